@@ -0,0 +1,119 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of computing audience (GatewayDispatcher.getChannelFilter) of one channel event, e.g. MESSAGE_CREATE.
+
+"before" fetches guild, owner, roles and overwrites of channel and checks permissions of every member with user
+overwrite (several queries per such member) for every event. "after" uses cached GuildPermissionModel:
+"cold" is the first event after guild permissions changed, "warm" is every other event.
+
+Usage: python -m benchmarks.gateway_channel_filter [roles] [user_overwrites]
+"""
+
+import asyncio
+import sys
+from datetime import date
+from time import perf_counter
+
+from yepcord.yepcord.enums import ChannelType, GuildPermissions
+from yepcord.yepcord.errors import InvalidDataErr
+from yepcord.yepcord.gateway_dispatcher import GatewayDispatcher
+from yepcord.yepcord.models import User, UserData, Guild, GuildMember, Role, Channel, PermissionOverwrite
+from .utils import count_queries, memory_db
+
+
+async def populate(roles_count: int, overwrites_count: int) -> Channel:
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(overwrites_count + 1)]
+    await User.bulk_create(users)
+    await UserData.bulk_create([
+        UserData(id=user.id, user_id=user.id, birth=date(2000, 1, 1), username=f"user{i}", discriminator=1)
+        for i, user in enumerate(users)
+    ])
+    guild = await Guild.create(owner_id=users[0].id, name="guild")
+    await Role.create(id=guild.id, guild_id=guild.id, name="@everyone", permissions=1024)
+    roles = [Role(guild_id=guild.id, name=str(i), position=i + 1, permissions=i % 2 * 1024) for i in range(roles_count)]
+    await Role.bulk_create(roles)
+    await GuildMember.bulk_create([GuildMember(guild_id=guild.id, user_id=user.id) for user in users])
+    channel = await Channel.create(guild_id=guild.id, type=ChannelType.GUILD_TEXT, name="channel", position=0)
+    await PermissionOverwrite.bulk_create([
+        PermissionOverwrite(channel_id=channel.id, target_role_id=role.id, type=0, allow=0, deny=1024)
+        for role in roles[::2]
+    ] + [
+        PermissionOverwrite(channel_id=channel.id, target_user_id=user.id, type=1, allow=0, deny=i % 2 * 1024)
+        for i, user in enumerate(users[1:])
+    ])
+    return await Channel.get(id=channel.id)
+
+
+async def filter_before(channel: Channel, permissions: int) -> dict:
+    await channel.fetch_related("guild", "guild__owner")
+    roles = {role.id: role.permissions for role in await channel.guild.get_roles()}
+
+    user_ids = set()
+    excluded_user_ids = set()
+    for overwrite in await channel.get_permission_overwrites():
+        if overwrite.type == 0:
+            if overwrite.target_role.id not in roles:
+                continue
+            roles[overwrite.target_role.id] &= ~overwrite.deny
+            roles[overwrite.target_role.id] |= overwrite.allow
+        else:
+            if not (member := await channel.guild.get_member(overwrite.target_user.id)):
+                continue
+            try:
+                await member.checkPermission(permissions, channel=channel)
+                user_ids.add(member.user.id)
+            except InvalidDataErr:
+                excluded_user_ids.add(member.user.id)
+
+    user_ids.add(channel.guild.owner.id)
+    excluded_user_ids.discard(channel.guild.owner.id)
+    return {
+        "role_ids": [role_id for role_id, perms in roles.items() if perms & permissions == permissions or perms & 8],
+        "user_ids": list(user_ids),
+        "exclude": list(excluded_user_ids),
+    }
+
+
+async def main(roles_count: int, overwrites_count: int) -> None:
+    async with memory_db():
+        channel = await populate(roles_count, overwrites_count)
+        print(f"Roles: {roles_count}, user overwrites: {overwrites_count}")
+        dispatcher = GatewayDispatcher()
+        permissions = GuildPermissions.VIEW_CHANNEL
+
+        expected = await filter_before(channel, permissions)
+        after = await dispatcher.getChannelFilter(channel, permissions)
+        assert {key: set(value) for key, value in expected.items()} == {key: set(value) for key, value in after.items()}
+
+        async def after_cold(channel_: Channel, permissions_: int) -> dict:
+            dispatcher.permissions.invalidate(channel_.guild_id)
+            return await dispatcher.getChannelFilter(channel_, permissions_)
+
+        for name, func in (("before", filter_before), ("after (cold)", after_cold),
+                           ("after (warm)", dispatcher.getChannelFilter)):
+            with count_queries() as counter:
+                start = perf_counter()
+                for _ in range(10):
+                    await func(channel, permissions)
+                elapsed = perf_counter() - start
+            print(f"  {name}: {counter.count / 10:.0f} queries, {elapsed / 10 * 1000:.3f}ms per event")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args, *(50, 20)[len(args):]))
@@ -0,0 +1,70 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Broker messages and gateway callbacks of write-heavy api load: every request dispatches several events to the same
+users (e.g. send message dispatches MESSAGE_CREATE and MESSAGE_ACK, guild operations dispatch many more).
+
+"before" every event is a separate broker message and gateway callback, "after" (GATEWAY_BATCH_DISPATCH) events of
+one request are published as one envelope per broker channel. Broker is simulated in-process (message is serialized
+to json and passed to Gateway.mcl_yepcordEventsCallback), so time only includes serialization and callbacks.
+
+Usage: python -m benchmarks.gateway_dispatch_batch [requests] [events_per_request]
+"""
+
+import asyncio
+import sys
+from json import dumps, loads
+from time import perf_counter
+
+from yepcord.gateway.events import RawDispatchEvent
+from yepcord.gateway.gateway import Gateway
+from yepcord.yepcord.config import Config
+from yepcord.yepcord.enums import GatewayOp
+from yepcord.yepcord.gateway_dispatcher import GatewayDispatcher
+
+
+async def main(requests: int, events: int) -> None:
+    dispatcher = GatewayDispatcher()
+    gateway = Gateway()
+    stats = {"messages": 0, "callbacks": 0}
+
+    async def publish(message: dict, channel: str) -> None:
+        stats["messages"] += 1
+        if channel.startswith("yepcord_events"):
+            stats["callbacks"] += 1
+            await gateway.mcl_yepcordEventsCallback(loads(dumps(message)))
+
+    dispatcher.broker.publish = publish
+    event = RawDispatchEvent({"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"content": "test" * 25}})
+
+    print(f"Requests: {requests}, events per request: {events}")
+    for name, enabled in (("before", False), ("after", True)):
+        Config.GATEWAY_BATCH_DISPATCH = enabled
+        stats["messages"] = stats["callbacks"] = 0
+        start = perf_counter()
+        for i in range(requests):
+            async with dispatcher.batch():
+                for _ in range(events):
+                    await dispatcher.dispatch(event, user_ids=[i % 100 + 1, i % 100 + 2])
+        elapsed = perf_counter() - start
+        print(f"  {name}: {stats['messages']} broker messages, {stats['callbacks']} gateway callbacks, "
+              f"{elapsed / requests * 1000000:.1f}us per request")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args, *(10000, 3)[len(args):]))
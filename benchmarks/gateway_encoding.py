@@ -0,0 +1,67 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Bytes per event and encode time of gateway dispatches for json and etf encodings with every compression.
+
+Every event is encoded once (EncodedDispatchEvent head) and then finished with per-client sequence number and
+passed through per-client compressor, like gateway does for each recipient.
+
+Usage: python -m benchmarks.gateway_encoding [events]
+"""
+
+import sys
+from time import process_time
+
+from yepcord.gateway.compression import WsCompressor
+from yepcord.gateway.encoding import WsEncoding
+from yepcord.gateway.events import EncodedDispatchEvent
+from .gateway_fanout import message_payload
+
+
+def make_events(count: int) -> list[EncodedDispatchEvent]:
+    events = []
+    for idx in range(count):
+        payload = message_payload()
+        payload["d"]["id"] = str(1234567890123456789 + idx)
+        payload["d"]["nonce"] = str(9876543210987654321 - idx)
+        events.append(EncodedDispatchEvent(payload))
+    return events
+
+
+def run(events: list[EncodedDispatchEvent], encoding: WsEncoding, compress: str = None) -> tuple[float, float]:
+    compressor = WsCompressor.create_compressor(compress)
+    total = 0
+    start = process_time()
+    for seq, event in enumerate(events, 1):
+        data = event.encode(seq, encoding)
+        if compressor is not None:
+            data = compressor(data.encode("utf8") if isinstance(data, str) else data)
+        total += len(data)
+    elapsed = process_time() - start
+    return total / len(events), elapsed / len(events)
+
+
+def main(count: int) -> None:
+    print(f"Events: {count}")
+    for compress in (None, "zlib-stream", "zstd-stream"):
+        for name in ("json", "etf"):
+            size, elapsed = run(make_events(count), WsEncoding.get(name), compress)
+            print(f"  {name}, compress={compress}: {size:.1f} bytes/event, {elapsed * 1e6:.2f} us/event")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,110 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Per-recipient CPU cost of gateway dispatch fan-out.
+
+"before" sends RawDispatchEvent to every client (json + dumps for every recipient),
+"after" sends EncodedDispatchEvent (body serialized once per broker message).
+
+Usage: python -m benchmarks.gateway_fanout [recipients]
+"""
+
+import asyncio
+import sys
+from json import dumps
+from time import process_time
+
+from yepcord.gateway.compression import WsCompressor
+from yepcord.gateway.events import RawDispatchEvent, EncodedDispatchEvent
+from yepcord.gateway.gateway import GatewayClient, Gateway
+from yepcord.yepcord.enums import GatewayOp
+
+
+class NullWs:
+    def __init__(self, compress: str = None):
+        self.compressor = WsCompressor.create_compressor(compress)
+
+    async def send(self, data) -> None:
+        pass
+
+    async def send_json(self, data: dict) -> None:
+        await self.send(dumps(data))
+
+
+def message_payload() -> dict:
+    return {
+        "t": "MESSAGE_CREATE",
+        "op": GatewayOp.DISPATCH,
+        "d": {
+            "id": "1234567890123456789",
+            "channel_id": "1234567890123456789",
+            "guild_id": "1234567890123456789",
+            "author": {
+                "id": "1234567890123456789", "username": "test_user", "discriminator": "0001", "avatar": None,
+                "avatar_decoration": None, "public_flags": 0,
+            },
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4,
+            "timestamp": "2024-01-01T00:00:00+00:00",
+            "edited_timestamp": None,
+            "embeds": [],
+            "attachments": [],
+            "mentions": [],
+            "mention_roles": [],
+            "mention_everyone": False,
+            "pinned": False,
+            "tts": False,
+            "type": 0,
+            "flags": 0,
+            "nonce": "1234567890123456789",
+        },
+    }
+
+
+async def run(event_cls: type, recipients: int, compress: str = None) -> float:
+    gw = Gateway()
+    clients = [GatewayClient(NullWs(compress), gw) for _ in range(recipients)]  # type: ignore
+    await asyncio.sleep(0)
+    start = process_time()
+    event = event_cls(message_payload())
+    for client in clients:
+        await client.esend(event)
+    while clients[-1].queue_size:  # Writers are woken up in order, so last one finishes last
+        await asyncio.sleep(0)
+    elapsed = process_time() - start
+
+    for client in clients:
+        client.disconnect()
+        gw.expire_session(client)
+    await asyncio.sleep(0)
+    return elapsed
+
+
+async def main(recipients: int) -> None:
+    print(f"Recipients: {recipients}")
+    for compress in (None, "zlib-stream"):
+        before = await run(RawDispatchEvent, recipients, compress)
+        after = await run(EncodedDispatchEvent, recipients, compress)
+        print(
+            f"  compress={compress}: "
+            f"before {before / recipients * 1e6:.2f} us/recipient, "
+            f"after {after / recipients * 1e6:.2f} us/recipient "
+            f"({before / after:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
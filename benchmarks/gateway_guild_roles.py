@@ -0,0 +1,79 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of resolving roles of guild-wide event (GatewayDispatcher.getRolesByPermissions), done for every dispatch
+with guild_id.
+
+"before" filters roles of guild with "permissions & mask" in sql for every event (and ignores ADMINISTRATOR),
+"after" uses RoleIndex from PermissionCache: "cold" is the first event after guild roles changed, "warm" is every
+other event.
+
+Usage: python -m benchmarks.gateway_guild_roles [roles]
+"""
+
+import asyncio
+import sys
+from time import perf_counter
+
+from tortoise.expressions import RawSQL
+
+from yepcord.yepcord.enums import GuildPermissions
+from yepcord.yepcord.gateway_dispatcher import GatewayDispatcher
+from yepcord.yepcord.models import User, Guild, Role
+from .utils import count_queries, memory_db
+
+
+async def populate(roles_count: int) -> int:
+    user = await User.create(email="user@yepcord.test", password="")
+    guild = await Guild.create(owner_id=user.id, name="guild")
+    await Role.create(id=guild.id, guild_id=guild.id, name="@everyone", permissions=1024)
+    await Role.bulk_create([
+        Role(guild_id=guild.id, name=str(i), position=i + 1, permissions=(1 << (i % 40)) | 1024)
+        for i in range(roles_count)
+    ])
+    return guild.id
+
+
+async def roles_before(guild_id: int, permissions: int) -> list[int]:
+    return await Role.filter(guild__id=guild_id).annotate(perms=RawSQL(f"permissions & {permissions}")) \
+        .filter(perms=permissions).values_list("id", flat=True)
+
+
+async def main(roles_count: int) -> None:
+    async with memory_db():
+        guild_id = await populate(roles_count)
+        print(f"Roles: {roles_count}")
+        dispatcher = GatewayDispatcher()
+
+        async def roles_cold(guild_id_: int, permissions_: int) -> list[int]:
+            dispatcher.permissions.invalidate(guild_id_)
+            return await dispatcher.getRolesByPermissions(guild_id_, permissions_)
+
+        for permissions in (0, GuildPermissions.MANAGE_GUILD):
+            print(f"  permissions={permissions}:")
+            for name, func in (("before", roles_before), ("after (cold)", roles_cold),
+                               ("after (warm)", dispatcher.getRolesByPermissions)):
+                with count_queries() as counter:
+                    start = perf_counter()
+                    for _ in range(100):
+                        await func(guild_id, permissions)
+                    elapsed = perf_counter() - start
+                print(f"    {name}: {counter.count / 100:.0f} queries, {elapsed / 100 * 1000:.3f}ms per event")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*[int(arg) for arg in sys.argv[1:2]] or [250]))
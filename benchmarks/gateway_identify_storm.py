@@ -0,0 +1,95 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Subscription bootstrap cost of a reconnect storm (many simultaneous IDENTIFYs).
+
+"before" loads guild members and then roles of every member (one query per guild),
+"after" uses Gateway.get_guilds_roles (two queries per IDENTIFY) and WsStore.add.
+
+Usage: python -m benchmarks.gateway_identify_storm [identifies] [users] [guilds]
+"""
+
+import asyncio
+import sys
+from time import perf_counter
+
+from tortoise import connections
+
+from yepcord.gateway.gateway import Gateway, WsStore
+from yepcord.yepcord.models import User, Guild, GuildMember, Role
+from .utils import count_queries, memory_db
+
+
+class FakeClient:
+    __slots__ = ("user_id", "sid",)
+
+    def __init__(self, user_id: int, sid: str):
+        self.user_id = user_id
+        self.sid = sid
+
+
+async def populate(users_count: int, guilds_count: int, roles_per_guild: int = 2) -> list[int]:
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(users_count)]
+    await User.bulk_create(users)
+    guilds = [Guild(owner_id=users[0].id, name=f"guild {i}") for i in range(guilds_count)]
+    await Guild.bulk_create(guilds)
+    roles = [Role(guild_id=guild.id, name=str(i)) for guild in guilds for i in range(roles_per_guild)]
+    await Role.bulk_create(roles)
+    members = [GuildMember(guild_id=guild.id, user_id=user.id) for guild in guilds for user in users]
+    await GuildMember.bulk_create(members)
+
+    guild_roles = {}
+    for role in roles:
+        guild_roles.setdefault(role.guild_id, []).append(role.id)
+    await connections.get("default").execute_many(
+        "INSERT INTO guildmember_role (guildmember_id, role_id) VALUES (?, ?)",
+        [[member.id, role_id] for member in members for role_id in guild_roles[member.guild_id]],
+    )
+
+    return [user.id for user in users]
+
+
+async def subscribe_before(store: WsStore, client: FakeClient) -> None:
+    guilds_roles = {}
+    for member in await GuildMember.filter(user__id=client.user_id).select_related("guild"):
+        guilds_roles[member.guild.id] = [role.id for role in await member.roles.all()]
+    store.add(client, guilds_roles)  # type: ignore
+
+
+async def subscribe_after(store: WsStore, client: FakeClient) -> None:
+    store.add(client, await Gateway.get_guilds_roles(client.user_id))  # type: ignore
+
+
+async def main(identifies: int, users_count: int, guilds_count: int) -> None:
+    async with memory_db():
+        user_ids = await populate(users_count, guilds_count)
+        print(f"IDENTIFYs: {identifies}, users: {users_count}, guilds per user: {guilds_count}")
+
+        for name, func in (("before", subscribe_before), ("after", subscribe_after)):
+            store = WsStore()
+            clients = [FakeClient(user_ids[i % users_count], str(i)) for i in range(identifies)]
+            with count_queries() as counter:
+                start = perf_counter()
+                await asyncio.gather(*(func(store, client) for client in clients))
+                elapsed = perf_counter() - start
+
+            print(f"  {name}: {counter.count} queries ({counter.count / identifies:.1f} per IDENTIFY), {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    asyncio.run(main(*args, *(1000, 10, 100)[len(args):]))
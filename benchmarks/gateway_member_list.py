@@ -0,0 +1,134 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of LAZY_REQUEST member lists and of keeping them up to date.
+
+"before" loads every member of guild and serializes all of them (with role/userdata queries per member) into one
+SYNC, which had to be sent again for every change. "after" loads guild once into MemberLists (fixed number
+of queries) and sends only requested range; presence change is then sent as incremental ops.
+
+Usage: python -m benchmarks.gateway_member_list [members] [roles]
+"""
+
+import asyncio
+import sys
+from datetime import date
+from json import dumps
+from time import perf_counter
+from typing import Optional
+
+from tortoise import connections
+
+from yepcord.gateway.events import EncodedDispatchEvent
+from yepcord.gateway.member_list import MemberLists
+from yepcord.gateway.presences import Presence
+from yepcord.yepcord.models import User, UserData, Guild, GuildMember, Role
+from .utils import count_queries, memory_db
+
+
+class Presences:
+    __slots__ = ("presences",)
+
+    def __init__(self, user_ids: list[int]):
+        self.presences = {user_id: Presence(user_id, "online") for user_id in user_ids[::3]}
+
+    async def get(self, user_id: int) -> Optional[Presence]:
+        return self.presences.get(user_id)
+
+    async def get_many(self, user_ids) -> dict[int, Presence]:
+        return {user_id: self.presences[user_id] for user_id in user_ids if user_id in self.presences}
+
+
+class FakeClient:
+    __slots__ = ("user_id", "sent",)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.sent = 0
+
+    async def esend(self, event) -> None:
+        data = event.data if isinstance(event, EncodedDispatchEvent) else await event.json()
+        self.sent += len(dumps(data))
+
+
+async def populate(members_count: int, roles_count: int) -> tuple[int, list[int]]:
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(members_count)]
+    await User.bulk_create(users)
+    await UserData.bulk_create([
+        UserData(id=user.id, user_id=user.id, birth=date(2000, 1, 1), username=f"user{i}", discriminator=1)
+        for i, user in enumerate(users)
+    ])
+    guild = await Guild.create(owner_id=users[0].id, name="guild")
+    await Role.create(id=guild.id, guild_id=guild.id, name="@everyone", permissions=1024)
+    roles = [Role(guild_id=guild.id, name=str(i), position=i + 1, hoist=True) for i in range(roles_count)]
+    await Role.bulk_create(roles)
+    members = [GuildMember(guild_id=guild.id, user_id=user.id) for user in users]
+    await GuildMember.bulk_create(members)
+    await connections.get("default").execute_many(
+        "INSERT INTO guildmember_role (guildmember_id, role_id) VALUES (?, ?)",
+        [[member.id, roles[i % roles_count].id] for i, member in enumerate(members[:members_count // 10])],
+    )
+
+    return guild.id, [user.id for user in users]
+
+
+async def full_list_before(guild_id: int, presences: Presences) -> int:
+    members = await GuildMember.filter(guild_id=guild_id).select_related("user")
+    statuses = await presences.get_many(member.user.id for member in members)
+    items = []
+    for member in members:
+        data = await member.ds_json()
+        status = statuses[member.user.id].public_status if member.user.id in statuses else "offline"
+        data["presence"] = {"user": {"id": str(member.user.id)}, "status": status, "activities": []}
+        items.append({"member": data})
+    items.sort(key=lambda item: item["member"]["presence"]["status"])
+    return len(dumps({"ops": [{"op": "SYNC", "range": [0, 99], "items": items}]}))
+
+
+async def main(members_count: int, roles_count: int) -> None:
+    async with memory_db():
+        guild_id, user_ids = await populate(members_count, roles_count)
+        presences = Presences(user_ids)
+        print(f"Members: {members_count}, hoisted roles: {roles_count}")
+
+        with count_queries() as counter:
+            start = perf_counter()
+            size = await full_list_before(guild_id, presences)
+            elapsed = perf_counter() - start
+        print(f"  before: {counter.count} queries, {elapsed * 1000:.1f}ms, {size / 1024:.1f}KiB per change")
+
+        lists = MemberLists(presences)  # type: ignore
+        client = FakeClient(user_ids[0])
+        with count_queries() as counter:
+            start = perf_counter()
+            await lists.subscribe(client, guild_id, None, [(0, 99)])  # type: ignore
+            elapsed = perf_counter() - start
+        print(f"  after: {counter.count} queries, {elapsed * 1000:.1f}ms, {client.sent / 1024:.1f}KiB initial SYNC")
+
+        client.sent = 0
+        changes = min(1000, members_count)
+        start = perf_counter()
+        for i in range(changes):
+            await lists.presence_update(user_ids[i], "idle" if i % 2 else "offline", [])
+        elapsed = perf_counter() - start
+        print(f"  after (presence changes): {elapsed / changes * 1000000:.1f}us, "
+              f"{client.sent / changes / 1024:.2f}KiB per change")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args, *(10000, 5)[len(args):]))
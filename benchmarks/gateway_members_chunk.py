@@ -0,0 +1,76 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of GUILD_MEMBERS (op 8) requests.
+
+"before" runs nick/username prefix query joined with userdata for every search (and serializes members with
+queries per member), "after" searches prefix index of MemberLists (guild is loaded on first search).
+"chunks" streams all members of guild (limit=0) with keyset pagination; peak memory is measured with tracemalloc.
+
+Usage: python -m benchmarks.gateway_members_chunk [members] [searches]
+"""
+
+import asyncio
+import sys
+import tracemalloc
+from time import perf_counter
+
+from tortoise.expressions import Q
+
+from yepcord.gateway.member_list import MemberLists
+from yepcord.yepcord.models import GuildMember
+from .gateway_member_list import Presences, populate
+from .utils import count_queries, memory_db
+
+
+async def search_before(guild_id: int, query: str) -> int:
+    q = Q(guild__id=guild_id) & (Q(nick__startswith=query) | Q(user__userdatas__username__istartswith=query))
+    members = await GuildMember.filter(q).select_related("user").limit(100)
+    return len([await member.ds_json() for member in members])
+
+
+async def main(members_count: int, searches: int) -> None:
+    async with memory_db():
+        guild_id, user_ids = await populate(members_count, 5)
+        lists = MemberLists(Presences(user_ids))  # type: ignore
+        print(f"Members: {members_count}, searches: {searches}")
+
+        queries = [f"user{i % members_count}" for i in range(searches)]
+        for name, func in (("before", search_before), ("after", lambda *args: lists.search(*args, 100))):
+            with count_queries() as counter:
+                start = perf_counter()
+                for query in queries:
+                    await func(guild_id, query)
+                elapsed = perf_counter() - start
+            print(f"  {name}: {counter.count} queries, {elapsed / searches * 1000:.2f}ms per search")
+
+        with count_queries() as counter:
+            start = perf_counter()
+            chunks = [len(entries) async for _, _, entries in lists.iter_chunks(guild_id)]
+            elapsed = perf_counter() - start
+        tracemalloc.start()
+        async for _ in lists.iter_chunks(guild_id):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  chunks: {len(chunks)} chunks, {counter.count} queries, {elapsed * 1000:.1f}ms, "
+              f"peak memory {peak / 1024:.0f}KiB")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args, *(10000, 100)[len(args):]))
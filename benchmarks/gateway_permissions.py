@@ -0,0 +1,145 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of computing effective permissions of every member in every channel of a large guild.
+
+"before" checks every member with GuildMember.checkPermission (PermissionsChecker, several queries per member and
+channel), it is measured on a sample of members and extrapolated. "after" loads PermissionEngine once (4 queries) and
+computes permissions of all members by role-set classes: compute() returns {channel: {member: permissions}},
+members_with() returns bitset of members with permissions in a channel (what event audience needs).
+
+Usage: python -m benchmarks.gateway_permissions [members] [channels] [roles]
+"""
+
+import asyncio
+import sys
+from datetime import date
+from random import Random
+from time import perf_counter
+
+from tortoise import connections
+
+from yepcord.yepcord.enums import ChannelType, GuildPermissions
+from yepcord.yepcord.errors import InvalidDataErr
+from yepcord.yepcord.models import User, UserData, Guild, GuildMember, Role, Channel, PermissionOverwrite
+from yepcord.yepcord.permissions import PermissionEngine
+from .utils import count_queries, memory_db
+
+SAMPLE = 20
+
+
+async def populate(members_count: int, channels_count: int, roles_count: int) -> Guild:
+    random = Random(0)
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(members_count)]
+    await User.bulk_create(users, batch_size=1000)
+    await UserData.bulk_create([
+        UserData(id=user.id, user_id=user.id, birth=date(2000, 1, 1), username=f"user{i}", discriminator=1)
+        for i, user in enumerate(users)
+    ], batch_size=1000)
+    guild = await Guild.create(owner_id=users[0].id, name="guild")
+    await Role.create(id=guild.id, guild_id=guild.id, name="@everyone", permissions=1024 | 2048)
+    await Role.bulk_create([
+        Role(guild_id=guild.id, name=str(i), position=i + 1, permissions=0) for i in range(roles_count)
+    ])
+    roles = await Role.filter(guild_id=guild.id).exclude(id=guild.id)
+    await GuildMember.bulk_create([GuildMember(guild_id=guild.id, user_id=user.id) for user in users], batch_size=1000)
+    members = await GuildMember.filter(guild_id=guild.id).values_list("id", flat=True)
+
+    field = GuildMember._meta.fields_map["roles"]
+    await connections.get("default").execute_many(
+        f"INSERT INTO {field.through} ({field.backward_key}, {field.forward_key}) VALUES (?, ?)",
+        [[member_id, role.id] for member_id in members for role in random.sample(roles, 3)],
+    )
+
+    await Channel.bulk_create([
+        Channel(guild_id=guild.id, type=ChannelType.GUILD_TEXT, name=f"channel{i}", position=i)
+        for i in range(channels_count)
+    ])
+    channels = await Channel.filter(guild_id=guild.id)
+    overwrites = []
+    for i, channel in enumerate(channels):
+        if i % 5 == 0:  # Private channel
+            overwrites.append(PermissionOverwrite(channel_id=channel.id, target_role_id=guild.id, type=0, allow=0,
+                                                  deny=1024))
+        for role in random.sample(roles, 3):
+            overwrites.append(PermissionOverwrite(channel_id=channel.id, target_role_id=role.id, type=0,
+                                                  allow=random.choice((0, 1024)), deny=random.choice((0, 2048))))
+        user = random.choice(users)
+        overwrites.append(PermissionOverwrite(channel_id=channel.id, target_user_id=user.id, type=1, allow=1024,
+                                              deny=0))
+    await PermissionOverwrite.bulk_create(overwrites, batch_size=1000)
+    return guild
+
+
+async def before(guild: Guild, channels: list[Channel], user_ids: list[int]) -> dict[int, set[int]]:
+    result = {}
+    for channel in channels:
+        visible = result[channel.id] = set()
+        for user_id in user_ids:
+            member = await guild.get_member(user_id)
+            try:
+                await member.checkPermission(GuildPermissions.VIEW_CHANNEL, channel=channel)
+                visible.add(user_id)
+            except InvalidDataErr:
+                pass
+    return result
+
+
+async def main(members_count: int, channels_count: int, roles_count: int) -> None:
+    async with memory_db():
+        guild = await populate(members_count, channels_count, roles_count)
+        guild = await Guild.get(id=guild.id).select_related("owner")
+        channels = await Channel.filter(guild_id=guild.id).select_related("guild")
+        user_ids = list(await GuildMember.filter(guild_id=guild.id).values_list("user_id", flat=True))
+        print(f"Members: {members_count}, channels: {channels_count}, roles: {roles_count}")
+
+        sample = user_ids[1:SAMPLE + 1]
+        with count_queries() as counter:
+            start = perf_counter()
+            expected = await before(guild, channels[:1], sample)
+            elapsed = perf_counter() - start
+        pairs = members_count * channels_count
+        print(f"  before: {counter.count / SAMPLE:.0f} queries/member/channel, {elapsed / SAMPLE * 1000:.3f}ms per "
+              f"member/channel, ~{elapsed / SAMPLE * pairs:.0f}s and ~{counter.count / SAMPLE * pairs:.0f} queries "
+              f"for whole guild (extrapolated)")
+
+        with count_queries() as counter:
+            start = perf_counter()
+            engine = await PermissionEngine.load(guild.id)
+            elapsed = perf_counter() - start
+        print(f"  after: load {counter.count} queries, {elapsed * 1000:.1f}ms, {len(engine._classes)} role-set classes")
+
+        start = perf_counter()
+        computed = engine.compute([channel.id for channel in channels])
+        elapsed = perf_counter() - start
+        print(f"  after: compute() of {pairs} member/channel pairs {elapsed * 1000:.1f}ms")
+
+        start = perf_counter()
+        for channel in channels:
+            engine.members_with(channel.id, GuildPermissions.VIEW_CHANNEL)
+        elapsed = perf_counter() - start
+        print(f"  after: members_with() {elapsed / channels_count * 1000:.3f}ms per channel")
+
+        channel_id = channels[0].id
+        assert expected[channel_id] == {
+            user_id for user_id in sample if computed[channel_id][user_id] & GuildPermissions.VIEW_CHANNEL
+        }
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    asyncio.run(main(*args, *(10000, 500, 50)[len(args):]))
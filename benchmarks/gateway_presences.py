@@ -0,0 +1,148 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Redis round trips and latency of reading presences of many users (friends list, lazy guild member list).
+
+"before" calls Presences.get for every user, "after" calls Presences.get_many once, "cached" repeats "after" with
+presences already in node-local cache.
+Second part compares writing heartbeats one pipeline per session ("before") with Presences.refresh ("after").
+Uses redis from REDIS_URL environment variable if set, otherwise in-memory FakeRedis with simulated round trip time.
+
+Usage: python -m benchmarks.gateway_presences [rtt_ms]
+"""
+
+import asyncio
+import os
+import sys
+from json import dumps
+from time import perf_counter
+
+from redis.asyncio import Redis
+
+from yepcord.gateway.presences import Presences, Presence
+from yepcord.yepcord.utils.fakeredis import FakeRedis
+
+
+class RoundTripCounter:
+    def __init__(self, redis, rtt: float):
+        self._redis = redis
+        self._rtt = rtt
+        self.count = 0
+
+    def __getattr__(self, item):
+        func = getattr(self._redis, item)
+
+        async def _wrapped(*args, **kwargs):
+            self.count += 1
+            if self._rtt:
+                await asyncio.sleep(self._rtt)
+            return await func(*args, **kwargs)
+
+        return _wrapped
+
+    def pipeline(self):
+        return CountingPipeline(self, self._redis.pipeline())
+
+
+class CountingPipeline:
+    def __init__(self, counter: RoundTripCounter, pipe):
+        self._counter = counter
+        self._pipe = pipe
+
+    def __getattr__(self, item):
+        return getattr(self._pipe, item)
+
+    async def execute(self):
+        self._counter.count += 1
+        if self._counter._rtt:
+            await asyncio.sleep(self._counter._rtt)
+        return await self._pipe.execute()
+
+
+class FakeGateway:
+    def __init__(self, redis):
+        self.redis = redis
+
+
+async def before(presences: Presences, user_ids: list[int]) -> int:
+    online = 0
+    for user_id in user_ids:
+        if await presences.get(user_id) is not None:
+            online += 1
+    return online
+
+
+async def after(presences: Presences, user_ids: list[int]) -> int:
+    return len(await presences.get_many(user_ids))
+
+
+async def main(rtt_ms: float) -> None:
+    if redis_url := os.environ.get("REDIS_URL"):
+        redis = Redis.from_url(redis_url, decode_responses=True)
+        rtt = 0
+        print(f"Redis: {redis_url}")
+    else:
+        redis = FakeRedis()
+        rtt = rtt_ms / 1000
+        print(f"Redis: FakeRedis, simulated round trip time: {rtt_ms}ms")
+
+    for count in (10, 1000, 10000):
+        user_ids = list(range(1, count + 1))
+        for user_id in user_ids[::2]:  # Half of users are online
+            await redis.set(f"presence_{user_id}", dumps({"status": "online", "activities": []}), ex=60)
+
+        print(f"Users: {count}")
+        counter = RoundTripCounter(redis, rtt)
+        presences = None
+        for name, func in (("before", before), ("after", after), ("cached", after)):
+            counter.count = 0
+            if name != "cached":
+                presences = Presences(FakeGateway(counter))  # type: ignore
+            start = perf_counter()
+            online = await func(presences, user_ids)
+            elapsed = perf_counter() - start
+            assert online == (count + 1) // 2
+            print(f"  {name}: {counter.count} round trips, {elapsed * 1000:.2f}ms")
+
+        for user_id in user_ids[::2]:
+            await redis.delete(f"presence_{user_id}")
+
+    print("Heartbeats of all sessions in one keep-alive interval:")
+    for count in (10, 1000, 10000):
+        counter = RoundTripCounter(redis, rtt)
+        presences = Presences(FakeGateway(counter))  # type: ignore
+        start = perf_counter()
+        for user_id in range(1, count + 1):
+            await presences.set_or_refresh(user_id, Presence(user_id, "online"))
+        before_time = perf_counter() - start
+        before_count, counter.count = counter.count, 0
+
+        start = perf_counter()
+        for user_id in range(1, count + 1):
+            presences.refresh(user_id, Presence(user_id, "online"))
+        await presences.flush()
+        after_time = perf_counter() - start
+        print(
+            f"  {count} sessions: before {before_count} pipelines, {before_time * 1000:.2f}ms, "
+            f"after {counter.count} pipelines, {after_time * 1000:.2f}ms"
+        )
+
+    await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.2))
@@ -0,0 +1,146 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Cost of building READY payload collections (guilds, private channels, read states, relationships, users).
+
+"before" serializes every guild/channel/read state with its own ds_json (several queries per object),
+"after" uses ReadyLoader (fixed number of queries), "cached" is a reconnect with all guilds found in GuildCache.
+"lazy" builds READY with unavailable guild stubs (GATEWAY_LAZY_GUILDS), guilds are then loaded in batches for
+GUILD_CREATE events; peak memory is measured with tracemalloc.
+
+Usage: python -m benchmarks.gateway_ready [guilds] [channels_per_guild] [friends]
+"""
+
+import asyncio
+import sys
+import tracemalloc
+from datetime import date, datetime
+from time import perf_counter
+
+from tortoise import connections
+
+from yepcord.gateway.ready import ReadyLoader, GuildCache
+from yepcord.yepcord.enums import ChannelType, RelationshipType
+from yepcord.yepcord.models import User, UserData, Guild, GuildMember, Role, Channel, Emoji, PermissionOverwrite, \
+    Message, ReadState, Relationship
+from .utils import count_queries, memory_db
+
+
+async def populate(guilds_count: int, channels_per_guild: int, friends_count: int) -> User:
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(friends_count + 1)]
+    await User.bulk_create(users)
+    await UserData.bulk_create([
+        UserData(id=user.id, user_id=user.id, birth=date(2000, 1, 1), username=f"user{i}", discriminator=1)
+        for i, user in enumerate(users)
+    ])
+    user, friends = users[0], users[1:]
+
+    guilds = [Guild(owner_id=user.id, name=f"guild {i}") for i in range(guilds_count)]
+    await Guild.bulk_create(guilds)
+    roles = [Role(id=guild.id, guild_id=guild.id, name="@everyone") for guild in guilds]
+    roles += [Role(guild_id=guild.id, name=str(i)) for guild in guilds for i in range(2)]
+    await Role.bulk_create(roles)
+    await GuildMember.bulk_create([GuildMember(guild_id=guild.id, user_id=user.id) for guild in guilds])
+    await Emoji.bulk_create([Emoji(guild_id=guild.id, user_id=user.id, name=f"emoji{i}")
+                             for guild in guilds for i in range(2)])
+    channels = [
+        Channel(guild_id=guild.id, type=ChannelType.GUILD_TEXT, name=f"channel{i}", position=i)
+        for guild in guilds for i in range(channels_per_guild)
+    ]
+    await Channel.bulk_create(channels)
+    await PermissionOverwrite.bulk_create([
+        PermissionOverwrite(channel_id=channel.id, target_role_id=channel.guild_id, type=0, allow=0, deny=1024)
+        for channel in channels
+    ])
+
+    relationships = [Relationship(from_user_id=user.id, to_user_id=friend.id, type=RelationshipType.FRIEND)
+                     for friend in friends]
+    await Relationship.bulk_create(relationships)
+    dms = [Channel(type=ChannelType.DM) for _ in friends]
+    await Channel.bulk_create(dms)
+    await connections.get("default").execute_many(
+        "INSERT INTO channel_user (channel_id, user_id) VALUES (?, ?)",
+        [[dm.id, member.id] for dm, friend in zip(dms, friends) for member in (user, friend)],
+    )
+
+    messages = [Message(channel_id=channel.id, author_id=user.id, content="test") for channel in channels + dms]
+    messages += [Message(channel_id=dm.id, author_id=user.id, content="pin", pinned_timestamp=datetime.now())
+                 for dm in dms]
+    await Message.bulk_create(messages)
+    await ReadState.bulk_create([ReadState(channel_id=dm.id, user_id=user.id, last_read_id=0, count=1) for dm in dms])
+
+    return await User.get(id=user.id)
+
+
+async def load_before(user: User) -> None:
+    [(await related.data).ds_json for related in await user.get_related_users()]
+    [await guild.ds_json(user_id=user.id, for_gateway=True, with_channels=True) for guild in await user.get_guilds()]
+    [await relationship.ds_json(user) for relationship in await user.get_relationships()]
+    [await channel.ds_json(user_id=user.id) for channel in await user.get_private_channels()]
+    [await state.ds_json() for state in await user.get_read_states()]
+
+
+async def load_after(user: User) -> None:
+    await ReadyLoader(user).load()
+
+
+async def load_lazy(user: User, batch_size: int = 10) -> float:
+    loader = ReadyLoader(user)
+    await loader.load(lazy_guilds=True)
+    ready_time = perf_counter()
+    guild_ids = await GuildMember.filter(user_id=user.id).values_list("guild_id", flat=True)
+    for i in range(0, len(guild_ids), batch_size):
+        await loader.load_guilds(guild_ids[i:i + batch_size])
+    return ready_time
+
+
+async def main(guilds_count: int, channels_per_guild: int, friends_count: int) -> None:
+    async with memory_db():
+        user = await populate(guilds_count, channels_per_guild, friends_count)
+        print(f"Guilds: {guilds_count}, channels per guild: {channels_per_guild}, friends (dm channels): {friends_count}")
+
+        cache = GuildCache()
+        await ReadyLoader(user, cache).load()
+
+        async def load_cached(user_: User) -> None:
+            await ReadyLoader(user_, cache).load()
+
+        for name, func in (("before", load_before), ("after", load_after), ("cached", load_cached)):
+            with count_queries() as counter:
+                start = perf_counter()
+                await func(user)
+                elapsed = perf_counter() - start
+
+            print(f"  {name}: {counter.count} queries, {elapsed * 1000:.1f}ms")
+
+        for name, func in (("full READY", load_after), ("lazy READY", load_lazy)):
+            tracemalloc.start()
+            start = perf_counter()
+            ready_time = await func(user) or perf_counter()
+            elapsed = perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(
+                f"  {name}: READY after {(ready_time - start) * 1000:.1f}ms, all guilds after {elapsed * 1000:.1f}ms, "
+                f"peak memory {peak / 1024:.0f}KiB"
+            )
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    asyncio.run(main(*args, *(100, 5, 20)[len(args):]))
@@ -0,0 +1,87 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Database queries needed to find recipients of presence updates.
+
+"before" loads relationships, dm channels and recipients of every channel on every presence update,
+"after" uses RelatedUsers graph of gateway (loaded once per user, then updated by "related" system events).
+
+Usage: python -m benchmarks.gateway_related_users [updates] [friends] [dm_channels]
+"""
+
+import asyncio
+import sys
+from time import perf_counter
+
+from tortoise import connections
+
+from yepcord.gateway.related_users import RelatedUsers
+from yepcord.yepcord.enums import ChannelType, RelationshipType
+from yepcord.yepcord.models import User, Relationship, Channel
+from yepcord.yepcord.snowflake import Snowflake
+from .utils import count_queries, memory_db
+
+
+async def populate(friends_count: int, channels_count: int) -> User:
+    users = [User(email=f"user{i}@yepcord.test", password="") for i in range(friends_count + channels_count + 1)]
+    await User.bulk_create(users)
+    user, others = users[0], users[1:]
+    await Relationship.bulk_create([
+        Relationship(from_user_id=user.id, to_user_id=other.id, type=RelationshipType.FRIEND)
+        for other in others[:friends_count]
+    ])
+    channels = [Channel(id=Snowflake.makeId(), type=ChannelType.DM) for _ in range(channels_count)]
+    await Channel.bulk_create(channels)
+    await connections.get("default").execute_many(
+        "INSERT INTO channel_user (channel_id, user_id) VALUES (?, ?)",
+        [
+            [channel.id, user_id]
+            for channel, other in zip(channels, others[friends_count:])
+            for user_id in (user.id, other.id)
+        ],
+    )
+    return user
+
+
+async def related_before(user: User) -> set[int]:
+    users = {relationship.other_user(user).id for relationship in await user.get_relationships()}
+    for channel in await Channel.filter(recipients__id=user.id):
+        for recipient in await channel.recipients.all():
+            if recipient != user:
+                users.add(recipient.id)
+    return users
+
+
+async def main(updates: int, friends_count: int, channels_count: int) -> None:
+    async with memory_db():
+        user = await populate(friends_count, channels_count)
+        related = RelatedUsers()
+        print(f"Presence updates: {updates}, friends: {friends_count}, dm channels: {channels_count}")
+
+        for name, func in (("before", lambda: related_before(user)), ("after", lambda: related.get(user.id))):
+            with count_queries() as counter:
+                start = perf_counter()
+                for _ in range(updates):
+                    assert len(await func()) == friends_count + channels_count
+                elapsed = perf_counter() - start
+
+            print(f"  {name}: {counter.count} queries ({counter.count / updates:.1f} per update), {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    asyncio.run(main(*args, *(100, 50, 50)[len(args):]))
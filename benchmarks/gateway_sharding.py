@@ -0,0 +1,171 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Local multi-process harness for sharded gateway (GATEWAY_SHARDING).
+
+Spawns N gateway node processes connected to the same ws message broker, each node holds clients of users from its
+shards, then publishes user-targeted and guild-wide events through GatewayDispatcher and reports how many broker
+messages every node received and whether every user got exactly the events addressed to it.
+"unsharded" runs every node with GATEWAY_SHARDING.count == 1 (every node receives every message),
+"sharded" runs node i with {"count": N, "shards": [i]}, "interest" runs every node with
+GATEWAY_SUBSCRIPTIONS = "interest" (per-guild and per-user channels).
+
+Note that ws broker (development-only) still relays raw frames to every connection and filters channels on
+the receiving side, with redis/rabbitmq/kafka/nats brokers messages for other shards are not delivered at all.
+
+Usage: python -m benchmarks.gateway_sharding [nodes] [events] [users]
+"""
+
+import asyncio
+import sys
+import warnings
+from json import dumps, loads
+from random import Random
+
+from yepcord.gateway.events import RawDispatchEvent
+from yepcord.gateway.gateway import Gateway
+from yepcord.yepcord.config import Config
+from yepcord.yepcord.enums import GatewayOp
+from yepcord.yepcord.gateway_dispatcher import GatewayDispatcher
+
+BROKER_URL = "ws://127.0.0.1:5099"
+GUILD_ID = 1
+
+
+MODES = ("unsharded", "sharded", "interest")
+
+
+def configure(mode: str, node: int, nodes: int) -> None:
+    warnings.simplefilter("ignore")
+    Config.update({
+        "MESSAGE_BROKER": Config.MESSAGE_BROKER | {"type": "ws", "ws": {"url": BROKER_URL}},
+        "GATEWAY_SHARDING": {"count": nodes, "shards": [node] if node >= 0 else []}
+        if mode == "sharded" else {"count": 1, "shards": []},
+        "GATEWAY_SUBSCRIPTIONS": "interest" if mode == "interest" else "shards",
+    })
+
+
+def user_ids(users_count: int) -> list[int]:
+    return [(idx + 1) << 22 for idx in range(users_count)]
+
+
+class CountingClient:
+    __slots__ = ("user_id", "sid", "is_bot", "received",)
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.sid = str(user_id)
+        self.is_bot = False
+        self.received = 0
+
+    async def esend(self, event) -> None:
+        self.received += 1
+
+
+class CountingGateway(Gateway):
+    def __init__(self):
+        super().__init__()
+        self.broker_messages = 0
+
+    async def mcl_yepcordEventsCallback(self, body: dict) -> None:
+        self.broker_messages += 1
+        await super().mcl_yepcordEventsCallback(body)
+
+
+async def run_node(node: int, nodes: int, mode: str, users_count: int) -> None:
+    configure(mode, node, nodes)
+    gw = CountingGateway()
+    await gw.init()
+    clients = [
+        CountingClient(user_id) for user_id in user_ids(users_count)
+        if ((user_id >> 22) % nodes) == node
+    ]
+    for client in clients:
+        gw.store.add(client, {GUILD_ID: []})  # type: ignore
+    if gw.subscriptions is not None:
+        await gw.subscriptions.wait()
+
+    print("ready", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+    print(dumps({
+        "broker_messages": gw.broker_messages,
+        "received": {client.user_id: client.received for client in clients},
+    }), flush=True)
+    await gw.stop()
+
+
+async def run(nodes: int, events: int, users_count: int, mode: str) -> None:
+    configure(mode, -1, nodes)
+    dispatcher = GatewayDispatcher()
+    await dispatcher.init()
+
+    processes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, "-W", "ignore", "-m", "benchmarks.gateway_sharding",
+            "node", str(node), str(nodes), mode, str(users_count), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        for node in range(nodes)
+    ]
+    for process in processes:
+        assert (await process.stdout.readline()).strip() == b"ready"
+
+    users = user_ids(users_count)
+    expected = {user_id: 0 for user_id in users}
+    rand = Random(0)
+    for idx in range(events):
+        event = RawDispatchEvent({"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"idx": idx}})
+        if idx % 10 == 0:
+            await dispatcher.dispatch(event, guild_id=GUILD_ID, permissions=None)
+            targets = users
+        else:
+            targets = rand.sample(users, 2)
+            await dispatcher.dispatch(event, user_ids=targets)
+        for user_id in targets:
+            expected[user_id] += 1
+
+    await asyncio.sleep(1)
+    total = 0
+    ok = True
+    print(f"  {mode}:")
+    for node, process in enumerate(processes):
+        process.stdin.write(b"\n")
+        stats = loads(await process.stdout.readline())
+        await process.wait()
+        received = {int(user_id): count for user_id, count in stats["received"].items()}
+        node_ok = all(count == expected[user_id] for user_id, count in received.items())
+        ok = ok and node_ok
+        total += stats["broker_messages"]
+        print(f"    node {node}: {stats['broker_messages']} broker messages, {len(received)} users, "
+              f"deliveries {'match' if node_ok else 'DO NOT match'} expected")
+
+    print(f"    total: {total} broker messages received for {events} dispatched events, "
+          f"{'all deliveries correct' if ok else 'DELIVERY MISMATCH'}")
+    await dispatcher.stop()
+
+
+async def main(nodes: int, events: int, users_count: int) -> None:
+    print(f"Nodes: {nodes}, events: {events}, users: {users_count}")
+    for mode in MODES:
+        await run(nodes, events, users_count, mode)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["node"]:
+        asyncio.run(run_node(int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], int(sys.argv[5])))
+    else:
+        args = [int(arg) for arg in sys.argv[1:4]]
+        asyncio.run(main(*args, *(4, 1000, 200)[len(args):]))
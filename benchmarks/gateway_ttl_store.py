@@ -0,0 +1,108 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Presence workload (SET NX EX + EXPIRE pipelines, MGET, DEL) on FakeRedis and on real redis (REDIS_URL), and expiry
+of many keys by FakeRedis timer wheel on the event loop.
+
+"before" FakeRedis expired keys in its own thread with own event loop (and could fail with "Set changed size during
+iteration" or KeyError when set/expire were called concurrently), "after" expires keys on the main loop:
+each wheel tick only visits keys of one slot, so loop stall during expiry is reported as longest tick.
+
+Usage: python -m benchmarks.gateway_ttl_store [keys]
+"""
+
+import asyncio
+import os
+import sys
+from json import dumps
+from time import perf_counter
+
+from redis.asyncio import Redis
+
+from yepcord.yepcord.utils.fakeredis import FakeRedis
+
+VALUE = dumps({"status": "online", "activities": []})
+
+
+async def workload(redis, keys: list[str]) -> dict[str, float]:
+    result = {}
+
+    start = perf_counter()
+    for key in keys:
+        pipe = redis.pipeline()
+        await pipe.set(key, VALUE, ex=60, nx=True)
+        await pipe.expire(key, 60)
+        await pipe.execute()
+    result["set pipeline"] = perf_counter() - start
+
+    start = perf_counter()
+    for i in range(0, len(keys), 100):
+        await redis.mget(keys[i:i + 100])
+    result["mget (100 keys per call)"] = perf_counter() - start
+
+    start = perf_counter()
+    for key in keys:
+        await redis.delete(key)
+    result["delete"] = perf_counter() - start
+
+    return result
+
+
+async def expiry(count: int) -> None:
+    redis = FakeRedis(resolution=0.01)
+    for i in range(count):
+        await redis.set(f"presence_{i}", VALUE, ex=0.01 + (i % 100) / 100)
+
+    longest = 0
+    original = redis._run
+
+    def _run() -> None:
+        nonlocal longest
+        start = perf_counter()
+        original()
+        longest = max(longest, perf_counter() - start)
+
+    redis._run = _run
+    start = perf_counter()
+    while len(redis):
+        await asyncio.sleep(0.01)
+    elapsed = perf_counter() - start
+
+    print(f"  expiry of {count} keys (ttl 0.01-1s): all expired after {elapsed:.2f}s, "
+          f"longest tick {longest * 1000:.2f}ms, {redis.expired} expired")
+    await redis.close()
+
+
+async def main(count: int) -> None:
+    keys = [f"presence_{i}" for i in range(count)]
+    stores = [("FakeRedis", FakeRedis())]
+    if redis_url := os.environ.get("REDIS_URL"):
+        stores.append((f"redis ({redis_url})", Redis.from_url(redis_url, decode_responses=True)))
+
+    print(f"Keys: {count}")
+    for name, redis in stores:
+        result = await workload(redis, keys)
+        print(f"  {name}: " + ", ".join(
+            f"{op} {elapsed / count * 1000000:.2f}us/key" for op, elapsed in result.items()
+        ))
+        await redis.close()
+
+    await expiry(count)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*[int(arg) for arg in sys.argv[1:2]] or [100000]))
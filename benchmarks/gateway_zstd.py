@@ -0,0 +1,93 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Compressed size of the first messages of a gateway session: zlib-stream vs zstd-stream with and without
+the dictionary shipped with yepcord.
+
+Session is HELLO, READY and then GUILD_CREATE/PRESENCE_UPDATE/MESSAGE_CREATE dispatches, serialized by
+zstd_training.collect_samples (not scrubbed) from synthetic users/guilds/messages generated with another seed than
+the data dictionary was trained on.
+
+Usage: python -m benchmarks.gateway_zstd [users] [messages]
+"""
+
+import asyncio
+import sys
+from zlib import decompressobj
+
+import zstandard
+
+from yepcord.gateway.compression import WsCompressor, ZstdCompressor, zstd_dictionary
+from yepcord.gateway.encoding import JSON
+from yepcord.gateway.zstd_training import collect_samples, populate_synthetic, SYNTHETIC_ACTIVITIES
+from yepcord.yepcord.enums import GatewayOp
+from .utils import memory_db
+
+CHECKPOINTS = (1, 2, 10, 50, 200)
+
+
+def session_messages(samples: list[bytes]) -> list[bytes]:
+    hello = JSON.encode({"op": GatewayOp.HELLO, "t": None, "s": None, "d": {"heartbeat_interval": 45000}})
+    ready, *dispatches = samples
+    return [hello.encode("utf8"), ready, *dispatches]
+
+
+def compressed_sizes(compressor: WsCompressor, messages: list[bytes]) -> list[int]:
+    sizes = []
+    total = 0
+    for message in messages:
+        total += len(compressor(message))
+        sizes.append(total)
+    return sizes
+
+
+async def main(users_count: int, messages_count: int) -> None:
+    async with memory_db():
+        await populate_synthetic(users_count, 3, messages_count, seed=1)
+        samples = await collect_samples(messages_count, SYNTHETIC_ACTIVITIES, scrubbed=False)
+
+    ready = [sample for sample in samples if sample.startswith(b'{"t": "READY"')]
+    dispatches = [sample for sample in samples if not sample.startswith(b'{"t": "READY"')]
+    messages = session_messages(ready[:1] + dispatches)
+    raw = compressed_sizes(lambda data: data, messages)  # type: ignore
+
+    dictionary = zstd_dictionary()
+    results = {
+        "zlib-stream": compressed_sizes(WsCompressor.create_compressor("zlib-stream"), messages),
+        "zstd-stream": compressed_sizes(ZstdCompressor(), messages),
+        "zstd-stream+dict": compressed_sizes(ZstdCompressor(dictionary), messages),
+    }
+
+    # Make sure that per-message flushed stream is decodable message by message
+    compressor = ZstdCompressor(dictionary)
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+    assert all(decompressor.decompress(compressor(message)) == message for message in messages)
+    zlib_compressor = WsCompressor.create_compressor("zlib-stream")
+    zlib_decompressor = decompressobj()
+    assert all(zlib_decompressor.decompress(zlib_compressor(message)) == message for message in messages)
+
+    print(f"Dictionary: {dictionary.dict_id()} ({len(dictionary.as_bytes())} bytes), messages in session: "
+          f"{len(messages)}")
+    print(f"  {'first N messages':<20}" + "".join(f"{n:>10}" for n in CHECKPOINTS if n <= len(messages)))
+    print(f"  {'raw':<20}" + "".join(f"{raw[n - 1]:>10}" for n in CHECKPOINTS if n <= len(messages)))
+    for name, sizes in results.items():
+        print(f"  {name:<20}" + "".join(f"{sizes[n - 1]:>10}" for n in CHECKPOINTS if n <= len(messages)))
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args, *(20, 200)[len(args):]))
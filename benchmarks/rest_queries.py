@@ -0,0 +1,101 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Per-route query count report of REST api: number of queries and time of one request made by guild member (not owner,
+so permissions are actually checked) to common guild routes.
+
+"before" every dependency loaded its own channel/guild/member (depChannel checked membership with separate query,
+route body loaded member again, PermissionsChecker loaded member roles twice and @everyone role separately,
+send_message serialized message twice), "after" dependencies and routes share entities of RequestCache:
+send message 18 -> 10 queries, get messages 13 -> 10, get message 15 -> 10, edit message 20 -> 15, typing 8 -> 5.
+
+Requests are made with test client of rest api app, so database from config is used (as in tests).
+
+Usage: python -m benchmarks.rest_queries [requests]
+"""
+
+import asyncio
+import sys
+from time import perf_counter
+
+from yepcord.rest_api.main import app
+from yepcord.yepcord.snowflake import Snowflake
+from .utils import count_queries
+
+
+async def register(client, name: str) -> dict:
+    resp = await client.post("/api/v9/auth/register", json={
+        "username": name, "email": f"{name}_{Snowflake.makeId()}@yepcord.test", "password": "test_passw0rd",
+        "date_of_birth": "2000-01-01",
+    })
+    token = (await resp.get_json())["token"]
+    resp = await client.get("/api/v9/users/@me", headers={"Authorization": token})
+    return {"token": token, "id": (await resp.get_json())["id"]}
+
+
+async def run(count: int) -> None:
+    client = app.test_client()
+    owner, member = await register(client, "owner"), await register(client, "member")
+    resp = await client.post("/api/v9/guilds", headers={"Authorization": owner["token"]}, json={"name": "guild"})
+    guild = await resp.get_json()
+    channel_id = [channel for channel in guild["channels"] if channel["type"] == 0][0]["id"]
+    resp = await client.post(f"/api/v9/channels/{channel_id}/invites", headers={"Authorization": owner["token"]},
+                             json={})
+    await client.post(f"/api/v9/invites/{(await resp.get_json())['code']}",
+                      headers={"Authorization": member["token"]})
+    resp = await client.post(f"/api/v9/channels/{channel_id}/messages", headers={"Authorization": member["token"]},
+                             json={"content": "test"})
+    message_id = (await resp.get_json())["id"]
+
+    routes = [
+        ("POST /channels/<id>/messages", "post", f"/channels/{channel_id}/messages", {"content": "test"}),
+        ("GET /channels/<id>/messages", "get", f"/channels/{channel_id}/messages?limit=1", None),
+        ("GET /channels/<id>/messages/<id>", "get", f"/channels/{channel_id}/messages/{message_id}", None),
+        ("PATCH /channels/<id>/messages/<id>", "patch", f"/channels/{channel_id}/messages/{message_id}",
+         {"content": "edited"}),
+        ("POST /channels/<id>/typing", "post", f"/channels/{channel_id}/typing", None),
+        ("GET /channels/<id>", "get", f"/channels/{channel_id}", None),
+        ("GET /guilds/<id>/stickers", "get", f"/guilds/{guild['id']}/stickers", None),
+        ("GET /guilds/<id>/emojis", "get", f"/guilds/{guild['id']}/emojis", None),
+        ("GET /guilds/<id>/members/@me/permissions", "get", f"/guilds/{guild['id']}/members/@me/permissions",
+         None),
+    ]
+
+    print(f"Requests per route: {count}")
+    for name, method, path, json in routes:
+        request = getattr(client, method)
+        with count_queries() as counter:
+            start = perf_counter()
+            for _ in range(count):
+                resp = await request(f"/api/v9{path}", headers={"Authorization": member["token"]}, json=json)
+                assert resp.status_code < 300, (name, resp.status_code, await resp.get_json())
+            elapsed = perf_counter() - start
+        print(f"  {name}: {counter.count / count:.0f} queries, {elapsed / count * 1000:.3f}ms per request")
+
+
+async def main(count: int) -> None:
+    for func in app.before_serving_funcs:
+        await app.ensure_async(func)()
+    try:
+        await run(count)
+    finally:
+        for func in app.after_serving_funcs:
+            await app.ensure_async(func)()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*[int(arg) for arg in sys.argv[1:2]] or [20]))
@@ -0,0 +1,62 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from contextlib import contextmanager, asynccontextmanager
+from typing import Iterator, AsyncIterator
+
+from tortoise import Tortoise, connections
+
+_EXECUTE_METHODS = ("execute_query", "execute_query_dict", "execute_insert", "execute_many")
+
+
+class QueryCounter:
+    __slots__ = ("count",)
+
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def count_queries(connection_name: str = "default") -> Iterator[QueryCounter]:
+    connection = connections.get(connection_name)
+    counter = QueryCounter()
+
+    def _wrap(func):
+        async def _wrapped(*args, **kwargs):
+            counter.count += 1
+            return await func(*args, **kwargs)
+
+        return _wrapped
+
+    for name in _EXECUTE_METHODS:
+        setattr(connection, name, _wrap(getattr(connection, name)))
+    try:
+        yield counter
+    finally:
+        for name in _EXECUTE_METHODS:
+            delattr(connection, name)
+
+
+@asynccontextmanager
+async def memory_db() -> AsyncIterator[None]:
+    await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["yepcord.yepcord.models"]})
+    await Tortoise.generate_schemas()
+    try:
+        yield
+    finally:
+        await Tortoise.close_connections()
@@ -71,6 +71,77 @@ REDIS_URL = ""
 # Default value is 45 seconds, do not set it too big or too small.
 GATEWAY_KEEP_ALIVE_DELAY = 45
 
+# Gateway connections that didn't send heartbeat for GATEWAY_KEEP_ALIVE_DELAY plus this many seconds are closed with
+# 4009 close code (session timed out), their sessions are removed and presence is set to offline.
+GATEWAY_HEARTBEAT_GRACE = 15
+
+# Every gateway process keeps presences of its own users in memory and caches presences of other users (read from
+# redis) for this many seconds. Cached presence is dropped earlier when process receives PRESENCE_UPDATE of that user.
+# Set to 0 to disable caching of other users' presences.
+GATEWAY_PRESENCE_CACHE_TTL = 30
+
+# Maximum number of messages (or bytes) waiting to be sent to a single gateway client. Clients that can't keep up
+# with this limit are disconnected with resumable close code (4000).
+GATEWAY_MAX_QUEUE_MESSAGES = 1000
+GATEWAY_MAX_QUEUE_BYTES = 16 * 1024 * 1024
+
+# If enabled, gateway serves its internal metrics (clients, queues, dropped clients, caches) at /gateway/metrics
+# without authentication. Only enable it if this endpoint is not reachable from outside.
+GATEWAY_METRICS = False
+
+# How long (in seconds) disconnected gateway sessions can be resumed and how much of recently dispatched events
+# (in bytes) is kept per session to replay them on resume.
+GATEWAY_SESSION_TIMEOUT = 120
+GATEWAY_RESUME_BUFFER_SIZE = 512 * 1024
+
+# If enabled, READY event contains only unavailable guild stubs ({"id": ..., "unavailable": true}) and full guilds
+# are sent afterward as separate GUILD_CREATE events. Guilds are loaded in batches of GATEWAY_GUILD_CREATE_BATCH,
+# at most GATEWAY_GUILD_CREATE_CONCURRENCY batches at a time, and next batch is loaded only when previous one was
+# written to the client, so users with many guilds get READY faster and gateway keeps less data in memory.
+GATEWAY_LAZY_GUILDS = False
+GATEWAY_GUILD_CREATE_BATCH = 10
+GATEWAY_GUILD_CREATE_CONCURRENCY = 2
+
+# If enabled, guilds in READY/GUILD_CREATE only contain channels that user has VIEW_CHANNEL permission in.
+GATEWAY_HIDE_INACCESSIBLE_CHANNELS = False
+
+# If enabled, events dispatched by one api request are published when request ends, several events going to the same
+# broker channel are published as one message. Disable it while gateway processes that do not support it are running.
+GATEWAY_BATCH_DISPATCH = True
+
+# Every api process caches permissions of this many most recently used guilds to compute who should receive dispatched
+# events. Changes of roles, overwrites and members are broadcast to other processes through "yepcord_sys_events".
+GATEWAY_PERMISSION_CACHE_SIZE = 1000
+
+# Gateway sharding. Users are assigned to one of "count" shards by their id, and every shard has its own broker
+# channel, so gateway process only receives events of users from shards listed in "shards" (empty list means all
+# shards). Every gateway process must use the same "count" and every shard must be handled by exactly one process.
+# Users identifying on process that doesn't handle their shard are disconnected with 4010 close code, so connections
+# must be routed (e.g. by sharding-aware proxy) to the process that handles user's shard.
+# Example for two processes: {"count": 4, "shards": [0, 1]} and {"count": 4, "shards": [2, 3]}.
+GATEWAY_SHARDING = {
+    "count": 1,
+    "shards": [],
+}
+
+# How gateway processes subscribe to dispatched events. Can be "shards" (see GATEWAY_SHARDING above) or "interest".
+# With "interest", every gateway process subscribes to channels of guilds and users only while it holds at least one
+# session of that user (or guild member), so users may connect to any process. GATEWAY_SHARDING is ignored in this
+# mode. Every process (gateway and api) must use the same value.
+GATEWAY_SUBSCRIPTIONS = "shards"
+
+# Settings of "zstd-stream" gateway compression. window_log is log2 of compression window size (0 means default
+# for selected level), lower values use less memory per connection. Clients that pass "zstd_dictionary=<id>"
+# (id is returned by /api/v9/gateway) get messages compressed with pre-trained dictionary, which greatly improves
+# compression of first messages of session. Dictionary shipped with yepcord is used if dictionary_path is not set,
+# custom one can be trained with "python app.py train-zstd-dictionary".
+GATEWAY_ZSTD = {
+    "level": 3,
+    "window_log": 0,
+    "use_dictionary": True,
+    "dictionary_path": None,
+}
+
 BCRYPT_ROUNDS = 15
 
 # Captcha settings, acquire your hcaptcha/recaptcha sitekey and secret and paste it here. You can disable captcha
@@ -0,0 +1,1766 @@
+import asyncio
+import logging
+from json import loads, dumps
+from time import time
+from zlib import decompressobj
+
+import pytest as pt
+import zstandard
+import pytest_asyncio
+from quart.testing.connections import WebsocketDisconnectError
+from redis.exceptions import ResponseError
+from tortoise import connections
+
+from yepcord.gateway.compression import WsCompressor, zstd_dictionary
+from yepcord.gateway.encoding import ETF
+from yepcord.gateway.events import EncodedDispatchEvent, RawDispatchEvent
+from yepcord.gateway.gateway import GatewayClient, Gateway, WsStore, GatewayEvents
+from yepcord.gateway import member_list
+from yepcord.gateway.member_list import GuildMembers, MemberEntry, MemberLists
+from yepcord.gateway.main import app as gw_app, gw as main_gw
+from yepcord.gateway.presences import Presence
+from yepcord.gateway.ready import ReadyLoader
+from yepcord.gateway.utils import ReplayBuffer, TimerWheel
+from yepcord.gateway.zstd_training import scrub
+from yepcord.rest_api.main import app
+from yepcord.yepcord.config import Config
+from yepcord.yepcord.enums import GatewayOp, GuildPermissions
+from yepcord.yepcord.gateway_dispatcher import GatewayDispatcher, GUILD_CACHE_EVENTS
+from yepcord.yepcord.mq_broker import DynamicSubscriptions
+from yepcord.yepcord.models import User, Channel
+from yepcord.yepcord.permissions import PermissionEngine, PermissionCache, ALL_PERMISSIONS
+from yepcord.yepcord.utils.fakeredis import FakeRedis
+from yepcord.yepcord.sharding import split_message, user_shard, events_channel, route_message
+from .utils import TestClientType, create_users, gateway_cm, create_guild, create_role, create_dm_channel, \
+    rel_request, rel_delete, create_guild_channel, create_emoji, create_sticker, create_event, create_message, \
+    create_thread, add_user_to_guild
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def setup_db():
+    for func in app.before_serving_funcs:
+        await app.ensure_async(func)()
+    yield
+    for func in app.after_serving_funcs:
+        await app.ensure_async(func)()
+
+
+class FakeWs:
+    def __init__(self, compress: str = None):
+        self.compressor = WsCompressor.create_compressor(compress)
+        self.sent = []
+        self.closed = None
+        self.blocked = asyncio.Event()
+        self.blocked.set()
+
+    async def send(self, data) -> None:
+        await self.blocked.wait()
+        self.sent.append(data)
+
+    async def send_json(self, data: dict) -> None:
+        self.sent.append(data)
+
+    async def close(self, code: int) -> None:
+        self.closed = code
+
+
+def make_client(gw: Gateway, user_id: int, compress: str = None) -> GatewayClient:
+    client = GatewayClient(FakeWs(compress), gw)
+    client.id = client.user_id = user_id
+    gw.store.by_user_id.setdefault(user_id, set()).add(client)
+    gw.store.by_sess_id[client.sid] = client
+    return client
+
+
+async def flush(*clients: GatewayClient) -> None:
+    while any(client.queue_size for client in clients):
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+def test_encoded_dispatch_event():
+    data = {"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"a": [1, "2"], "s": 5}, "s": 10}
+    event = EncodedDispatchEvent(data)
+    assert event.name == "TEST"
+    assert loads(event.encode(1)) == {"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"a": [1, "2"], "s": 5}, "s": 1}
+    assert loads(event.encode(42))["s"] == 42
+    assert loads(EncodedDispatchEvent({}).encode(3)) == {"s": 3}
+    assert ETF.decode(event.encode(7, ETF)) == {"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"a": [1, "2"], "s": 5},
+                                                "s": 7}
+
+
+def test_etf_encoding():
+    assert ETF.encode({"a": "b"}) == b"\x83t\x00\x00\x00\x01w\x01am\x00\x00\x00\x01b"
+
+    data = {
+        "id": "1234567890123456789", "guild_id": "5", "roles": ["1", "2"], "name": "123", "nick": None, "bot": True,
+        "flags": -1, "big": 1 << 70, "ratio": 0.5, "nested": [[1], {"a": False}], "empty": [],
+    }
+    assert ETF.decode(ETF.encode(data)) == data | {"id": 1234567890123456789, "guild_id": 5, "roles": [1, 2]}
+
+    # Only known snowflake fields are converted to integers
+    data = {"custom_id": "123", "session_id": "456", "nonce": "789", "list_id": "10", "component_ids": ["1"],
+            "user_ids": ["11"], "message_id": "12"}
+    assert ETF.decode(ETF.encode(data)) == data | {"user_ids": [11], "message_id": 12}
+
+    # Atoms, tuples, strings and old floats sent by erlang clients
+    assert ETF.decode(b"\x83d\x00\x03nil") is None
+    assert ETF.decode(b"\x83h\x02a\x01s\x01a") == [1, "a"]
+    assert ETF.decode(b"\x83k\x00\x03abc") == "abc"
+    assert ETF.decode(b"\x83c" + b"1.50000000000000000000e+00".ljust(31, b"\x00")) == 1.5
+    assert ETF.decode(b"\x83o\x00\x00\x00\x01\x01\x05") == -5
+
+    unhashable_key = b"\x83t\x00\x00\x00\x01j\x6a"
+    too_deep = b"\x83" + b"l\x00\x00\x00\x01" * 100000 + b"j" * 100001
+    for invalid in (b"", b"\x82a\x01", b"\x83t\x00\x00\x00\x01", b"\x83a\x01\x00", b"\x83z", unhashable_key,
+                    too_deep):
+        with pt.raises(ValueError):
+            ETF.decode(invalid)
+
+
+@pt.mark.asyncio
+async def test_gateway_fanout():
+    gw = Gateway()
+    plain = make_client(gw, 1)
+    plain.seq = 5
+    compressed = make_client(gw, 2, "zlib-stream")
+    bot = make_client(gw, 3)
+    bot.is_bot = True
+
+    for event_name in ("TEST", "MESSAGE_ACK"):
+        await gw.mcl_yepcordEventsCallback({
+            "data": {"t": event_name, "op": GatewayOp.DISPATCH, "d": {"id": "123"}},
+            "user_ids": [1, 2, 3],
+            "guild_id": None,
+            "role_ids": None,
+            "session_id": None,
+        })
+
+    await flush(plain, compressed, bot)
+    assert [loads(msg) for msg in plain.ws.sent] == [
+        {"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"id": "123"}, "s": 6},
+        {"t": "MESSAGE_ACK", "op": GatewayOp.DISPATCH, "d": {"id": "123"}, "s": 7},
+    ]
+
+    decompressor = decompressobj()
+    assert [loads(decompressor.decompress(msg)) for msg in compressed.ws.sent] == [
+        {"t": "TEST", "op": GatewayOp.DISPATCH, "d": {"id": "123"}, "s": 1},
+        {"t": "MESSAGE_ACK", "op": GatewayOp.DISPATCH, "d": {"id": "123"}, "s": 2},
+    ]
+
+    assert [loads(msg)["t"] for msg in bot.ws.sent] == ["TEST"]
+
+    for client in (plain, compressed, bot):
+        client.disconnect()
+
+
+@pt.mark.asyncio
+async def test_gateway_slow_consumer(monkeypatch):
+    monkeypatch.setattr(Config, "GATEWAY_MAX_QUEUE_MESSAGES", 3)
+    gw = Gateway()
+    fast = make_client(gw, 1)
+    slow = make_client(gw, 2)
+    slow.ws.blocked.clear()
+    slow_ws = slow.ws
+
+    event = {"data": {"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}, "user_ids": [1, 2], "guild_id": None,
+             "role_ids": None, "session_id": None}
+    for _ in range(3):
+        await gw.mcl_yepcordEventsCallback(event)
+    await flush(fast)
+
+    metrics = gw.metrics()
+    assert metrics["clients"] == 2
+    assert metrics["outbound_queue"]["messages"] == 2
+    assert metrics["outbound_queue"]["max_messages"] == 2
+    assert metrics["outbound_queue"]["bytes"] > 0
+    assert metrics["dropped_slow_clients"] == 0
+
+    await gw.mcl_yepcordEventsCallback(event)
+    await gw.mcl_yepcordEventsCallback(event)
+    await flush(fast)
+
+    assert not slow.connected
+    assert slow_ws.closed == 4000
+    assert slow.queue_size == 0
+    assert len(fast.ws.sent) == 5
+    assert gw.metrics()["dropped_slow_clients"] == 1
+
+    fast.disconnect()
+
+
+@pt.mark.asyncio
+async def test_gateway_close_after_queued_messages():
+    gw = Gateway()
+    client = make_client(gw, 1)
+    await client.send({"op": GatewayOp.INV_SESSION})
+    client.close(4009)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert [loads(msg)["op"] for msg in client.ws.sent] == [GatewayOp.INV_SESSION]
+    assert client.ws.closed == 4009
+    client.disconnect()
+
+
+def test_replay_buffer():
+    buffer = ReplayBuffer(10)
+    buffer.append(1, "aaaa")
+    buffer.append(3, "bbbb")
+    assert buffer.size == 8
+    assert buffer.can_replay(0, 3)
+    assert not buffer.can_replay(4, 3)
+    assert list(buffer.since(1)) == ["bbbb"]
+
+    buffer.append(4, "cccc")
+    assert buffer.size == 8
+    assert not buffer.can_replay(0, 4)
+    assert buffer.can_replay(1, 4)
+    assert list(buffer.since(1)) == ["bbbb", "cccc"]
+
+    buffer.append(5, "d" * 11)
+    assert buffer.size == 0
+    assert not buffer.can_replay(4, 5)
+    assert buffer.can_replay(5, 5)
+
+    # Size is counted in bytes of utf8 encoded payloads
+    buffer.append(6, "ééé")
+    buffer.append(7, b"ee")
+    assert buffer.size == 8
+    assert buffer.size_since(6) == 2
+    buffer.append(8, "éé")
+    assert buffer.size == 6
+    assert list(buffer.since(0)) == [b"ee", "éé"]
+
+
+@pt.mark.asyncio
+async def test_timer_wheel():
+    expired = []
+    wheel = TimerWheel(3, expired.append)
+    wheel.touch("a")
+    wheel.advance()
+    wheel.touch("b")
+    assert len(wheel) == 2
+
+    wheel.advance()
+    wheel.advance()
+    assert expired == []
+    wheel.advance()
+    assert expired == ["a"]
+    assert "a" not in wheel
+
+    wheel.touch("b")
+    wheel.advance()
+    wheel.discard("b")
+    for _ in range(10):
+        wheel.advance()
+    assert expired == ["a"]
+    assert len(wheel) == 0
+    wheel.close()
+
+
+async def connect(gw: Gateway) -> GatewayClient:
+    ws = FakeWs()
+    await gw.add_client(ws)
+    return getattr(ws, "_yepcord_client")
+
+
+@pt.mark.asyncio
+async def test_gateway_resume():
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    user_id = int(user["id"])
+    event = {"data": {"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}, "user_ids": [user_id], "guild_id": None,
+             "role_ids": None, "session_id": None}
+
+    async with gateway_cm(gw_app):
+        cl = await connect(main_gw)
+        old_ws = cl.ws
+        await main_gw.process(old_ws, {"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}})
+        await flush(cl)
+        assert [loads(msg).get("t") for msg in old_ws.sent] == [None, "READY", "READY_SUPPLEMENTAL"]
+        last_seq = loads(old_ws.sent[-1])["s"]
+
+        await main_gw.disconnect(old_ws)
+        assert not cl.connected
+        await main_gw.mcl_yepcordEventsCallback(event)
+        await main_gw.mcl_yepcordEventsCallback(event)
+        assert main_gw.metrics()["resumable_sessions"] == 1
+
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": last_seq,
+        }})
+        await flush(cl)
+        assert cl.connected
+        assert [(msg["t"], msg["s"]) for msg in map(loads, cl.ws.sent[1:])] == [
+            ("TEST", last_seq + 1), ("TEST", last_seq + 2), ("RESUMED", last_seq + 3)
+        ]
+        assert [loads(msg)["t"] for msg in cl._replay.since(last_seq)] == ["TEST", "TEST"]
+
+        # Session is already connected
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": cl.seq,
+        }})
+        await flush(new)
+        assert [loads(msg)["op"] for msg in new.ws.sent[1:]] == [GatewayOp.INV_SESSION, GatewayOp.RECONNECT]
+        assert new.ws.closed == 4009
+        new.disconnect()
+
+        # Sequence number is not known to the server
+        await main_gw.disconnect(cl.ws)
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": cl.seq + 10,
+        }})
+        await flush(new)
+        assert [loads(msg) for msg in new.ws.sent[1:]] == [{"op": GatewayOp.INV_SESSION, "d": False, "s": 2}]
+        assert not cl.connected
+        new.disconnect()
+
+        # Session is expired
+        main_gw.expire_session(cl)
+        assert main_gw.metrics()["resumable_sessions"] == 0
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": cl.seq,
+        }})
+        await flush(new)
+        assert [loads(msg)["op"] for msg in new.ws.sent[1:]] == [GatewayOp.INV_SESSION, GatewayOp.RECONNECT]
+        new.disconnect()
+
+
+@pt.mark.asyncio
+async def test_gateway_resume_replay_over_queue_limit(monkeypatch):
+    monkeypatch.setattr(Config, "GATEWAY_MAX_QUEUE_MESSAGES", 5)
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    event = {"data": {"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}, "user_ids": [int(user["id"])],
+             "guild_id": None, "role_ids": None, "session_id": None}
+
+    async with gateway_cm(gw_app):
+        cl = await connect(main_gw)
+        await main_gw.process(cl.ws, {"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}})
+        await flush(cl)
+        last_seq = cl.seq
+        await main_gw.disconnect(cl.ws)
+
+        # Replay fits into replay buffer, but not into send queue: resuming would get client dropped again
+        for _ in range(5):
+            await main_gw.mcl_yepcordEventsCallback(event)
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": last_seq,
+        }})
+        await flush(new)
+        assert [loads(msg) for msg in new.ws.sent[1:]] == [{"op": GatewayOp.INV_SESSION, "d": False, "s": 2}]
+        assert new.ws.closed is None
+        assert not cl.connected
+        new.disconnect()
+
+        # Shorter replay still can be resumed
+        new = await connect(main_gw)
+        await main_gw.process(new.ws, {"op": GatewayOp.RESUME, "d": {
+            "token": user["token"], "session_id": cl.sid, "seq": last_seq + 2,
+        }})
+        await flush(cl)
+        assert cl.connected
+        assert [loads(msg)["t"] for msg in cl.ws.sent[1:]] == ["TEST", "TEST", "TEST", "RESUMED"]
+        assert cl.ws.closed is None
+        main_gw.expire_session(cl)
+
+
+@pt.mark.asyncio
+async def test_gateway_heartbeat_reaper():
+    client: TestClientType = app.test_client()
+    user, other = await create_users(client, 2)
+    user_id = int(user["id"])
+
+    async with gateway_cm(gw_app):
+        cl = await connect(main_gw)
+        await flush(cl)
+        assert loads(cl.ws.sent[0])["d"]["heartbeat_interval"] == Config.GATEWAY_KEEP_ALIVE_DELAY * 1000
+        assert cl in main_gw.heartbeats
+        await main_gw.process(cl.ws, {"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}})
+        await main_gw.process(cl.ws, {"op": GatewayOp.HEARTBEAT, "d": None})
+        assert await main_gw.presences.get(user_id) is not None
+        assert cl in main_gw.heartbeats
+
+        ws = cl.ws
+        reaped = main_gw.metrics()["reaped_clients"]
+        main_gw.reap(cl)
+        await asyncio.sleep(0)
+        assert ws.closed == 4009
+        assert cl not in main_gw.heartbeats
+        assert not main_gw.store.get(user_id=user_id)
+        assert not main_gw.store.get(session_id=cl.sid)
+        assert main_gw.metrics()["reaped_clients"] == reaped + 1
+
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert await main_gw.presences.get(user_id) is None
+
+        # Disconnected sessions are handled by session timeout and are not reaped
+        cl = await connect(main_gw)
+        await main_gw.disconnect(cl.ws)
+        assert cl not in main_gw.heartbeats
+        main_gw.reap(cl)
+        assert main_gw.metrics()["reaped_clients"] == reaped + 1
+
+
+@pt.mark.asyncio
+async def test_presences_get_many():
+    async with gateway_cm(gw_app):
+        presences = main_gw.presences
+        await presences.set_or_refresh(1, Presence(1, "online"))
+        await presences.set_or_refresh(3, Presence(3, "dnd", activities=[{"name": "test", "type": 0}]))
+
+        result = await presences.get_many([1, 2, 3])
+        assert set(result) == {1, 3}
+        assert result[1].status == "online"
+        assert result[3].status == "dnd"
+        assert result[3].activities == [{"name": "test", "type": 0}]
+        assert await presences.get_many([]) == {}
+        assert (await presences.get(1)).status == "online"
+        assert (await presences.get(1)).status == "online"
+
+        await presences.remove(1)
+        await presences.remove(3)
+        assert await presences.get_many([1, 3]) == {}
+
+
+@pt.mark.asyncio
+async def test_presences_cache():
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    presences = gw.presences
+    local = make_client(gw, 1)
+    await presences.set_or_refresh(1, Presence(1, "online"))
+    await gw.redis.set("presence_2", dumps({"status": "idle", "activities": []}))
+
+    assert (await presences.get_many([1, 2, 3])).keys() == {1, 2}
+    assert presences.metrics() | {"write_pipelines": 0} == {
+        "local": 1, "remote": 2, "hits": 1, "misses": 2, "pending_writes": 0, "write_pipelines": 0,
+    }
+
+    # Remote presences (including offline ones) are served from cache until invalidated
+    await gw.redis.set("presence_2", dumps({"status": "dnd", "activities": []}))
+    await gw.redis.set("presence_3", dumps({"status": "online", "activities": []}))
+    assert (await presences.get(2)).status == "idle"
+    assert await presences.get(3) is None
+    await gw.mcl_yepcordEventsCallback({
+        "data": {"t": "PRESENCE_UPDATE", "op": GatewayOp.DISPATCH, "d": {"user": {"id": "2"}, "status": "dnd"}},
+        "user_ids": [], "guild_id": None, "role_ids": None, "session_id": None,
+    })
+    assert (await presences.get(2)).status == "dnd"
+
+    # Presence changes of users without related users on this process are only received as system event
+    assert await presences.get(3) is None
+    await gw.mcl_yepcordSysEventsCallback({"event": "presence", "user_id": 3, "status": "online", "activities": []})
+    assert (await presences.get(3)).status == "online"
+
+    # Presences of local users are not read from redis
+    await gw.redis.delete("presence_1")
+    assert (await presences.get(1)).status == "online"
+    local.disconnect()
+    assert await presences.get(1) is None
+    gw.expire_session(local)
+    assert presences.metrics()["local"] == 0
+
+    with pt.MonkeyPatch.context() as mp:
+        mp.setattr(Config, "GATEWAY_PRESENCE_CACHE_TTL", 0)
+        await gw.redis.set("presence_4", dumps({"status": "online", "activities": []}))
+        assert (await presences.get(4)).status == "online"
+        await gw.redis.delete("presence_4")
+        assert await presences.get(4) is None
+
+
+@pt.mark.asyncio
+async def test_fake_redis():
+    redis = FakeRedis(resolution=0.01, slots=4)
+
+    assert await redis.set("a", "1", ex=0.02) is True
+    assert await redis.set("a", "2", ex=0.02, nx=True) is None
+    assert await redis.set("b", "1") is True
+    assert await redis.set("c", "1", ex=1) is True
+    assert await redis.ttl("b") == -1
+    assert await redis.ttl("d") == -2
+    assert await redis.expire("d", 1) is False
+
+    pipe = redis.pipeline()
+    await pipe.set("b", "2", ex=0.03, nx=True)
+    await pipe.expire("b", 0.03)
+    assert await pipe.execute() == [None, True]
+    assert await redis.mget(["a", "b", "d"]) == ["1", "1", None]
+
+    # Keys are expired by timer wheel (even with deadline further than one wheel rotation) ...
+    await asyncio.sleep(0.1)
+    assert len(redis) == 1
+    assert redis.expired == 2
+    # ... and are never returned after deadline, even before wheel reaches them
+    await redis.set("c", "2", ex=0.001)
+    await asyncio.sleep(0.002)
+    assert await redis.get("c") is None
+    assert len(redis) == 0
+
+    # Set without ex removes ttl
+    await redis.set("a", "1", ex=0.01)
+    await redis.set("a", "2")
+    await asyncio.sleep(0.05)
+    assert await redis.get("a") == "2"
+    assert await redis.delete("a", "b") == 1
+
+    assert await redis.sadd("s", "1", "2") == 2
+    assert await redis.sismember("s", "1")
+    assert await redis.srem("s", "1", "2", "3") == 2
+    assert not await redis.sismember("s", "1")
+    await redis.set("a", "1")
+    with pt.raises(ResponseError):
+        await redis.sadd("a", "1")
+
+    await redis.close()
+
+
+@pt.mark.asyncio
+async def test_presence_writes_batching():
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    presences = gw.presences
+
+    for user_id in (1, 2, 3):
+        presences.refresh(user_id, Presence(user_id, "online"))
+    presences.refresh(1, Presence(1, "idle"))
+    assert presences.metrics()["pending_writes"] == 3
+    await presences.flush()
+    assert presences.metrics()["pending_writes"] == 0
+    assert presences.metrics()["write_pipelines"] == 1
+    assert loads(await gw.redis.get("presence_1"))["status"] == "online"  # Refresh does not overwrite
+
+    await asyncio.gather(*(presences.set_or_refresh(user_id, Presence(user_id, "dnd"), True) for user_id in (1, 4)))
+    assert presences.metrics()["write_pipelines"] == 2
+    assert loads(await gw.redis.get("presence_1"))["status"] == "dnd"
+    assert loads(await gw.redis.get("presence_4"))["status"] == "dnd"
+
+
+@pt.mark.asyncio
+async def test_presence_update_debounce(monkeypatch):
+    monkeypatch.setattr(GatewayEvents, "PRESENCE_DEBOUNCE", 0.5)
+    client: TestClientType = app.test_client()
+    user, friend = await create_users(client, 2)
+    await create_dm_channel(client, user, friend)
+    user_id = int(user["id"])
+
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    listener = make_client(gw, int(friend["id"]))
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:  # Presence updates are delivered through the broker
+        published.append(channel)
+        if channel == "yepcord_sys_events":
+            return await gw.mcl_yepcordSysEventsCallback(message)
+        await gw.mcl_yepcordEventsCallback(message)
+
+    monkeypatch.setattr(gw.broker, "publish", publish)
+
+    for status in ("online", "idle", "dnd"):
+        await gw.ev.presence_update(user_id, Presence(user_id, status))
+    await flush(listener)
+    assert [loads(msg)["d"]["status"] for msg in listener.ws.sent] == ["online"]
+    assert published == ["yepcord_sys_events", "yepcord_events"]
+
+    await asyncio.sleep(0.6)
+    await flush(listener)
+    assert [loads(msg)["d"]["status"] for msg in listener.ws.sent] == ["online", "dnd"]
+
+    await asyncio.sleep(0.6)
+    listener.disconnect()
+
+
+@pt.mark.asyncio
+async def test_related_users(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, dm_user, friend = await create_users(client, 3)
+    user_id, dm_user_id, friend_id = int(user["id"]), int(dm_user["id"]), int(friend["id"])
+    await create_dm_channel(client, user, dm_user)
+
+    sys_events = []
+
+    async def _dispatch_sys(event: str, data: dict) -> None:
+        sys_events.append(data | {"event": event})
+
+    monkeypatch.setattr(GatewayDispatcher.getInstance(), "dispatchSys", _dispatch_sys)
+
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    related = gw.related_users
+    listener = make_client(gw, user_id)
+    assert await related.get(user_id) == {dm_user_id}
+    assert await related.get(user_id) == {dm_user_id}
+    assert related.loads == 1
+
+    assert await rel_request(client, user, friend) == 204
+    assert sys_events == [{"event": "related", "user_ids": [user_id], "other_ids": [friend_id], "removed": False}]
+    await gw.mcl_yepcordSysEventsCallback(sys_events.pop())
+    assert await related.get(user_id) == {dm_user_id, friend_id}
+    await gw.ev.presence_update(user_id, Presence(user_id, "online"))
+    assert related.loads == 1
+
+    assert await rel_delete(client, user, friend) == 204
+    assert sys_events == [{"event": "related", "user_ids": [friend_id], "other_ids": [user_id], "removed": True}]
+    await gw.mcl_yepcordSysEventsCallback(sys_events.pop())
+    assert await related.get(user_id) == {dm_user_id}
+    assert related.loads == 2
+
+    listener.disconnect()
+    gw.expire_session(listener)
+    assert user_id not in related
+
+
+@pt.mark.asyncio
+async def test_gateway_guilds_roles_subscription():
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild1 = await create_guild(client, user, "Test")
+    guild2 = await create_guild(client, user, "Test 2")
+    role = await create_role(client, user, guild1["id"])
+    resp = await client.patch(f"/api/v9/guilds/{guild1['id']}/roles/{role['id']}/members",
+                              headers={"Authorization": user["token"]}, json={"member_ids": [user["id"]]})
+    assert resp.status_code == 200
+
+    guild1_id, guild2_id, role_id = int(guild1["id"]), int(guild2["id"]), int(role["id"])
+    guilds_roles = await Gateway.get_guilds_roles(int(user["id"]))
+    assert guilds_roles == {guild1_id: [role_id], guild2_id: []}
+
+    gw = Gateway()
+    cl = make_client(gw, int(user["id"]))
+    gw.store.add(cl, guilds_roles)
+    assert gw.store.get(guild_id=guild1_id) == {cl}
+    assert gw.store.get(guild_id=guild2_id) == {cl}
+    assert gw.store.get(role_id=guild1_id) == {cl}
+    assert gw.store.get(role_id=role_id) == {cl}
+
+    gw.store.remove(cl)
+    assert not gw.store.get(guild_id=guild1_id)
+    assert not gw.store.get(role_id=role_id)
+    assert not gw.store.get(user_id=cl.user_id)
+    assert not gw.store.get(session_id=cl.sid)
+    cl.disconnect()
+
+
+@pt.mark.asyncio
+async def test_ws_store_routing():
+    gw = Gateway()
+    store: WsStore = gw.store
+    cl1, cl2, cl3 = make_client(gw, 1), make_client(gw, 2), make_client(gw, 3)
+    cl1_2 = make_client(gw, 1)
+    store.add(cl1, {100: [101, 102], 200: []})
+    store.add(cl1_2, {100: [101, 102], 200: []})
+    store.add(cl2, {100: [102]})
+    store.add(cl3, {200: [201]})
+
+    assert store.get(guild_id=100) == {cl1, cl1_2, cl2}
+    assert set(store.get_by_roles([101])) == {cl1, cl1_2}
+    assert set(store.get_by_roles([102, 201])) == {cl1, cl1_2, cl2, cl3}
+    assert set(store.get_by_roles([200])) == {cl1, cl1_2, cl3}
+    assert set(store.get_by_roles([999])) == set()
+
+    # Role is added to user through sys event
+    await gw.mcl_yepcordSysEventsCallback({"event": "sub", "user_ids": [2, 4], "guild_id": 100, "role_id": 103})
+    assert set(store.get_by_roles([103])) == {cl2}
+    assert 4 not in store.guilds[100].members
+
+    # Role is removed from user
+    await gw.mcl_yepcordSysEventsCallback({"event": "unsub", "user_ids": [1], "guild_id": 100, "role_id": 101,
+                                           "delete": False})
+    assert set(store.get_by_roles([101])) == set()
+
+    # Role is deleted, its bit is reused by next role
+    bit = store.guilds[100].role_bits[102]
+    store.unsubscribe(100, 102, delete=True)
+    assert set(store.get_by_roles([102])) == set()
+    store.subscribe(100, 104, 3)
+    assert store.guilds[100].role_bits[104] == bit
+    assert set(store.get_by_roles([104])) == {cl3}
+    assert store.get(guild_id=100) == {cl1, cl1_2, cl2, cl3}
+
+    # Member leaves guild
+    store.unsubscribe(100, None, 2)
+    assert store.get(guild_id=100) == {cl1, cl1_2, cl3}
+    assert 100 not in store.user_guilds[2]
+
+    # Last client of user disconnects
+    store.remove(cl1)
+    assert store.get(guild_id=200) == {cl1_2, cl3}
+    store.remove(cl1_2)
+    assert store.get(guild_id=200) == {cl3}
+    assert 1 not in store.user_guilds
+
+    # Guild is deleted
+    store.unsubscribe(100, None, delete=True)
+    assert 100 not in store.guilds
+    assert 103 not in store.role_guild
+    assert store.get(guild_id=100) == set()
+    assert store.user_guilds[3] == {200}
+
+    for client in (cl1, cl1_2, cl2, cl3):
+        client.disconnect()
+
+
+def test_split_message(monkeypatch):
+    message = {"data": {}, "event": "TEST", "user_ids": [1 << 22], "guild_id": None, "role_ids": None,
+               "session_id": None, "exclude": []}
+    assert list(split_message(message)) == [(0, message)]
+    assert events_channel(0) == "yepcord_events"
+
+    monkeypatch.setattr(Config, "GATEWAY_SHARDING", {"count": 3, "shards": []})
+    users = [shard << 22 for shard in range(3)] + [4 << 22]
+    assert [user_shard(user_id) for user_id in users] == [0, 1, 2, 1]
+    assert events_channel(2) == "yepcord_events.2"
+
+    message = message | {"user_ids": users[1:]}
+    assert [(shard, msg["user_ids"]) for shard, msg in split_message(message)] == [(1, users[1::2]), (2, users[2:3])]
+
+    message = message | {"user_ids": None, "guild_id": 1, "exclude": users[1:3]}
+    assert [(shard, msg["user_ids"], msg["exclude"]) for shard, msg in split_message(message)] == [
+        (0, None, []), (1, None, users[1:2]), (2, None, users[2:3]),
+    ]
+
+    # Guild messages only go to shards of guild members (and of targeted users), session messages go everywhere
+    assert [shard for shard, _ in split_message(message, {1})] == [1]
+    assert [shard for shard, _ in split_message(message | {"user_ids": users[2:3]}, {1})] == [1, 2]
+    assert [shard for shard, _ in split_message(message | {"guild_id": None, "session_id": "1"}, {1})] == [0, 1, 2]
+
+
+@pt.mark.asyncio
+async def test_gateway_sharding(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    user_id = int(user["id"])
+    shard = (user_id >> 22) % 2
+    monkeypatch.setattr(Config, "GATEWAY_SHARDING", {"count": 2, "shards": [shard]})
+    local_channel = events_channel(shard)
+    remote_channel = events_channel(1 - shard)
+
+    gw = Gateway()
+    assert gw.metrics()["shards"] == [shard]
+    assert local_channel in gw.broker._handlers
+    assert remote_channel not in gw.broker._handlers
+
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.append((channel, message["user_ids"]))
+
+    dispatcher = GatewayDispatcher.getInstance()
+    monkeypatch.setattr(dispatcher.broker, "publish", publish)
+    other_user_id = user_id + (1 << 22)
+    await dispatcher.dispatch(RawDispatchEvent({"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}),
+                              user_ids=[user_id, other_user_id])
+    assert sorted(published) == sorted([(local_channel, [user_id]), (remote_channel, [other_user_id])])
+
+    # Guild has members only on shard of user
+    guild = await create_guild(client, user, "Test")
+    published.clear()
+    await dispatcher.dispatch(RawDispatchEvent({"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}),
+                              guild_id=int(guild["id"]))
+    assert published == [(local_channel, None)]
+
+    async with gateway_cm(gw_app):
+        monkeypatch.setattr(main_gw, "shards", {1 - shard})
+        cl = await connect(main_gw)
+        await main_gw.process(cl.ws, {"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}})
+        await flush(cl)
+        assert cl.ws.closed == 4010
+        assert cl.user_id is None
+        cl.disconnect()
+
+
+def test_route_message_interest(monkeypatch):
+    monkeypatch.setattr(Config, "GATEWAY_SUBSCRIPTIONS", "interest")
+    message = {"data": {}, "event": "TEST", "user_ids": [1, 2], "guild_id": None, "role_ids": None,
+               "session_id": None, "exclude": []}
+
+    assert [(channel, msg["user_ids"]) for channel, msg in route_message(message)] == [
+        ("yepcord_events.user.1", [1]), ("yepcord_events.user.2", [2]),
+    ]
+    assert [channel for channel, _ in route_message(message | {"role_ids": [3]}, 4)] == ["yepcord_events.guild.4"]
+    assert [channel for channel, _ in route_message(message | {"role_ids": [3]})] == ["yepcord_events"]
+    assert [channel for channel, _ in route_message(message | {"session_id": "1"})] == ["yepcord_events"]
+    assert [(channel, msg["user_ids"]) for channel, msg in route_message(message | {"guild_changed": 4})] == [
+        ("yepcord_events.user.1", [1]), ("yepcord_events.user.2", [2]), ("yepcord_events.guild.4", None),
+    ]
+
+
+@pt.mark.asyncio
+async def test_gateway_interest_subscriptions(monkeypatch):
+    monkeypatch.setattr(Config, "GATEWAY_SUBSCRIPTIONS", "interest")
+    gw = Gateway()
+    assert gw.local_channels == {"yepcord_events"}
+
+    cl1 = GatewayClient(FakeWs(), gw)
+    cl2 = GatewayClient(FakeWs(), gw)
+    cl1.id = cl1.user_id = 1
+    cl2.id = cl2.user_id = 2
+    gw.store.add(cl1, {100: [101]})
+    gw.store.add(cl2, {100: [], 200: []})
+    await gw.subscriptions.wait()
+    channels = {"yepcord_events.user.1", "yepcord_events.user.2", "yepcord_events.guild.100",
+                "yepcord_events.guild.200"}
+    assert gw.subscriptions.channels == channels
+    assert channels.issubset(gw.broker._handlers)
+    assert gw.metrics()["subscriptions"] == 5
+
+    await gw.broker._handlers["yepcord_events.guild.100"].copy().pop()({
+        "data": {"t": "TEST", "op": GatewayOp.DISPATCH, "d": None}, "user_ids": None, "guild_id": 100,
+        "role_ids": None, "session_id": None,
+    })
+    await flush(cl1, cl2)
+    assert len(cl1.ws.sent) == len(cl2.ws.sent) == 1
+
+    # Last member of guild 200 and last session of user 2 disconnect
+    gw.store.remove(cl2)
+    await gw.subscriptions.wait()
+    assert gw.subscriptions.channels == {"yepcord_events.user.1", "yepcord_events.guild.100"}
+    assert "yepcord_events.guild.200" not in gw.broker._handlers
+
+    # Subscribe and unsubscribe before changes are applied
+    gw.store.subscribe(300, None, 1)
+    gw.store.unsubscribe(300, None, delete=True)
+    gw.store.remove(cl1)
+    await gw.subscriptions.wait()
+    assert gw.subscriptions.channels == set()
+
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.append((channel, message["user_ids"]))
+
+    dispatcher = GatewayDispatcher.getInstance()
+    monkeypatch.setattr(dispatcher.broker, "publish", publish)
+    event = RawDispatchEvent({"t": "TEST", "op": GatewayOp.DISPATCH, "d": None})
+    await dispatcher.dispatch(event, user_ids=[1, 2])
+    await dispatcher.dispatch(event, guild_id=100, permissions=None)
+    assert published == [
+        ("yepcord_events.user.1", [1]), ("yepcord_events.user.2", [2]), ("yepcord_events.guild.100", None),
+    ]
+
+    # "sub" system event is handled only after subscriber of new guild is started
+    subscribe = DynamicSubscriptions._subscribe
+
+    async def slow_subscribe(self, channel: str):
+        await asyncio.sleep(.1)
+        return await subscribe(self, channel)
+
+    monkeypatch.setattr(DynamicSubscriptions, "_subscribe", slow_subscribe)
+    gw.store.add(cl1, {})
+    await gw.mcl_yepcordSysEventsCallback({"event": "sub", "user_ids": [1], "guild_id": 400, "role_id": None})
+    assert "yepcord_events.guild.400" in gw.subscriptions.channels
+    assert "yepcord_events.guild.400" in gw.broker._handlers
+
+    await gw.subscriptions.close()
+    assert gw.subscriptions.channels == set()
+    assert "yepcord_events.guild.400" not in gw.broker._handlers
+
+    for client in (cl1, cl2):
+        client.disconnect()
+
+
+
+@pt.mark.asyncio
+async def test_dispatch_batch(monkeypatch):
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.append((channel, message))
+
+    dispatcher = GatewayDispatcher.getInstance()
+    monkeypatch.setattr(dispatcher.broker, "publish", publish)
+
+    def _event(name: str) -> RawDispatchEvent:
+        return RawDispatchEvent({"t": name, "op": GatewayOp.DISPATCH, "d": {"id": "123"}})
+
+    async with dispatcher.batch():
+        await dispatcher.dispatch(_event("TEST_1"), user_ids=[1])
+        async with dispatcher.batch():  # Nested batch is a part of outer one
+            await dispatcher.dispatch(_event("TEST_2"), user_ids=[1])
+        assert published == []
+        await dispatcher.dispatchSub([1], guild_id=100)  # System events flush batch
+        await dispatcher.dispatch(_event("TEST_3"), user_ids=[1])
+        await dispatcher.dispatch(_event("TEST_4"), user_ids=[1], guild_id=100, permissions=None)
+    (channel1, envelope1), (channel2, sub), (channel3, envelope2) = published
+    assert channel1 == channel3 and channel2 == "yepcord_sys_events"
+    assert [message["data"]["t"] for message in envelope1["batch"]] == ["TEST_1", "TEST_2"]
+    assert sub["event"] == "sub"
+    assert [message["data"]["t"] for message in envelope2["batch"]] == ["TEST_3", "TEST_4"]
+
+    # Single message is published without envelope
+    published.clear()
+    async with dispatcher.batch():
+        await dispatcher.dispatch(_event("TEST_1"), user_ids=[1])
+    assert published[0][1]["data"]["t"] == "TEST_1"
+
+    published.clear()
+    monkeypatch.setattr(Config, "GATEWAY_BATCH_DISPATCH", False)
+    async with dispatcher.batch():
+        await dispatcher.dispatch(_event("TEST_1"), user_ids=[1])
+        assert len(published) == 1
+
+    # Gateway handles events of envelope in order
+    gw = Gateway()
+    cl = make_client(gw, 1)
+    await gw.mcl_yepcordEventsCallback(envelope1)
+    await gw.mcl_yepcordEventsCallback(envelope2)
+    await flush(cl)
+    assert [loads(msg)["t"] for msg in cl.ws.sent] == ["TEST_1", "TEST_2", "TEST_3", "TEST_4"]
+
+    # Events of api request are published when request ends
+    monkeypatch.setattr(Config, "GATEWAY_BATCH_DISPATCH", True)
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild = await create_guild(client, user, "Test")
+    channel = [channel for channel in guild["channels"] if channel["type"] == 0][0]
+    published.clear()
+    await create_message(client, user, channel["id"], content="test")
+    events = [message.get("batch", [message]) for _, message in published]
+    assert [[message["data"]["t"] for message in batch] for batch in events] == [["MESSAGE_CREATE", "MESSAGE_ACK"]]
+    cl.disconnect()
+
+
+@pt.mark.asyncio
+async def test_gateway_metrics_endpoint(monkeypatch):
+    client = gw_app.test_client()
+    resp = await client.get("/metrics")
+    assert resp.status_code == 404
+
+    monkeypatch.setattr(Config, "GATEWAY_METRICS", True)
+    resp = await client.get("/metrics")
+    assert resp.status_code == 200
+    assert "clients" in await resp.get_json()
+
+@pt.mark.asyncio
+async def test_gateway_etf_encoding():
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+
+    async with gateway_cm(gw_app):
+        gw_client = gw_app.test_client()
+        async with gw_client.websocket("/?encoding=etf&compress=zlib-stream") as ws:
+            decompressor = decompressobj()
+            hello = ETF.decode(decompressor.decompress(await ws.receive()))
+            assert hello["op"] == GatewayOp.HELLO
+
+            await ws.send(ETF.encode({"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}}))
+            ready = ETF.decode(decompressor.decompress(await ws.receive()))
+            assert ready["t"] == "READY"
+            assert ready["d"]["user"]["id"] == int(user["id"])
+
+        for invalid in (b"\x83invalid", b"\x83t\x00\x00\x00\x01jj"):
+            async with gw_client.websocket("/?encoding=etf") as ws:
+                assert ETF.decode(await ws.receive())["op"] == GatewayOp.HELLO
+                await ws.send(invalid)
+                with pt.raises(WebsocketDisconnectError) as exc:
+                    await ws.receive()
+                assert exc.value.args[0] == 4002
+
+
+@pt.mark.asyncio
+async def test_gateway_unknown_op(caplog):
+    gw = Gateway()
+    cl = make_client(gw, 1)
+    setattr(cl.ws, "_yepcord_client", cl)
+    with caplog.at_level(logging.DEBUG, logger="yepcord.gateway.gateway"):
+        await gw.process(cl.ws, {"op": 99, "d": {"test": 1}})
+    await flush(cl)
+    assert "Unknown op code 99" in caplog.text
+    assert cl.ws.sent == []
+    cl.disconnect()
+
+
+def test_zstd_training_scrub():
+    payload = {"t": "READY", "d": {
+        "user": {"id": "634241071368626240", "email": "test@yepcord.ml", "phone": "+10000000000", "username": "Test"},
+        "session_id": "8cd777435cc800f", "resume_gateway_url": "wss://127.0.0.1:8080/gateway/",
+        "presences": [{"status": "online", "last_modified": 1792222809843, "activities": [{"state": "hi"}]}],
+        "read_state": {"634241071368626240": {"mention_count": 1}}, "user_settings_proto": "CgQIDhgB",
+    }}
+    assert scrub(payload) == {"t": "READY", "d": {
+        "user": {"id": "000000000000000000", "username": "xxxx"},
+        "resume_gateway_url": "xxx://000.0.0.0:0000/xxxxxxx/",
+        "presences": [{"status": "online", "last_modified": 1000000000000, "activities": [{"state": "xx"}]}],
+        "read_state": {"000000000000000000": {"mention_count": 1}},
+    }}
+
+
+def test_zstd_compression(monkeypatch):
+    messages = [b'{"op":10,"d":{"heartbeat_interval":45000}}', b'{"t":"READY","op":0,"d":{"v":9}}' * 10, b"{}"]
+    dictionary = zstd_dictionary()
+    dict_id = str(dictionary.dict_id())
+
+    for args, dict_data in (({}, None), ({"zstd_dictionary": "1"}, None), ({"zstd_dictionary": dict_id}, dictionary)):
+        compressor = WsCompressor.create_compressor("zstd-stream", args)
+        decompressor = zstandard.ZstdDecompressor(dict_data=dict_data).decompressobj()
+        for message in messages:
+            # Every message is flushed and can be decompressed as soon as it is received
+            assert decompressor.decompress(compressor(message)) == message
+
+    with_dict = WsCompressor.create_compressor("zstd-stream", {"zstd_dictionary": dict_id})
+    without_dict = WsCompressor.create_compressor("zstd-stream")
+    assert len(with_dict(messages[1])) < len(without_dict(messages[1]))
+
+    monkeypatch.setattr(Config, "GATEWAY_ZSTD", Config.GATEWAY_ZSTD | {"use_dictionary": False, "window_log": 10})
+    zstd_dictionary.cache_clear()
+    try:
+        assert zstd_dictionary() is None
+        compressor = WsCompressor.create_compressor("zstd-stream", {"zstd_dictionary": dict_id})
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        frame = compressor(messages[0])
+        assert zstandard.get_frame_parameters(frame).window_size == 1 << 10
+        assert decompressor.decompress(frame) == messages[0]
+    finally:
+        zstd_dictionary.cache_clear()
+
+
+def count_queries(monkeypatch) -> list[int]:
+    counter = [0]
+    connection = connections.get("default")
+    for name in ("execute_query", "execute_query_dict"):
+        async def _counted(*args, _func=getattr(connection, name), **kwargs):
+            counter[0] += 1
+            return await _func(*args, **kwargs)
+        monkeypatch.setattr(connection, name, _counted)
+
+    return counter
+
+
+async def _ready_per_object(user: User) -> dict:
+    return {
+        "users": [(await related.data).ds_json for related in await user.get_related_users()],
+        "guilds": [
+            await guild.ds_json(user_id=user.id, for_gateway=True, with_channels=True)
+            for guild in await user.get_guilds()
+        ],
+        "relationships": [await relationship.ds_json(user) for relationship in await user.get_relationships()],
+        "private_channels": [await channel.ds_json(user_id=user.id) for channel in await user.get_private_channels()],
+        "read_states": [await state.ds_json() for state in await user.get_read_states()],
+    }
+
+
+def _normalize_ready(ready: dict) -> dict:
+    ready["users"].sort(key=lambda u: u["id"])
+    for guild in ready["guilds"]:
+        del guild["version"]
+    for channel in ready["private_channels"]:
+        channel["recipient_ids"].sort()
+    return ready
+
+
+@pt.mark.asyncio
+async def test_ready_loader_constant_queries(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, other1, other2 = await create_users(client, 3)
+    db_user = await User.get(id=int(user["id"]))
+
+    queries = count_queries(monkeypatch)
+
+    async def _load() -> tuple[dict, int]:
+        queries[0] = 0
+        loaded = await ReadyLoader(db_user).load()
+        return loaded, queries[0]
+
+    async def _populate(idx: int) -> None:
+        guild = await create_guild(client, user, f"Guild {idx}")
+        channel = await create_guild_channel(client, user, guild, f"channel-{idx}")
+        await create_role(client, user, guild["id"])
+        await create_emoji(client, user, guild["id"], f"YEP_{idx}")
+        voice = await create_guild_channel(client, user, guild, f"voice-{idx}", 2)
+        await create_event(client, guild, user, name=f"event {idx}", entity_type=2, channel_id=voice["id"])
+        message = await create_message(client, user, channel["id"], content="test")
+        await create_thread(client, user, message, name=f"thread {idx}", auto_archive_duration=1440)
+
+        dm = await create_dm_channel(client, user, other1 if idx % 2 else other2)
+        message = await create_message(client, user, dm["id"], content="test")
+        resp = await client.put(f"/api/v9/channels/{dm['id']}/pins/{message['id']}",
+                                headers={"Authorization": user["token"]})
+        assert resp.status_code == 204
+        await create_message(client, other1 if idx % 2 else other2, dm["id"], content="test")
+
+    await create_sticker(client, user, (await create_guild(client, user, "Stickers"))["id"], "yep")
+    await rel_request(client, other1, user)
+    await _populate(0)
+    await _populate(1)
+    ready, count = await _load()
+    assert len(ready["guilds"]) == 3
+    assert _normalize_ready(ready) == _normalize_ready(await _ready_per_object(db_user))
+
+    for idx in range(2, 6):
+        await _populate(idx)
+    ready, count_after = await _load()
+    assert len(ready["guilds"]) == 7
+    assert count_after == count
+    assert _normalize_ready(ready) == _normalize_ready(await _ready_per_object(db_user))
+
+
+@pt.mark.asyncio
+async def test_gateway_lazy_guilds(monkeypatch):
+    monkeypatch.setattr(Config, "GATEWAY_LAZY_GUILDS", True)
+    monkeypatch.setattr(Config, "GATEWAY_GUILD_CREATE_BATCH", 2)
+    monkeypatch.setattr(Config, "GATEWAY_GUILD_CREATE_CONCURRENCY", 1)
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild_ids = {(await create_guild(client, user, f"Guild {i}"))["id"] for i in range(3)}
+
+    def _events(cl: GatewayClient, name: str) -> list[dict]:
+        messages = [loads(message) for message in [*cl.ws.sent, *cl._queue] if isinstance(message, str)]
+        return [message["d"] for message in messages if message.get("t") == name]
+
+    async with gateway_cm(gw_app):
+        cl = await connect(main_gw)
+        await flush(cl)
+        cl.ws.blocked.clear()
+        await main_gw.process(cl.ws, {"op": GatewayOp.IDENTIFY, "d": {"token": user["token"]}})
+        for _ in range(100):
+            if _events(cl, "GUILD_CREATE"):
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+        # Next batch is not loaded until first one is written to the websocket
+        assert len(_events(cl, "GUILD_CREATE")) == 2
+
+        cl.ws.blocked.set()
+        for _ in range(100):
+            if cl._guilds_stream is None:
+                break
+            await asyncio.sleep(0.01)
+        await flush(cl)
+        ready, = _events(cl, "READY")
+        assert {guild["id"] for guild in ready["guilds"]} == guild_ids
+        assert all(guild == {"id": guild["id"], "unavailable": True} for guild in ready["guilds"])
+        guilds = _events(cl, "GUILD_CREATE")
+        assert {guild["id"] for guild in guilds} == guild_ids
+        assert all(guild["channels"] and guild["roles"] for guild in guilds)
+        assert cl._guilds_stream is None
+
+        await main_gw.disconnect(cl.ws)
+        main_gw.expire_session(cl)
+
+
+@pt.mark.asyncio
+async def test_guild_cache(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild = await create_guild(client, user, "Test")
+    guild_id = int(guild["id"])
+    channel = [channel for channel in guild["channels"] if channel["type"] == 0][0]
+    db_user = await User.get(id=int(user["id"]))
+    gw = Gateway()
+    cache = gw.guild_cache
+    queries = count_queries(monkeypatch)
+
+    loaded, = await ReadyLoader(db_user, cache).load_guilds()
+    assert guild_id in cache
+    uncached_queries, queries[0] = queries[0], 0
+    cached, = await ReadyLoader(db_user, cache).load_guilds()
+    assert queries[0] == 2  # Only per-user parts (joined_at and threads) are loaded
+    assert queries[0] < uncached_queries
+    assert cached == loaded
+    assert gw.metrics()["guild_cache"] == {"guilds": 1, "hits": 1, "misses": 1}
+
+    # New messages update cached channels without invalidating guild
+    message = await create_message(client, user, channel["id"], content="test")
+    await gw.mcl_yepcordEventsCallback({
+        "data": {"t": "MESSAGE_CREATE", "op": GatewayOp.DISPATCH, "d": message}, "user_ids": None,
+        "guild_id": None, "role_ids": None, "session_id": None,
+    })
+    assert guild_id in cache
+    cached, = await ReadyLoader(db_user, cache).load_guilds()
+    assert [ch for ch in cached["channels"] if ch["id"] == channel["id"]][0]["last_message_id"] == message["id"]
+
+    # Guild changes dispatched with GatewayDispatcher drop cached guild
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.extend(message.get("batch", [message]))
+
+    monkeypatch.setattr(GatewayDispatcher.getInstance().broker, "publish", publish)
+    role = await create_role(client, user, guild["id"])
+    body, = [message for message in published if "data" in message and message["data"]["t"] == "GUILD_ROLE_CREATE"]
+    assert body["guild_changed"] == guild_id
+    await gw.mcl_yepcordEventsCallback(body)
+    assert guild_id not in cache
+    reloaded, = await ReadyLoader(db_user, cache).load_guilds()
+    assert role["id"] in {r["id"] for r in reloaded["roles"]}
+    assert {"GUILD_MEMBER_ADD", "GUILD_SCHEDULED_EVENT_USER_ADD", "GUILD_SCHEDULED_EVENT_USER_REMOVE"} \
+           <= GUILD_CACHE_EVENTS
+
+    # Deleting messages drops cached guild only if last message of cached channel is deleted
+    def delete_event(*message_ids: str) -> dict:
+        data = {"guild_id": guild["id"], "channel_id": channel["id"]}
+        data |= {"id": message_ids[0]} if len(message_ids) == 1 else {"ids": list(message_ids)}
+        return {
+            "data": {"t": "MESSAGE_DELETE" if len(message_ids) == 1 else "MESSAGE_DELETE_BULK",
+                     "op": GatewayOp.DISPATCH, "d": data},
+            "user_ids": None, "guild_id": guild_id, "role_ids": None, "session_id": None,
+        }
+
+    await gw.mcl_yepcordEventsCallback(delete_event("1", "2"))
+    assert guild_id in cache
+    await gw.mcl_yepcordEventsCallback(delete_event(message["id"]))
+    assert guild_id not in cache
+    await ReadyLoader(db_user, cache).load_guilds()
+    await gw.mcl_yepcordEventsCallback(delete_event("1", message["id"]))
+    assert guild_id not in cache
+
+    # Guild that changed while it was loaded is not cached
+    cache.invalidate(guild_id)
+    versions = cache.start_loading([guild_id])
+    cache.invalidate(guild_id)
+    cache.finish_loading(versions, {guild_id: reloaded})
+    assert guild_id not in cache
+
+    # Guild is dropped when its last connected member disconnects
+    await ReadyLoader(db_user, cache).load_guilds()
+    cl = GatewayClient(FakeWs(), gw)
+    cl.id = cl.user_id = db_user.id
+    gw.store.add(cl, {guild_id: []})
+    assert guild_id in cache
+    gw.store.remove(cl)
+    assert guild_id not in cache
+    cl.disconnect()
+
+
+def _member_list_updates(cl: GatewayClient) -> list[dict]:
+    messages = [loads(message) for message in [*cl.ws.sent, *cl._queue] if isinstance(message, str)]
+    cl.ws.sent.clear()
+    return [message["d"] for message in messages if message.get("t") == "GUILD_MEMBER_LIST_UPDATE"]
+
+
+def _apply_member_list_ops(items: list[dict], updates: list[dict]) -> None:
+    for update in updates:
+        for op in update["ops"]:
+            if op["op"] == "SYNC":
+                items[op["range"][0]:op["range"][1] + 1] = op["items"]
+            elif op["op"] == "INSERT":
+                items.insert(op["index"], op["item"])
+            elif op["op"] == "DELETE":
+                del items[op["index"]]
+            elif op["op"] == "UPDATE":
+                items[op["index"]] = op["item"]
+
+
+def test_member_list_ranges_and_ops():
+    view = GuildPermissions.VIEW_CHANNEL
+    entries = {
+        user_id: MemberEntry(user_id, {"user": {"username": f"user{user_id:02}"}}, [],
+                             "online" if user_id % 2 else "offline")
+        for user_id in range(1, 31)
+    }
+    entries[2].role_ids = [200]
+    guild = GuildMembers(100, 1, {100: (view, 0, False), 200: (0, 1, True)}, entries)
+
+    everyone = guild.get_list(guild.list_id([]), [])
+    assert everyone.id == "everyone"
+    assert everyone.member_count == 30
+    items = everyone.items(0, 99)
+    assert len(items) == 32  # Hoisted role group is empty since its only member is offline
+    assert items[0] == {"group": {"id": "online", "count": 15}}
+    assert everyone.items(10, 19) == items[10:20]
+    assert everyone.items(25, 40) == items[25:]
+
+    overwrites = [(100, 0, view), (200, view, 0), (3, view, 0)]
+    private = guild.get_list(guild.list_id(overwrites), overwrites)
+    assert private.id not in ("everyone", guild.list_id([(100, 0, view)]))
+    assert set(private.member_keys) == {1, 2, 3}
+
+    # Applying ops to previous state of list gives current state
+    for user_id, status in ((4, "online"), (1, "offline"), (2, "dnd"), (2, "offline"), (5, "idle"), (6, "offline")):
+        entry = entries[user_id]
+        entry.status = status
+        ops = []
+        everyone.update(entry, ops)
+        _apply_member_list_ops(items, [{"ops": ops}])
+        assert [item["member"]["user"]["username"] for item in items if "member" in item] == \
+               [item["member"]["user"]["username"] for item in everyone.items(0, 99) if "member" in item]
+        assert [item["group"]["id"] for item in items if "group" in item] == \
+               [group["id"] for group in everyone.groups()]
+
+
+@pt.mark.asyncio
+async def test_member_list(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user1, user2 = await create_users(client, 3)
+    guild = await create_guild(client, owner, "Test")
+    guild_id = int(guild["id"])
+    channel = [channel for channel in guild["channels"] if channel["type"] == 0][0]
+    await add_user_to_guild(client, guild, owner, user1)
+
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.extend(message.get("batch", [message]))
+
+    def _published(name: str) -> list[dict]:
+        return [message for message in published if "data" in message and message["data"]["t"] == name]
+
+    monkeypatch.setattr(GatewayDispatcher.getInstance().broker, "publish", publish)
+
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    await gw.presences.set_or_refresh(int(owner["id"]), Presence(int(owner["id"]), "online"))
+    cl = make_client(gw, int(owner["id"]))
+    cl2 = make_client(gw, int(user1["id"]))
+    outsider = make_client(gw, int(user2["id"]))
+    queries = count_queries(monkeypatch)
+
+    # Member list of guild is only sent to its members
+    await outsider.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {channel["id"]: [[0, 99]]}})
+    await flush(outsider)
+    assert _member_list_updates(outsider) == []
+    assert guild_id not in gw.member_lists
+    outsider.disconnect()
+    gw.expire_session(outsider)
+
+    # Guild is not kept while its events are not received by this gateway process
+    await cl.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {channel["id"]: [[0, 99]]}})
+    await flush(cl)
+    assert _member_list_updates(cl) == []
+    assert guild_id not in gw.member_lists
+
+    gw.store.add(cl, {guild_id: []})
+    gw.store.add(cl2, {guild_id: []})
+    await cl.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {channel["id"]: [[0, 99]]}})
+    await flush(cl)
+    sync, = _member_list_updates(cl)
+    assert sync["id"] == "everyone"
+    assert (sync["member_count"], sync["online_count"]) == (2, 1)
+    assert sync["groups"] == [{"id": "online", "count": 1}, {"id": "offline", "count": 1}]
+    items = sync["ops"][0]["items"]
+    assert [next(iter(item)) for item in items] == ["group", "member", "group", "member"]
+    assert items[1]["member"]["user"]["id"] == owner["id"]
+    assert items[3]["member"]["presence"]["status"] == "offline"
+
+    # List is loaded once for all sessions
+    queries[0] = 0
+    await cl2.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {channel["id"]: [[0, 0]]}})
+    await flush(cl2)
+    assert queries[0] == 0
+    assert _member_list_updates(cl2)[0]["ops"][0]["items"] == items[:1]
+
+    def _list():  # List is rebuilt (as new object) when guild roles/channels change
+        return gw.member_lists._guilds[guild_id].lists["everyone"]
+
+    def _rebuilt() -> bool:  # Sessions are resubscribed to rebuilt list in background
+        return guild_id in gw.member_lists and "everyone" in gw.member_lists._guilds[guild_id].lists
+
+    def _ids(items_: list[dict]) -> list[str]:  # Group counts are taken from "groups" field by clients
+        return [item["group"]["id"] if "group" in item else item["member"]["user"]["id"] for item in items_]
+
+    async def _check(*body: dict) -> None:
+        for message in body:
+            await gw.mcl_yepcordEventsCallback(message)
+        for _ in range(100):
+            await flush(cl, cl2)
+            _apply_member_list_ops(items, _member_list_updates(cl))
+            if _rebuilt() and _ids(items) == _ids(_list().items(0, 99)):
+                break
+            await asyncio.sleep(0.01)
+        assert _ids(items) == _ids(_list().items(0, 99))
+        assert [item for item in items if "member" in item] == \
+               [item for item in _list().items(0, 99) if "member" in item]
+
+    # Presence change moves member to another group, session with range [0, 0] only gets INSERT/DELETE ops
+    await gw.presences.set_or_refresh(int(user1["id"]), Presence(int(user1["id"]), "dnd"))
+    await gw.mcl_yepcordSysEventsCallback({
+        "event": "presence", "user_id": int(user1["id"]), "status": "dnd", "activities": [],
+    })
+    await _check()
+    assert _list().groups() == [{"id": "online", "count": 2}]
+    assert all(op["op"] in ("INSERT", "DELETE") for update in _member_list_updates(cl2) for op in update["ops"])
+
+    # Member join
+    await add_user_to_guild(client, guild, owner, user2)
+    await _check(*_published("GUILD_MEMBER_ADD"))
+    assert _list().member_count == 3
+    assert items[-1]["member"]["user"]["id"] == user2["id"]
+
+    # Hoisted role rebuilds list, role change moves member to role group
+    published.clear()
+    role = await create_role(client, owner, guild["id"], hoist=True)
+    resp = await client.patch(f"/api/v9/guilds/{guild['id']}/members/{user1['id']}",
+                              headers={"Authorization": owner["token"]}, json={"roles": [role["id"]]})
+    assert resp.status_code == 200
+    await _check(*_published("GUILD_ROLE_CREATE"))
+    await _check(*_published("GUILD_MEMBER_UPDATE"))
+    assert items[0]["group"]["id"] == role["id"]
+    assert items[1]["member"]["user"]["id"] == user1["id"]
+
+    # Member leave
+    published.clear()
+    resp = await client.delete(f"/api/v9/guilds/{guild['id']}/members/{user2['id']}",
+                               headers={"Authorization": owner["token"]})
+    assert resp.status_code == 204
+    await _check(*_published("GUILD_MEMBER_REMOVE"))
+    assert _list().member_count == 2
+    assert not [group for group in _list().groups() if group["id"] == "offline"]
+
+    # Changed ranges are invalidated
+    await cl.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {channel["id"]: [[0, 0]]}})
+    await flush(cl)
+    update, = _member_list_updates(cl)
+    assert update["ops"][0] == {"op": "INVALIDATE", "range": [0, 99]}
+    assert update["ops"][1]["op"] == "SYNC"
+
+    # Lists are dropped when their last subscriber is gone, guild is dropped when its events are no longer received
+    assert gw.metrics()["member_lists"] == {"guilds": 1, "lists": 1, "loads": 2}
+    cl.disconnect()
+    gw.expire_session(cl)
+    assert guild_id in gw.member_lists
+    cl2.disconnect()
+    gw.expire_session(cl2)
+    assert guild_id not in gw.member_lists
+
+
+@pt.mark.asyncio
+async def test_member_list_non_local(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user = await create_users(client, 2)
+    guild = await create_guild(client, owner, "Test")
+    await add_user_to_guild(client, guild, owner, user)
+    guild_id = int(guild["id"])
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    cl = make_client(gw, int(owner["id"]))  # Guild is not added to store, so its events are not received
+
+    # Lists of non-local guilds are not loaded at all
+    await cl.handle_LAZY_REQUEST({"guild_id": guild["id"], "channels": {}})
+    await flush(cl)
+    assert not _member_list_updates(cl)
+    assert gw.member_lists.loads == 0
+
+    # Non-local guilds are kept for searches only for a short time
+    assert len(await gw.member_lists.search(guild_id, "", 10)) == 2
+    assert len(await gw.member_lists.search(guild_id, "", 10)) == 2
+    assert gw.member_lists.loads == 1
+    assert guild_id not in gw.member_lists
+
+    monkeypatch.setattr(member_list, "time", lambda: time() + MemberLists.NON_LOCAL_TTL)
+    await gw.member_lists.search(guild_id, "", 10)
+    assert gw.member_lists.loads == 2
+
+    # Guild that became local is loaded and kept
+    gw.store.add(cl, {guild_id: []})
+    await gw.member_lists.search(guild_id, "", 10)
+    assert gw.member_lists.loads == 3
+    assert guild_id in gw.member_lists
+
+    cl.disconnect()
+
+
+def _dispatched(cl: GatewayClient, name: str) -> list[dict]:
+    messages = [loads(message) for message in [*cl.ws.sent, *cl._queue] if isinstance(message, str)]
+    cl.ws.sent.clear()
+    return [message["d"] for message in messages if message.get("t") == name]
+
+
+@pt.mark.asyncio
+async def test_guild_members_chunks(monkeypatch):
+    monkeypatch.setattr(MemberLists, "CHUNK_SIZE", 2)
+    client: TestClientType = app.test_client()
+    owner, *users = await create_users(client, 4)
+    guild = await create_guild(client, owner, "Test")
+    for user in users:
+        await add_user_to_guild(client, guild, owner, user)
+    member_ids = {owner["id"], *(user["id"] for user in users)}
+
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.extend(message.get("batch", [message]))
+
+    monkeypatch.setattr(GatewayDispatcher.getInstance().broker, "publish", publish)
+
+    gw = Gateway()
+    gw.redis = FakeRedis()
+    await gw.presences.set_or_refresh(int(users[0]["id"]), Presence(int(users[0]["id"]), "online"))
+    cl = make_client(gw, int(owner["id"]))
+    gw.store.add(cl, {int(guild["id"]): []})
+
+    # limit=0 sends all members in multiple chunks
+    await cl.handle_GUILD_MEMBERS({"guild_id": [guild["id"]], "query": "", "limit": 0, "presences": True, "nonce": "1"})
+    for _ in range(100):
+        if not cl._members_streams:
+            break
+        await asyncio.sleep(0.01)
+    await flush(cl)
+    chunks = _dispatched(cl, "GUILD_MEMBERS_CHUNK")
+    assert [(chunk["chunk_index"], chunk["chunk_count"], chunk["nonce"]) for chunk in chunks] == \
+           [(0, 2, "1"), (1, 2, "1")]
+    assert {member["user"]["id"] for chunk in chunks for member in chunk["members"]} == member_ids
+    assert [presence["user"]["id"] for chunk in chunks for presence in chunk["presences"]] == [users[0]["id"]]
+
+    # Prefix search by username or nick is case-insensitive and limited
+    await cl.handle_GUILD_MEMBERS({"guild_id": guild["id"], "query": "testuser", "limit": 2})
+    await flush(cl)
+    chunk, = _dispatched(cl, "GUILD_MEMBERS_CHUNK")
+    assert len(chunk["members"]) == 2
+    assert "presences" not in chunk
+
+    resp = await client.patch(f"/api/v9/guilds/{guild['id']}/members/{users[1]['id']}",
+                              headers={"Authorization": owner["token"]}, json={"nick": "Nickname"})
+    assert resp.status_code == 200
+    for message in published:
+        if "data" in message and message["data"]["t"] == "GUILD_MEMBER_UPDATE":
+            await gw.mcl_yepcordEventsCallback(message)
+    await cl.handle_GUILD_MEMBERS({"guild_id": guild["id"], "query": "NICK", "limit": 10})
+    await flush(cl)
+    chunk, = _dispatched(cl, "GUILD_MEMBERS_CHUNK")
+    assert [member["user"]["id"] for member in chunk["members"]] == [users[1]["id"]]
+
+    # Members by ids
+    await cl.handle_GUILD_MEMBERS({"guild_id": guild["id"], "user_ids": [users[2]["id"], "1"], "nonce": "2"})
+    await flush(cl)
+    chunk, = _dispatched(cl, "GUILD_MEMBERS_CHUNK")
+    assert [member["user"]["id"] for member in chunk["members"]] == [users[2]["id"]]
+    assert chunk["not_found"] == ["1"]
+    assert chunk["nonce"] == "2"
+    cl.disconnect()
+
+
+@pt.mark.asyncio
+async def test_channel_filter_permission_cache(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user1, user2 = await create_users(client, 3)
+    guild = await create_guild(client, owner, "Test")
+    guild_id = int(guild["id"])
+    channel_id = [channel for channel in guild["channels"] if channel["type"] == 0][0]["id"]
+    for user in (user1, user2):
+        await add_user_to_guild(client, guild, owner, user)
+    role = await create_role(client, owner, guild["id"], perms=0)
+    headers = {"Authorization": owner["token"]}
+
+    resp = await client.put(f"/api/v9/channels/{channel_id}/permissions/{user1['id']}", headers=headers,
+                            json={"id": user1["id"], "type": 1, "allow": "0",
+                                  "deny": str(GuildPermissions.VIEW_CHANNEL)})
+    assert resp.status_code == 204
+
+    dispatcher = GatewayDispatcher.getInstance()
+    channel = await Channel.get(id=channel_id)
+    queries = count_queries(monkeypatch)
+
+    async def _filter() -> dict:
+        result = await dispatcher.getChannelFilter(channel, GuildPermissions.VIEW_CHANNEL)
+        return {key: set(value) for key, value in result.items()}
+
+    expected = {"role_ids": {guild_id}, "user_ids": {int(owner["id"])}, "exclude": {int(user1["id"])}}
+    assert await _filter() == expected
+    queries[0] = 0
+    assert await _filter() == expected
+    assert queries[0] == 0
+
+    # Member roles are applied to cached engine in place
+    resp = await client.patch(f"/api/v9/guilds/{guild_id}/members/{user2['id']}", headers=headers,
+                              json={"roles": [role["id"]]})
+    assert resp.status_code == 200
+    assert guild_id in dispatcher.permissions
+    queries[0] = 0
+    assert await _filter() == expected
+    assert queries[0] == 0
+
+    resp = await client.patch(f"/api/v9/guilds/{guild_id}/roles/{role['id']}", headers=headers,
+                              json={"permissions": str(GuildPermissions.ADMINISTRATOR)})
+    assert resp.status_code == 200
+    assert guild_id not in dispatcher.permissions
+    assert await _filter() == expected  # Every member of role is member of @everyone role
+
+    resp = await client.get(f"/api/v9/guilds/{guild_id}/members/{user1['id']}/permissions", headers=headers)
+    assert resp.status_code == 200
+    json = await resp.get_json()
+    assert int(json["permissions"]) & GuildPermissions.VIEW_CHANNEL
+    assert not int(json["channels"][channel_id]) & GuildPermissions.VIEW_CHANNEL
+    resp = await client.get(f"/api/v9/guilds/{guild_id}/members/{user2['id']}/permissions",
+                            headers={"Authorization": user1["token"]})
+    assert resp.status_code == 403
+    resp = await client.get(f"/api/v9/guilds/{guild_id}/members/@me/permissions",
+                            headers={"Authorization": user2["token"]})
+    assert resp.status_code == 200
+    assert set((await resp.get_json())["channels"].values()) == {str(ALL_PERMISSIONS)}
+
+    resp = await client.patch(f"/api/v9/guilds/{guild_id}/members/{user1['id']}", headers=headers,
+                              json={"roles": [role["id"]]})
+    assert resp.status_code == 200
+    assert guild_id in dispatcher.permissions
+    assert await _filter() == expected | {"exclude": set()}
+
+    resp = await client.delete(f"/api/v9/channels/{channel_id}/permissions/{user1['id']}", headers=headers)
+    assert resp.status_code == 204
+    assert await _filter() == expected | {"exclude": set()}
+
+
+def test_permission_engine():
+    view, send = GuildPermissions.VIEW_CHANNEL, GuildPermissions.SEND_MESSAGES
+    guild_id, owner_id, mods, muted, admins = 1, 10, 2, 3, 4
+    engine = PermissionEngine(
+        guild_id, owner_id, {guild_id: view | send, mods: 0, muted: 0, admins: GuildPermissions.ADMINISTRATOR},
+        {
+            100: {guild_id: (0, view), mods: (view, 0)},  # Private channel
+            101: {muted: (0, send), 13: (send, 0)},
+            102: {guild_id: (0, view), 12: (view, 0)},
+        },
+        {
+            owner_id: [], 11: [mods], 12: [], 13: [muted], 14: [muted, mods], 15: [admins],
+            **{user_id: [] for user_id in range(20, 25)},
+        },
+    )
+
+    assert sorted(engine.user_ids_with(100, view)) == [10, 11, 14, 15]
+    assert sorted(engine.user_ids_with(101, view | send)) == [10, 11, 12, 13, 15, *range(20, 25)]
+    assert engine.permissions(14, 101) == view
+    assert engine.permissions(12, 102) == view | send
+    assert engine.permissions(99) is None
+    assert engine.compute([100, 102], [11, 12]) == {100: {11: view | send, 12: send}, 102: {11: send, 12: view | send}}
+    assert engine.channels_with(12, [100, 101, 102], view) == [101, 102]
+
+    def _filter(channel_id: int, permissions: int) -> dict:
+        return {key: set(value) for key, value in engine.channel_filter(channel_id, permissions).items()}
+
+    assert _filter(100, view) == {"role_ids": {mods, muted, admins}, "user_ids": {owner_id}, "exclude": {13}}
+    assert _filter(101, view | send) == {"role_ids": {guild_id}, "user_ids": {owner_id}, "exclude": {14}}
+    assert _filter(102, view) == {"role_ids": {admins}, "user_ids": {owner_id, 12}, "exclude": set()}
+
+    engine.set_member(12, [mods])
+    engine.remove_member(15)
+    assert sorted(engine.user_ids_with(100, view)) == [10, 11, 12, 14]
+    assert sorted(engine.user_ids_with(102, view)) == [10, 12]
+
+
+
+@pt.mark.asyncio
+async def test_roles_by_permissions(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild = await create_guild(client, user, "Test")
+    guild_id = int(guild["id"])
+    manage = int(GuildPermissions.MANAGE_GUILD | GuildPermissions.MANAGE_ROLES)
+    managers = await create_role(client, user, guild["id"], perms=manage)
+    admins = await create_role(client, user, guild["id"], perms=GuildPermissions.ADMINISTRATOR)
+    dispatcher = GatewayDispatcher.getInstance()
+    dispatcher.permissions.invalidate(guild_id)
+    queries = count_queries(monkeypatch)
+
+    assert set(await dispatcher.getRolesByPermissions(guild_id)) == {guild_id, int(managers["id"]), int(admins["id"])}
+    assert queries[0] == 1
+    assert guild_id not in dispatcher.permissions  # Only roles are loaded
+    assert set(await dispatcher.getRolesByPermissions(guild_id, GuildPermissions.MANAGE_GUILD)) == \
+           {int(managers["id"]), int(admins["id"])}
+    assert set(await dispatcher.getRolesByPermissions(guild_id, manage | GuildPermissions.BAN_MEMBERS)) == \
+           {int(admins["id"])}
+    assert queries[0] == 1
+
+    resp = await client.patch(f"/api/v9/guilds/{guild_id}/roles/{managers['id']}",
+                              headers={"Authorization": user["token"]}, json={"permissions": "0"})
+    assert resp.status_code == 200
+    assert set(await dispatcher.getRolesByPermissions(guild_id, GuildPermissions.MANAGE_GUILD)) == {int(admins["id"])}
+
+    # Cached engine of guild is used as index too
+    await dispatcher.permissions.get(guild_id)
+    queries[0] = 0
+    assert set(await dispatcher.getRolesByPermissions(guild_id, GuildPermissions.MANAGE_GUILD)) == {int(admins["id"])}
+    assert queries[0] == 0
+    assert await dispatcher.getRolesByPermissions(guild_id + 1) == []
+
+
+@pt.mark.asyncio
+async def test_permission_cache_broadcast(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user = await create_users(client, 2)
+    guild = await create_guild(client, owner, "Test")
+    guild_id = int(guild["id"])
+    await add_user_to_guild(client, guild, owner, user)
+    dispatcher = GatewayDispatcher.getInstance()
+    published = []
+
+    async def publish(message: dict, channel: str) -> None:
+        published.extend((channel, message_) for message_ in message.get("batch", [message]))
+
+    def _changes() -> list[dict]:
+        result = [message for channel, message in published if message.get("event") == "permissions"]
+        assert all(channel == "yepcord_sys_events" for channel, message in published if message in result)
+        published.clear()
+        return result
+
+    monkeypatch.setattr(dispatcher.broker, "publish", publish)
+    other = PermissionCache()  # Cache of another api process
+    await other.get(guild_id)
+
+    role = await create_role(client, owner, guild["id"], perms=GuildPermissions.MANAGE_GUILD)
+    change, = _changes()
+    assert change["guild_id"] == guild_id and change.get("user_id") is None
+    other.apply(change)
+    assert guild_id not in other
+
+    engine = await other.get(guild_id)
+    assert not engine.permissions(int(user["id"])) & GuildPermissions.MANAGE_GUILD
+    resp = await client.patch(f"/api/v9/guilds/{guild_id}/members/{user['id']}",
+                              headers={"Authorization": owner["token"]}, json={"roles": [role["id"]]})
+    assert resp.status_code == 200
+    change, = _changes()
+    assert (change["user_id"], change["roles"]) == (int(user["id"]), [int(role["id"])])
+    other.apply(change)
+    assert await other.get(guild_id) is engine
+    assert engine.permissions(int(user["id"])) & GuildPermissions.MANAGE_GUILD
+
+    # Changes broadcast by this process are already applied
+    await dispatcher.permissions.get(guild_id)
+    await dispatcher._sys_events_callback(change | {"user_id": None})
+    assert guild_id in dispatcher.permissions
+    await dispatcher._sys_events_callback(change | {"user_id": None, "origin": "other"})
+    assert guild_id not in dispatcher.permissions
+
+
+@pt.mark.asyncio
+async def test_permission_cache_lru(monkeypatch):
+    client: TestClientType = app.test_client()
+    user, = await create_users(client, 1)
+    guild_ids = [int((await create_guild(client, user, "Test"))["id"]) for _ in range(3)]
+    monkeypatch.setattr(Config, "GATEWAY_PERMISSION_CACHE_SIZE", 2)
+    cache = PermissionCache()
+
+    await cache.get(guild_ids[0])
+    await cache.get(guild_ids[1])
+    await cache.get(guild_ids[0])
+    await cache.get(guild_ids[2])
+    assert len(cache) == 2
+    assert guild_ids[0] in cache and guild_ids[1] not in cache and guild_ids[2] in cache
+
+    for guild_id in guild_ids:
+        await cache.roles(guild_id)
+    assert len(cache._role_indexes) == 1
+    assert cache.misses == 4  # Role indexes of guilds with cached engine are not loaded
+
+
+@pt.mark.asyncio
+async def test_ready_hide_inaccessible_channels(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user = await create_users(client, 2)
+    guild = await create_guild(client, owner, "Test")
+    await add_user_to_guild(client, guild, owner, user)
+    channel_id = [channel for channel in guild["channels"] if channel["type"] == 0][0]["id"]
+    resp = await client.put(f"/api/v9/channels/{channel_id}/permissions/{user['id']}",
+                            headers={"Authorization": owner["token"]},
+                            json={"id": user["id"], "type": 1, "allow": "0",
+                                  "deny": str(GuildPermissions.VIEW_CHANNEL)})
+    assert resp.status_code == 204
+
+    owner_db, user_db = await User.get(id=int(owner["id"])), await User.get(id=int(user["id"]))
+    cache = Gateway().guild_cache
+    loaded, = await ReadyLoader(user_db, cache).load_guilds()
+    assert channel_id in {channel["id"] for channel in loaded["channels"]}
+
+    monkeypatch.setattr(Config, "GATEWAY_HIDE_INACCESSIBLE_CHANNELS", True)
+    loaded, = await ReadyLoader(user_db, cache).load_guilds()
+    assert channel_id not in {channel["id"] for channel in loaded["channels"]}
+    assert len(loaded["channels"]) == len(guild["channels"]) - 1
+    loaded, = await ReadyLoader(owner_db, cache).load_guilds()
+    assert channel_id in {channel["id"] for channel in loaded["channels"]}
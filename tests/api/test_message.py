@@ -4,13 +4,14 @@ from json import dumps
 
 import pytest as pt
 import pytest_asyncio
+from tortoise import connections
 
 from yepcord.rest_api.main import app
-from yepcord.yepcord.enums import ChannelType
+from yepcord.yepcord.enums import ChannelType, GuildPermissions
 from yepcord.yepcord.snowflake import Snowflake
 from yepcord.yepcord.utils import getImage
 from tests.api.utils import TestClientType, create_users, create_guild, create_guild_channel, create_message, rel_block, \
-    create_dm_channel, create_sticker, create_emoji, create_dm_group, create_invite, create_webhook
+    create_dm_channel, create_sticker, create_emoji, create_dm_group, create_invite, create_webhook, add_user_to_guild
 from tests.yep_image import YEP_IMAGE
 from ..utils import register_app_error_handler
 
@@ -686,3 +687,33 @@ async def test_get_message_interaction_without_interaction():
     resp = await client.get(f"/api/v9/channels/{channel['id']}/messages/{message['id']}/interaction-data",
                             headers=headers)
     assert resp.status_code == 404
+
+
+@pt.mark.asyncio
+async def test_send_message_queries(monkeypatch):
+    client: TestClientType = app.test_client()
+    owner, user = await create_users(client, 2)
+    guild = await create_guild(client, owner, "Test Guild")
+    await add_user_to_guild(client, guild, owner, user)
+    channel = await create_guild_channel(client, owner, guild, "test_channel")
+    await create_message(client, user, channel["id"], content="test")
+
+    queries = [0]
+    connection = connections.get("default")
+    for name in ("execute_query", "execute_query_dict"):
+        async def _counted(*args, _func=getattr(connection, name), **kwargs):
+            queries[0] += 1
+            return await _func(*args, **kwargs)
+        monkeypatch.setattr(connection, name, _counted)
+
+    # Channel, member (and its roles) are loaded once and shared between dependencies and route
+    await create_message(client, user, channel["id"], content="test")
+    assert queries[0] <= 9
+
+    resp = await client.put(f"/api/v9/channels/{channel['id']}/permissions/{user['id']}",
+                            headers={"Authorization": owner["token"]},
+                            json={"id": user["id"], "type": 1, "allow": "0", "deny": str(GuildPermissions.SEND_MESSAGES)})
+    assert resp.status_code == 204
+    resp = await client.post(f"/api/v9/channels/{channel['id']}/messages", headers={"Authorization": user["token"]},
+                             json={"content": "test"})
+    assert resp.status_code == 403
@@ -1,6 +1,7 @@
 import pytest as pt
 import pytest_asyncio
 
+from yepcord.gateway.compression import zstd_dictionary
 from yepcord.rest_api.main import app
 from yepcord.yepcord.config import Config
 from tests.api.utils import TestClientType, create_users
@@ -128,7 +129,14 @@ async def test_hardcoded_endpoints():
 
     resp = await client.get(f"/api/v9/gateway")
     assert resp.status_code == 200
-    assert await resp.get_json() == {"url": f"wss://{Config.GATEWAY_HOST}"}
+    dictionary = zstd_dictionary()
+    assert await resp.get_json() == {"url": f"wss://{Config.GATEWAY_HOST}", "zstd_dictionary": {
+        "id": str(dictionary.dict_id()), "url": f"https://{Config.PUBLIC_HOST}/api/v9/gateway/zstd-dictionary",
+    }}
+
+    resp = await client.get(f"/api/v9/gateway/zstd-dictionary")
+    assert resp.status_code == 200
+    assert await resp.get_data() == dictionary.as_bytes()
 
     resp = await client.get(f"/api/v9/oauth2/tokens")
     assert resp.status_code == 200
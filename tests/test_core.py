@@ -371,6 +371,7 @@ async def test_gw_channel_filter():
 
     await PermissionOverwrite.create(channel=channel, target_role=role,
                                      deny=GuildPermissions.VIEW_CHANNEL, type=0, allow=0)
+    gw.permissions.invalidate(guild.id)  # Overwrites are created without route, which would dispatch CHANNEL_UPDATE
 
     assert await gw.getChannelFilter(channel, GuildPermissions.VIEW_CHANNEL) == \
            {"role_ids": [], "user_ids": [user.id], "exclude": []}
@@ -381,6 +382,7 @@ async def test_gw_channel_filter():
                                      deny=GuildPermissions.VIEW_CHANNEL, type=1, allow=0)
     await PermissionOverwrite.create(channel=channel, target_user=user2,
                                      deny=GuildPermissions.VIEW_CHANNEL, type=1, allow=0)
+    gw.permissions.invalidate(guild.id)
 
     assert await gw.getChannelFilter(channel, GuildPermissions.VIEW_CHANNEL) == \
            {"role_ids": [role1.id], "user_ids": [user.id], "exclude": []}
@@ -77,6 +77,7 @@ app.register_blueprint(other.other, url_prefix="/")
 app.route("/api/v9/<path:path>", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])(rest_api.other_api_endpoints)
 
 app.websocket("/gateway", strict_slashes=False)(gateway.ws_gateway)
+app.route("/gateway/metrics")(gateway.gateway_metrics)
 remote_auth.ws_gateway.__name__ = "ws_ra_gateway"
 app.websocket("/remote-auth", strict_slashes=False)(remote_auth.ws_gateway)
 
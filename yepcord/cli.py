@@ -91,6 +91,42 @@ def run_all(config: str, host: str, port: int, reload: bool, ssl: bool) -> None:
     uvicorn.run("yepcord.asgi:app", **kwargs)
 
 
+@cli.command(name="train-zstd-dictionary")
+@click.option("--config", "-c", help="Config path.", default=None)
+@click.option("--output", "-o", help="Output file. Dictionary shipped with yepcord is replaced if not specified.",
+              default=None)
+@click.option("--size", "-s", help="Dictionary size in bytes.", default=16 * 1024)
+@click.option("--limit", "-l", help="Maximum number of users and messages to take samples from.", default=1000)
+@click.option("--synthetic", is_flag=True, default=False,
+              help="Take samples from synthetic data generated in in-memory database instead of configured one "
+                   "(shipped dictionary is trained this way).")
+def train_zstd_dictionary(config: str, output: str, size: int, limit: int, synthetic: bool) -> None:
+    if config is not None:
+        environ["YEPCORD_CONFIG"] = config
+
+    from .yepcord.config import Config
+    from .gateway.compression import DEFAULT_ZSTD_DICTIONARY_PATH
+    from .gateway.zstd_training import collect_samples, train, populate_synthetic, SYNTHETIC_ACTIVITIES
+
+    async def _train():
+        db_url = "sqlite://:memory:" if synthetic else Config.DB_CONNECT_STRING
+        await Tortoise.init(db_url=db_url, modules={"models": ["yepcord.yepcord.models"]})
+        try:
+            if synthetic:
+                await Tortoise.generate_schemas()
+                await populate_synthetic(messages_count=limit)
+            samples = await collect_samples(limit, SYNTHETIC_ACTIVITIES if synthetic else ([],))
+        finally:
+            await Tortoise.close_connections()
+
+        dictionary = train(samples, size)
+        with open(output or DEFAULT_ZSTD_DICTIONARY_PATH, "wb") as f:
+            f.write(dictionary.as_bytes())
+        print(f"Trained dictionary {dictionary.dict_id()} ({len(dictionary)} bytes) from {len(samples)} samples.")
+
+    asyncio.run(_train())
+
+
 @cli.command(name="download-ipdb")
 @click.option("--url", "-u", help="Url of mmdb file.",
               default="https://github.com/geoacumen/geoacumen-country/raw/master/Geoacumen-Country.mmdb")
@@ -19,10 +19,18 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from functools import lru_cache
+from pathlib import Path
+from typing import Mapping, Optional
+import warnings
 import zlib
 
 import zstandard
 
+from ..yepcord.config import Config
+
+DEFAULT_ZSTD_DICTIONARY_PATH = Path(__file__).parent / "zstd_dictionary.bin"
+
 
 class WsCompressor(ABC):
     CLSs = {}
@@ -31,9 +39,13 @@ class WsCompressor(ABC):
     def __call__(self, data: bytes) -> bytes: ...
 
     @classmethod
-    def create_compressor(cls, name: str) -> WsCompressor | None:
+    def from_args(cls, args: Mapping[str, str]) -> WsCompressor:
+        return cls()
+
+    @classmethod
+    def create_compressor(cls, name: str, args: Optional[Mapping[str, str]] = None) -> WsCompressor | None:
         if name in cls.CLSs:
-            return cls.CLSs[name]()
+            return cls.CLSs[name].from_args(args or {})
 
 
 class ZlibCompressor(WsCompressor):
@@ -46,14 +58,39 @@ class ZlibCompressor(WsCompressor):
         return self._obj.compress(data) + self._obj.flush(zlib.Z_FULL_FLUSH)
 
 
+@lru_cache
+def zstd_dictionary() -> Optional[zstandard.ZstdCompressionDict]:
+    if not Config.GATEWAY_ZSTD["use_dictionary"]:
+        return None
+    try:
+        with open(Config.GATEWAY_ZSTD["dictionary_path"] or DEFAULT_ZSTD_DICTIONARY_PATH, "rb") as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+    except OSError as e:
+        warnings.warn(f"Failed to load zstd dictionary: {e.__class__.__name__}: {e}.")
+        return None
+    dictionary.precompute_compress(Config.GATEWAY_ZSTD["level"])
+    return dictionary
+
+
 class ZstdCompressor(WsCompressor):
     __slots__ = ("_obj",)
 
-    def __init__(self):
-        self._obj = zstandard.ZstdCompressor().compressobj()
+    def __init__(self, dictionary: Optional[zstandard.ZstdCompressionDict] = None):
+        params = zstandard.ZstdCompressionParameters.from_level(
+            Config.GATEWAY_ZSTD["level"], window_log=Config.GATEWAY_ZSTD["window_log"],
+        )
+        self._obj = zstandard.ZstdCompressor(compression_params=params, dict_data=dictionary).compressobj()
+
+    @classmethod
+    def from_args(cls, args: Mapping[str, str]) -> ZstdCompressor:
+        dictionary = zstd_dictionary()
+        if dictionary is None or args.get("zstd_dictionary") != str(dictionary.dict_id()):
+            dictionary = None
+        return cls(dictionary)
 
     def __call__(self, data: bytes) -> bytes:
-        return self._obj.compress(data)# + self._obj.flush(zlib.Z_FULL_FLUSH)
+        # Every message ends zstd block, so client can decompress it as soon as it is received
+        return self._obj.compress(data) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
 
 
 WsCompressor.CLSs["zlib-stream"] = ZlibCompressor
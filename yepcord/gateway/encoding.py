@@ -0,0 +1,303 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from json import dumps as jdumps, loads as jloads
+from struct import Struct, error as StructError
+from typing import Union, Any
+
+
+class WsEncoding(ABC):
+    CLSs = {}
+    NAME: str
+
+    @abstractmethod
+    def encode(self, data: dict) -> Union[str, bytes]: ...
+
+    @abstractmethod
+    def decode(self, data: Union[str, bytes]) -> dict: ...
+
+    @abstractmethod
+    def dispatch_head(self, data: dict) -> Union[str, bytes]:
+        """ Encodes dispatch payload without sequence number, result is shared between all recipients. """
+
+    @abstractmethod
+    def dispatch_encode(self, head: Union[str, bytes], seq: int) -> Union[str, bytes]: ...
+
+    @classmethod
+    def get(cls, name: str) -> WsEncoding:
+        return cls.CLSs.get(name, cls.CLSs["json"])
+
+
+class JsonEncoding(WsEncoding):
+    NAME = "json"
+
+    def encode(self, data: dict) -> str:
+        return jdumps(data)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return jloads(data)
+
+    def dispatch_head(self, data: dict) -> str:
+        body = jdumps(data, separators=(",", ":"))
+        return body[:-1] + ("," if len(body) > 2 else "")
+
+    def dispatch_encode(self, head: str, seq: int) -> str:
+        return f"{head}\"s\":{seq}}}"
+
+
+_U8 = Struct(">B")
+_U16 = Struct(">H")
+_I32 = Struct(">i")
+_U32 = Struct(">I")
+_F64 = Struct(">d")
+
+ETF_VERSION = 131
+NEW_FLOAT_EXT = 70
+SMALL_INTEGER_EXT = 97
+INTEGER_EXT = 98
+FLOAT_EXT = 99
+ATOM_EXT = 100
+SMALL_TUPLE_EXT = 104
+LARGE_TUPLE_EXT = 105
+NIL_EXT = 106
+STRING_EXT = 107
+LIST_EXT = 108
+BINARY_EXT = 109
+SMALL_BIG_EXT = 110
+LARGE_BIG_EXT = 111
+MAP_EXT = 116
+SMALL_ATOM_EXT = 115
+ATOM_UTF8_EXT = 118
+SMALL_ATOM_UTF8_EXT = 119
+
+_NIL = bytes((SMALL_ATOM_UTF8_EXT, 3)) + b"nil"
+_TRUE = bytes((SMALL_ATOM_UTF8_EXT, 4)) + b"true"
+_FALSE = bytes((SMALL_ATOM_UTF8_EXT, 5)) + b"false"
+_ATOMS = {"nil": None, "true": True, "false": False}
+
+# Snowflakes are sent as integers, like discord does. Only known snowflake fields are converted: other fields that
+# may contain digits-only strings (custom_id, session_id, nonce, list_id, ...) must be sent unchanged
+_SNOWFLAKE_KEYS = {
+    "id", "guild_id", "channel_id", "user_id", "message_id", "parent_id", "owner_id", "last_message_id", "emoji_id",
+    "sku_id", "application_id", "role_id", "system_channel_id", "afk_channel_id", "target_id", "last_read_id",
+    "guild_scheduled_event_id", "webhook_id", "target_user_id", "target_role_id", "inviter_id", "creator_id",
+    "bot_id", "author_id", "widget_channel_id", "source_guild_id", "safety_alerts_channel_id", "rules_channel_id",
+    "public_updates_channel_id", "note_user_id", "entity_id", "latest_onboarding_question_id",
+}
+_SNOWFLAKE_LISTS = {
+    "roles", "mention_roles", "user_ids", "role_ids", "guild_ids", "sticker_ids", "recipient_ids", "message_ids",
+    "activity_restricted_guild_ids",
+}
+
+
+class EtfEncoding(WsEncoding):
+    """
+    Erlang External Term Format encoding (compatible with erlpack).
+    Map keys are encoded as atoms, strings as binaries, None/True/False as nil/true/false atoms and snowflakes
+    as integers.
+    """
+
+    NAME = "etf"
+
+    def encode(self, data: dict) -> bytes:
+        buf = bytearray((ETF_VERSION,))
+        self._pack(data, buf)
+        return bytes(buf)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if isinstance(data, str):
+            data = data.encode("latin1")
+        if not data or data[0] != ETF_VERSION:
+            raise ValueError("Invalid ETF version")
+        try:
+            result, offset = self._unpack(data, 1)
+        except (IndexError, StructError) as e:
+            raise ValueError("Truncated ETF term") from e
+        except (TypeError, RecursionError) as e:  # Unhashable map key or too deeply nested term
+            raise ValueError("Invalid ETF term") from e
+        if offset != len(data):
+            raise ValueError("Trailing data after ETF term")
+        return result
+
+    def dispatch_head(self, data: dict) -> bytes:
+        buf = bytearray((ETF_VERSION, MAP_EXT))
+        buf += _U32.pack(len(data) + 1)
+        for key, value in data.items():
+            self._pack_atom(key, buf)
+            self._pack(value, buf)
+        self._pack_atom("s", buf)
+        return bytes(buf)
+
+    def dispatch_encode(self, head: bytes, seq: int) -> bytes:
+        buf = bytearray(head)
+        self._pack_int(seq, buf)
+        return bytes(buf)
+
+    @staticmethod
+    def _pack_str(value: str, buf: bytearray) -> None:
+        value = value.encode("utf8")
+        buf.append(BINARY_EXT)
+        buf += _U32.pack(len(value))
+        buf += value
+
+    @staticmethod
+    def _pack_atom(value: str, buf: bytearray) -> None:
+        value = value.encode("utf8")
+        if len(value) < 256:
+            buf.append(SMALL_ATOM_UTF8_EXT)
+            buf.append(len(value))
+        else:
+            buf.append(ATOM_UTF8_EXT)
+            buf += _U16.pack(len(value))
+        buf += value
+
+    @staticmethod
+    def _pack_int(value: int, buf: bytearray) -> None:
+        if 0 <= value <= 255:
+            buf.append(SMALL_INTEGER_EXT)
+            buf.append(value)
+        elif -2147483648 <= value <= 2147483647:
+            buf.append(INTEGER_EXT)
+            buf += _I32.pack(value)
+        else:
+            magnitude = abs(value)
+            digits = magnitude.to_bytes((magnitude.bit_length() + 7) // 8, "little")
+            if len(digits) > 255:
+                raise ValueError("Integer is too big to be encoded")
+            buf.append(SMALL_BIG_EXT)
+            buf.append(len(digits))
+            buf.append(value < 0)
+            buf += digits
+
+    def _pack(self, value: Any, buf: bytearray) -> None:
+        value_type = type(value)
+        if value_type is str:
+            self._pack_str(value, buf)
+        elif value_type is dict:
+            buf.append(MAP_EXT)
+            buf += _U32.pack(len(value))
+            for key, item in value.items():
+                self._pack_atom(key if type(key) is str else str(key), buf)
+                if type(item) is str and key in _SNOWFLAKE_KEYS and item.isdigit():
+                    self._pack_int(int(item), buf)
+                elif type(item) is list and key in _SNOWFLAKE_LISTS:
+                    self._pack_list([int(i) if type(i) is str and i.isdigit() else i for i in item], buf)
+                else:
+                    self._pack(item, buf)
+        elif value is None:
+            buf += _NIL
+        elif value is True:
+            buf += _TRUE
+        elif value is False:
+            buf += _FALSE
+        elif value_type is int or isinstance(value, int):
+            self._pack_int(int(value), buf)
+        elif value_type is list or value_type is tuple or value_type is set:
+            self._pack_list(value, buf)
+        elif value_type is float:
+            buf.append(NEW_FLOAT_EXT)
+            buf += _F64.pack(value)
+        elif value_type is bytes:
+            buf.append(BINARY_EXT)
+            buf += _U32.pack(len(value))
+            buf += value
+        else:
+            raise TypeError(f"Object of type {value_type.__name__} can not be encoded to ETF")
+
+    def _pack_list(self, value, buf: bytearray) -> None:
+        if not value:
+            buf.append(NIL_EXT)
+            return
+        buf.append(LIST_EXT)
+        buf += _U32.pack(len(value))
+        for item in value:
+            self._pack(item, buf)
+        buf.append(NIL_EXT)
+
+    def _unpack(self, data: bytes, offset: int) -> tuple[Any, int]:
+        tag = data[offset]
+        offset += 1
+        if tag == SMALL_INTEGER_EXT:
+            return data[offset], offset + 1
+        elif tag == INTEGER_EXT:
+            return _I32.unpack_from(data, offset)[0], offset + 4
+        elif tag == BINARY_EXT:
+            length = _U32.unpack_from(data, offset)[0]
+            offset += 4
+            return data[offset:offset + length].decode("utf8"), offset + length
+        elif tag == MAP_EXT:
+            arity = _U32.unpack_from(data, offset)[0]
+            offset += 4
+            result = {}
+            for _ in range(arity):
+                key, offset = self._unpack(data, offset)
+                result[key], offset = self._unpack(data, offset)
+            return result, offset
+        elif tag in (SMALL_ATOM_UTF8_EXT, SMALL_ATOM_EXT, ATOM_UTF8_EXT, ATOM_EXT):
+            if tag in (SMALL_ATOM_UTF8_EXT, SMALL_ATOM_EXT):
+                length = data[offset]
+                offset += 1
+            else:
+                length = _U16.unpack_from(data, offset)[0]
+                offset += 2
+            encoding = "utf8" if tag in (SMALL_ATOM_UTF8_EXT, ATOM_UTF8_EXT) else "latin1"
+            atom = data[offset:offset + length].decode(encoding)
+            return _ATOMS.get(atom, atom), offset + length
+        elif tag == NIL_EXT:
+            return [], offset
+        elif tag in (LIST_EXT, SMALL_TUPLE_EXT, LARGE_TUPLE_EXT):
+            if tag == SMALL_TUPLE_EXT:
+                length = data[offset]
+                offset += 1
+            else:
+                length = _U32.unpack_from(data, offset)[0]
+                offset += 4
+            result = []
+            for _ in range(length):
+                item, offset = self._unpack(data, offset)
+                result.append(item)
+            if tag == LIST_EXT:
+                _, offset = self._unpack(data, offset)  # Tail, NIL_EXT for proper lists
+            return result, offset
+        elif tag == STRING_EXT:
+            length = _U16.unpack_from(data, offset)[0]
+            offset += 2
+            return data[offset:offset + length].decode("latin1"), offset + length
+        elif tag in (SMALL_BIG_EXT, LARGE_BIG_EXT):
+            if tag == SMALL_BIG_EXT:
+                length = data[offset]
+                offset += 1
+            else:
+                length = _U32.unpack_from(data, offset)[0]
+                offset += 4
+            sign = data[offset]
+            value = int.from_bytes(data[offset + 1:offset + 1 + length], "little")
+            return -value if sign else value, offset + 1 + length
+        elif tag == NEW_FLOAT_EXT:
+            return _F64.unpack_from(data, offset)[0], offset + 8
+        elif tag == FLOAT_EXT:
+            return float(data[offset:offset + 31].split(b"\x00", 1)[0]), offset + 31
+
+        raise ValueError(f"Unsupported ETF tag: {tag}")
+
+
+JSON = WsEncoding.CLSs["json"] = JsonEncoding()
+ETF = WsEncoding.CLSs["etf"] = EtfEncoding()
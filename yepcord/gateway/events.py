@@ -20,8 +20,11 @@ from __future__ import annotations
 
 from base64 import b64encode
 from time import time
-from typing import List, TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Optional, Union
 
+
+from .encoding import WsEncoding, JSON
+from .ready import ReadyLoader, GuildCache
 from ..yepcord.config import Config
 from ..yepcord.enums import GatewayOp
 from ..yepcord.models import Emoji, Application, Integration, ConnectedAccount
@@ -29,7 +32,7 @@ from ..yepcord.models.interaction import Interaction
 from ..yepcord.snowflake import Snowflake
 
 if TYPE_CHECKING:  # pragma: no cover
-    from ..yepcord.models import Channel, Invite, GuildMember, UserData, User, UserSettings
+    from ..yepcord.models import Channel, Invite, UserData, User, UserSettings
     from .gateway import GatewayClient
     from .presences import Presence
 
@@ -55,6 +58,23 @@ class RawDispatchEvent(DispatchEvent):
         return self.data
 
 
+class EncodedDispatchEvent(RawDispatchEvent):
+    __slots__ = ("name", "_heads",)
+
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.name = data.get("t")
+        self._heads: dict[str, Union[str, bytes]] = {}
+
+    def encode(self, seq: int, encoding: WsEncoding = JSON) -> Union[str, bytes]:
+        # Body is serialized once per encoding and shared between all recipients, only sequence number is different
+        if (head := self._heads.get(encoding.NAME)) is None:
+            head = self._heads[encoding.NAME] = encoding.dispatch_head(
+                {k: v for k, v in self.data.items() if k != "s"}
+            )
+        return encoding.dispatch_encode(head, seq)
+
+
 class RawDispatchEventWrapper(RawDispatchEvent):
     def __init__(self, event: DispatchEvent, data: dict=None):
         super().__init__(data)
@@ -67,16 +87,20 @@ class RawDispatchEventWrapper(RawDispatchEvent):
 class ReadyEvent(DispatchEvent):
     NAME = "READY"
 
-    __slots__ = ("user", "client",)
+    __slots__ = ("user", "client", "lazy_guilds", "guild_cache",)
 
-    def __init__(self, user: User, client: GatewayClient):
+    def __init__(self, user: User, client: GatewayClient, lazy_guilds: bool = False,
+                 guild_cache: Optional[GuildCache] = None):
         self.user = user
         self.client = client
+        self.lazy_guilds = lazy_guilds
+        self.guild_cache = guild_cache
 
     async def json(self) -> dict:
         userdata = await self.user.userdata
         settings = await self.user.settings
         proto = settings.proto().get()
+        ready = await ReadyLoader(self.user, self.guild_cache).load(self.lazy_guilds)
         data = {
             "t": self.NAME,
             "op": self.OP,
@@ -104,20 +128,11 @@ class ReadyEvent(DispatchEvent):
                     "id": str(self.user.id),
                     "flags": 0,
                 },
-                "users": [
-                    (await user.data).ds_json
-                    for user in await self.user.get_related_users()
-                ],
-                "guilds": [
-                    await guild.ds_json(user_id=self.user.id, for_gateway=True, with_channels=True)
-                    for guild in await self.user.get_guilds()
-                ],
+                "users": ready["users"],
+                "guilds": ready["guilds"],
                 "session_id": self.client.sid,
                 "presences": [],  # TODO
-                "relationships": [
-                    await relationship.ds_json(self.user)
-                    for relationship in await self.user.get_relationships()
-                ],
+                "relationships": ready["relationships"],
                 "connected_accounts": [
                     conn.ds_json() for conn in await ConnectedAccount.filter(user=self.user, verified=True)
                 ],
@@ -133,17 +148,11 @@ class ReadyEvent(DispatchEvent):
                 "guild_experiments": [],  # TODO
                 "guild_join_requests": [],  # TODO
                 "merged_members": [],  # TODO
-                "private_channels": [
-                    await channel.ds_json(user_id=self.user.id)
-                    for channel in await self.user.get_private_channels()
-                ],
+                "private_channels": ready["private_channels"],
                 "read_state": {
                     "version": 1,
                     "partial": False,
-                    "entries": [
-                        await state.ds_json()
-                        for state in await self.user.get_read_states()
-                    ]
+                    "entries": ready["read_states"],
                 },
                 "resume_gateway_url": f"wss://{Config.GATEWAY_HOST}/",
                 "session_type": "normal",
@@ -555,60 +564,28 @@ class GuildDeleteEvent(DispatchEvent):
 class GuildMembersListUpdateEvent(DispatchEvent):
     NAME = "GUILD_MEMBER_LIST_UPDATE"
 
-    __slots__ = ("members", "total_members", "statuses", "groups", "guild_id",)
+    __slots__ = ("guild_id", "list_id", "member_count", "online_count", "groups", "ops",)
 
-    def __init__(self, members: List[GuildMember], total_members: int, statuses: dict, guild_id: int):
-        self.members = members
-        self.total_members = total_members
-        self.statuses = statuses
-        self.groups = {}
-        for s in statuses.values():
-            if s.public_status not in self.groups:
-                self.groups[s.public_status] = 0
-            self.groups[s.public_status] += 1
+    def __init__(self, guild_id: int, list_id: str, member_count: int, online_count: int, groups: list[dict],
+                 ops: list[dict]):
         self.guild_id = guild_id
+        self.list_id = list_id
+        self.member_count = member_count
+        self.online_count = online_count
+        self.groups = groups
+        self.ops = ops
 
-    # noinspection PyShadowingNames
     async def json(self) -> dict:
-        groups = [{"id": status, "count": count} for status, count in self.groups.items()]
-        items = []
-        for mem in self.members:
-            m = await mem.ds_json()
-            m["presence"] = {
-                "user": {"id": str(mem.user.id)},
-                "status": self.statuses[mem.user.id].public_status,
-                "client_status": {} if self.statuses[mem.user.id].public_status == "offline" else {
-                    "desktop": self.statuses[mem.user.id].public_status
-                },
-                "activities": self.statuses[mem.user.id].activities
-            }
-            items.append({"member": m})
-        items.sort(key=lambda i: i["member"]["presence"]["status"])
-        _ls = None
-        _ins: dict = {}
-        _offset = 0
-        for idx, i in enumerate(items):
-            if (_s := i["member"]["presence"]["status"]) != _ls:
-                group = {"id": _s, "count": self.groups[_s]}
-                _ins[idx+_offset] = {"group": group}
-                _offset += 1
-            _ls = _s
-        for idx, ins in _ins.items():
-            items.insert(idx, ins)
         return {
             "t": self.NAME,
             "op": self.OP,
             "d": {
-                "ops": [{
-                    "range": [0, 99],
-                    "op": "SYNC",
-                    "items": items
-                }],
-                "online_count": self.statuses.get("online", 0),
-                "member_count": self.total_members,
-                "id": "everyone",
+                "ops": self.ops,
+                "online_count": self.online_count,
+                "member_count": self.member_count,
+                "id": self.list_id,
                 "guild_id": str(self.guild_id),
-                "groups": groups
+                "groups": self.groups,
             }
         }
 
@@ -836,6 +813,25 @@ class GuildRoleDeleteEvent(DispatchEvent):
         return data
 
 
+class GuildMemberAddEvent(DispatchEvent):
+    NAME = "GUILD_MEMBER_ADD"
+
+    __slots__ = ("guild_id", "member_obj",)
+
+    def __init__(self, guild_id: int, member_obj: dict):
+        self.guild_id = guild_id
+        self.member_obj = member_obj
+
+    async def json(self) -> dict:
+        data = {
+            "t": self.NAME,
+            "op": self.OP,
+            "d": self.member_obj
+        }
+        data["d"]["guild_id"] = str(self.guild_id)
+        return data
+
+
 class GuildMemberUpdateEvent(DispatchEvent):
     NAME = "GUILD_MEMBER_UPDATE"
 
@@ -858,25 +854,35 @@ class GuildMemberUpdateEvent(DispatchEvent):
 class GuildMembersChunkEvent(DispatchEvent):
     NAME = "GUILD_MEMBERS_CHUNK"
 
-    __slots__ = ("members", "presences", "guild_id",)
+    __slots__ = ("members", "presences", "guild_id", "chunk_index", "chunk_count", "nonce", "not_found",)
 
-    def __init__(self, members: List[GuildMember], presences: list, guild_id: int):
+    def __init__(self, members: list[dict], presences: Optional[list[dict]], guild_id: int, chunk_index: int = 0,
+                 chunk_count: int = 1, nonce: Optional[str] = None, not_found: Optional[list[int]] = None):
         self.members = members
         self.presences = presences
         self.guild_id = guild_id
+        self.chunk_index = chunk_index
+        self.chunk_count = chunk_count
+        self.nonce = nonce
+        self.not_found = not_found
 
     async def json(self) -> dict:
         data = {
             "t": self.NAME,
             "op": self.OP,
             "d": {
-                "members": [await member.ds_json() for member in self.members],
-                "presences": self.presences,
-                "chunk_index": 0,
-                "chunk_count": 1,
+                "members": self.members,
+                "chunk_index": self.chunk_index,
+                "chunk_count": self.chunk_count,
                 "guild_id": str(self.guild_id)
             }
         }
+        if self.presences is not None:
+            data["d"]["presences"] = self.presences
+        if self.nonce is not None:
+            data["d"]["nonce"] = self.nonce
+        if self.not_found:
+            data["d"]["not_found"] = [str(user_id) for user_id in self.not_found]
         return data
 
 
@@ -19,26 +19,41 @@
 from __future__ import annotations
 
 import warnings
+from asyncio import Event as AsyncEvent, Task, TimerHandle, Semaphore, get_running_loop, current_task, gather
+from collections import deque
 from json import dumps as jdumps
-from typing import Union
+from logging import getLogger
+from time import monotonic
+from typing import Union, Iterable, Iterator, Callable, Optional
 
 from quart import Websocket
 from redis.asyncio import Redis
-from tortoise.expressions import Q
 
 from .compression import WsCompressor
+from .encoding import WsEncoding, JSON
 from .events import *
+from .member_list import MemberLists, MemberEntry
 from .presences import Presences, Presence
-from .utils import require_auth, get_token_type, TokenType, init_redis_pool
+from .ready import ReadyLoader, GuildCache
+from .related_users import RelatedUsers
+from .utils import require_auth, get_token_type, TokenType, init_redis_pool, ReplayBuffer, TimerWheel, \
+    byte_size
 from ..yepcord.utils.fakeredis import FakeRedis
+from ..yepcord.config import Config
 from ..yepcord.enums import GatewayOp, RelationshipType
-from ..yepcord.models import Session, User, UserSettings, Bot, GuildMember, Guild
-from ..yepcord.mq_broker import getBroker
+from ..yepcord.models import Session, User, UserSettings, Bot, GuildMember, Role, UserData
+from ..yepcord.mq_broker import getBroker, DynamicSubscriptions
+from ..yepcord.sharding import route_message, events_channel, local_shards, user_shard, interest_subscriptions, \
+    guild_channel, user_channel, EVENTS_CHANNEL
+
+log = getLogger(__name__)
 
 
 class GatewayClient:
     __slots__ = (
-        "ws", "gateway", "seq", "sid", "id", "user_id", "is_bot", "_connected", "_compressor", "cached_presence",
+        "ws", "gateway", "seq", "sid", "id", "user_id", "is_bot", "_connected", "_compressor", "_encoding",
+        "cached_presence", "_queue", "_queue_bytes", "_queue_event", "_drained", "_writer", "_replay", "_expiration",
+        "_guilds_stream", "_members_streams",
     )
 
     def __init__(self, ws: Websocket, gateway: Gateway):
@@ -49,43 +64,158 @@ class GatewayClient:
         self._connected = True
 
         self._compressor: WsCompressor = getattr(ws, "compressor", None)
+        self._encoding: WsEncoding = getattr(ws, "encoding", JSON)
         self.id = self.user_id = None
         self.is_bot = False
         self.cached_presence: Optional[Presence] = None
 
+        self._queue: deque[Union[str, bytes, int]] = deque()
+        self._queue_bytes = 0
+        self._queue_event = AsyncEvent()
+        self._drained = AsyncEvent()
+        self._drained.set()
+        self._writer: Optional[Task] = None
+        self._start_writer()
+
+        self._replay = ReplayBuffer(Config.GATEWAY_RESUME_BUFFER_SIZE)
+        self._expiration: Optional[TimerHandle] = None
+        self._guilds_stream: Optional[Task] = None
+        self._members_streams: set[Task] = set()
+
     @property
     def connected(self):
         return self._connected
 
+    @property
+    def queue_size(self) -> int:
+        return len(self._queue)
+
+    @property
+    def queue_bytes(self) -> int:
+        return self._queue_bytes
+
+    @property
+    def replay_size(self) -> int:
+        return self._replay.size
+
     def disconnect(self) -> None:
         self._connected = False
         self.ws = None
+        self.gateway.heartbeats.discard(self)
+        self._stop_writer()
+        if self._expiration is None:
+            self._expiration = get_running_loop().call_later(
+                Config.GATEWAY_SESSION_TIMEOUT, self.gateway.expire_session, self
+            )
+
+    def expire(self) -> None:
+        if self._expiration is not None:
+            self._expiration.cancel()
+            self._expiration = None
+        if self._guilds_stream is not None:
+            self._guilds_stream.cancel()
+            self._guilds_stream = None
+        for task in self._members_streams:
+            task.cancel()
+        self._members_streams.clear()
+        self._replay.clear()
+
+    def _start_writer(self) -> None:
+        self._writer = get_running_loop().create_task(self._write_loop(self.ws))
+
+    def _stop_writer(self) -> None:
+        if self._writer is not None and self._writer is not current_task():
+            self._writer.cancel()
+        self._writer = None
+        self._queue.clear()
+        self._queue_bytes = 0
+        self._drained.set()  # Nothing will be written until resume, events only go to replay buffer
+
+    async def _write_loop(self, ws: Websocket) -> None:
+        while True:
+            while not self._queue:
+                self._queue_event.clear()
+                self._drained.set()
+                await self._queue_event.wait()
+
+            item = self._queue.popleft()
+            if isinstance(item, int):
+                await ws.close(item)
+                return
+
+            self._queue_bytes -= byte_size(item)
+            try:
+                await ws.send(item)
+            except Exception:
+                if self.ws is ws:
+                    self.disconnect()
+                return
+
+    def _enqueue(self, item: Union[str, bytes, int]) -> None:
+        if self.ws is None:
+            return
 
-    async def send(self, data: dict):
+        self._queue.append(item)
+        self._drained.clear()
+        if not isinstance(item, int):
+            self._queue_bytes += byte_size(item)
+            if len(self._queue) > Config.GATEWAY_MAX_QUEUE_MESSAGES \
+                    or self._queue_bytes > Config.GATEWAY_MAX_QUEUE_BYTES:
+                return self._drop_slow_consumer()
+
+        self._queue_event.set()
+
+    def _drop_slow_consumer(self) -> None:
+        ws = self.ws
+        self.gateway.dropped_slow_clients += 1
+        self.disconnect()
+        get_running_loop().create_task(ws.close(4000))  # Unknown error, client may resume
+
+    def close(self, code: int) -> None:
+        self._enqueue(code)
+
+    def _send_raw(self, data: Union[str, bytes]) -> None:
+        if self.ws is None:
+            return
+        if self._compressor:
+            return self._enqueue(self._compressor(data.encode("utf8") if isinstance(data, str) else data))
+        self._enqueue(data)
+
+    async def send(self, data: dict, replay: bool = True):
         self.seq += 1
         data["s"] = self.seq
-        if self._compressor:
-            return await self.ws.send(self.compress(data))
-        if self.ws is not None:
-            await self.ws.send_json(data)
+        raw = self._encoding.encode(data)
+        if replay and data["op"] == GatewayOp.DISPATCH:
+            self._replay.append(self.seq, raw)
+        self._send_raw(raw)
+
+    async def send_encoded(self, event: EncodedDispatchEvent) -> None:
+        self.seq += 1
+        data = event.encode(self.seq, self._encoding)
+        self._replay.append(self.seq, data)
+        self._send_raw(data)
 
     async def esend(self, event):
-        if not self.connected:
-            return
+        if isinstance(event, EncodedDispatchEvent):
+            return await self.send_encoded(event)
         await self.send(await event.json())
 
     def compress(self, json: dict):
-        return self._compressor(jdumps(json).encode("utf8"))
+        data = self._encoding.encode(json)
+        return self._compressor(data.encode("utf8") if isinstance(data, str) else data)
 
     async def handle_IDENTIFY(self, data: dict) -> None:
         if self.user_id is not None:
-            return await self.ws.close(4005)
+            return self.close(4005)
         if not (token := data.get("token")) or (token_type := get_token_type(token)) is None:
-            return await self.ws.close(4004)
+            return self.close(4004)
 
         S = Session if token_type == TokenType.USER else Bot
         if (session := await S.from_token(token)) is None:
-            return await self.ws.close(4004)
+            return self.close(4004)
+
+        if self.gateway.shards and user_shard(session.user.id) not in self.gateway.shards:
+            return self.close(4010)
 
         self.id = self.user_id = session.user.id
         self.is_bot = session.user.is_bot
@@ -95,38 +225,93 @@ class GatewayClient:
         if self.cached_presence is None:
             self.cached_presence = Presence(self.user_id, settings.status, settings.custom_status, [])
 
+        lazy_guilds = Config.GATEWAY_LAZY_GUILDS
         await self.gateway.authenticated(self, self.cached_presence)
-        await self.esend(ReadyEvent(session.user, self))
+        await self.esend(ReadyEvent(session.user, self, lazy_guilds, self.gateway.guild_cache))
+        if session.user.is_bot and not lazy_guilds:
+            return
+
+        guild_ids = await GuildMember.filter(user=session.user).values_list("guild_id", flat=True)
         if not session.user.is_bot:
-            guild_ids = [guild.id for guild in await session.user.get_guilds()]
             await self.esend(ReadySupplementalEvent(await self.gateway.getFriendsPresences(self.user_id), guild_ids))
+        if lazy_guilds and guild_ids:
+            self._guilds_stream = get_running_loop().create_task(self._stream_guilds(session.user, guild_ids))
+
+    async def _stream_guilds(self, user: User, guild_ids: list[int]) -> None:
+        """
+        Sends GUILD_CREATE for every guild of lazy READY. Guilds are loaded in batches, and every batch waits until
+        previous events are written to the websocket, so only a few batches of guilds are kept in memory at a time.
+        """
+        batch_size = Config.GATEWAY_GUILD_CREATE_BATCH
+        semaphore = Semaphore(Config.GATEWAY_GUILD_CREATE_CONCURRENCY)
+        loader = ReadyLoader(user, self.gateway.guild_cache)
+
+        async def _send_batch(batch: list[int]) -> None:
+            async with semaphore:
+                for guild in await loader.load_guilds(batch):
+                    await self.esend(GuildCreateEvent(guild))
+                await self._drained.wait()
+
+        try:
+            await gather(*(
+                _send_batch(guild_ids[i:i + batch_size]) for i in range(0, len(guild_ids), batch_size)
+            ))
+        except Exception as e:
+            warnings.warn(f"Failed to send guilds of {self.user_id}: {e.__class__.__name__}: {e}.")
+        finally:
+            if self._guilds_stream is current_task():
+                self._guilds_stream = None
 
     @require_auth
     async def handle_RESUME(self, data: dict, new_client: GatewayClient) -> None:
         if self.connected:
             await new_client.send({"op": GatewayOp.INV_SESSION})
             await new_client.send({"op": GatewayOp.RECONNECT})
-            return await new_client.ws.close(4009)
+            return new_client.close(4009)
         if not (token := data.get("token")) or (token_type := get_token_type(token)) is None:
-            return await new_client.ws.close(4004)
+            return new_client.close(4004)
 
         S = Session if token_type == TokenType.USER else Bot
-        if (session := await S.from_token(token)) is None or self.user_id.id != session.user.id:
-            return await self.ws.close(4004)
+        if (session := await S.from_token(token)) is None or self.user_id != session.user.id:
+            return new_client.close(4004)
+        if not isinstance(seq := data.get("seq"), int) or not self._replay.can_replay(seq, self.seq) \
+                or new_client._encoding is not self._encoding:  # Replay buffer is stored already encoded
+            return await new_client.send({"op": GatewayOp.INV_SESSION, "d": False})
+
+        # Replay that does not fit into send queue would get client dropped as slow consumer right after resuming,
+        # and client would try to resume again forever, so it has to start new session instead
+        replay = list(self._replay.since(seq))
+        if len(replay) + 1 > Config.GATEWAY_MAX_QUEUE_MESSAGES \
+                or self._replay.size_since(seq) > Config.GATEWAY_MAX_QUEUE_BYTES:
+            return await new_client.send({"op": GatewayOp.INV_SESSION, "d": False})
+
+        if self._expiration is not None:
+            self._expiration.cancel()
+            self._expiration = None
 
         self._compressor = new_client._compressor
         self.ws = new_client.ws
+        self._connected = True
         setattr(self.ws, "_yepcord_client", self)
+        self._start_writer()
+        self.gateway.heartbeats.touch(self)
 
+        new_client.disconnect()
         self.gateway.remove_client(new_client)
-        await self.gateway.authenticated(self, self.cached_presence)
 
-        await self.send({"op": GatewayOp.DISPATCH, "t": "READY"})
+        for message in replay:
+            self._send_raw(message)
+        await self.send({"op": GatewayOp.DISPATCH, "t": "RESUMED", "d": None}, replay=False)
+
+        # Subscriptions of disconnected session are kept up to date, so there is no need to load them again
+        await self.gateway.online(self, self.cached_presence)
 
     # noinspection PyUnusedLocal
     async def handle_HEARTBEAT(self, data: None) -> None:
+        self.gateway.heartbeats.touch(self)
         await self.send({"op": GatewayOp.HEARTBEAT_ACK, "t": None, "d": None})
-        await self.gateway.presences.set_or_refresh(self.user_id, self.cached_presence)
+        if self.user_id is not None:
+            self.gateway.presences.refresh(self.user_id, self.cached_presence)
 
     @require_auth
     async def handle_STATUS(self, data: dict) -> None:
@@ -146,78 +331,161 @@ class GatewayClient:
         await self.gateway.ev.presence_update(self.user_id, presence)
 
     @require_auth
-    async def handle_LAZY_REQUEST(self, data: dict) -> None:  # TODO: handle ranges
+    async def handle_LAZY_REQUEST(self, data: dict) -> None:
         if not (guild_id := int(data.get("guild_id"))): return
         if not data.get("members", True): return
-        if not await GuildMember.exists(guild__id=guild_id, user__id=self.user_id):
+        # Membership is checked by member lists if guild is already loaded, other guilds must not be loaded for anyone
+        if guild_id not in self.gateway.member_lists \
+                and not await GuildMember.exists(guild__id=guild_id, user__id=self.user_id):
             return
 
-        guild = await Guild.get_or_none(id=guild_id)
-        members = await GuildMember.filter(guild=guild).select_related("user")
-        statuses = {}
-        for member in members:
-            if presence := await self.gateway.presences.get(member.user.id):
-                statuses[member.user.id] = presence
-            else:
-                statuses[member.user.id] = Presence(member.user.id, "offline", None)
-        await self.esend(GuildMembersListUpdateEvent(
-            members,
-            await guild.get_member_count(),
-            statuses,
-            guild_id
-        ))
+        channels = data.get("channels")
+        if not isinstance(channels, dict) or not channels:
+            channels = {None: [[0, 99]]}
+        for channel_id, ranges in channels.items():
+            ranges = self._parse_ranges(ranges)
+            if channel_id is not None:
+                channel_id = int(channel_id)
+            await self.gateway.member_lists.subscribe(self, guild_id, channel_id, ranges)
+
+    @staticmethod
+    def _parse_ranges(ranges: list) -> list[tuple[int, int]]:
+        result = []
+        for range_ in (ranges if isinstance(ranges, list) else [])[:MemberLists.MAX_RANGES]:
+            if not isinstance(range_, list) or len(range_) != 2 or not all(isinstance(i, int) for i in range_):
+                continue
+            start, end = range_
+            if 0 <= start <= end:
+                result.append((start, min(end, start + 99)))
+        return result
 
     @require_auth
     async def handle_GUILD_MEMBERS(self, data: dict) -> None:
-        if not (guild_id := int(data.get("guild_id")[0])): return
+        if isinstance(guild_id := data.get("guild_id"), list):
+            guild_id = guild_id[0] if guild_id else None
+        if not guild_id or not (guild_id := int(guild_id)): return
         if not await GuildMember.exists(guild__id=guild_id, user__id=self.user_id):
             return
 
-        query = data.get("query", "")
+        query = data.get("query") or ""
         limit = data.get("limit", 100)
-        user_ids = data.get("user_ids", [])
-        if limit > 100 or limit < 1:
-            limit = 100
+        nonce = data.get("nonce")
+        presences = bool(data.get("presences", False))
+        if not isinstance(user_ids := data.get("user_ids") or [], list):
+            user_ids = [user_ids]
+        user_ids = [int(user_id) for user_id in user_ids[:100]]
 
-        q = Q(guild__id=guild_id) & (Q(nick__startswith=query) | Q(user__userdatas__username__istartswith=query))
         if user_ids:
-            q &= Q(user__id__in=user_ids)
-        members = await GuildMember.filter(q).select_related("user").limit(limit)
+            entries = await self.gateway.member_lists.load_members(guild_id, user_ids)
+            found = {entry.user_id for entry in entries}
+            not_found = [user_id for user_id in user_ids if user_id not in found]
+            return await self.esend(self._members_chunk(guild_id, entries, presences, nonce, not_found=not_found))
+        if not query and limit == 0:
+            task = get_running_loop().create_task(self._stream_members(guild_id, presences, nonce))
+            self._members_streams.add(task)
+            task.add_done_callback(self._members_streams.discard)
+            return
 
-        presences = []  # TODO: add presences
-        await self.esend(GuildMembersChunkEvent(members, presences, guild_id))
+        if limit > 100 or limit < 1:
+            limit = 100
+        entries = await self.gateway.member_lists.search(guild_id, query, limit)
+        await self.esend(self._members_chunk(guild_id, entries, presences, nonce))
+
+    @staticmethod
+    def _members_chunk(guild_id: int, entries: list[MemberEntry], presences: bool, nonce: Optional[str],
+                       chunk_index: int = 0, chunk_count: int = 1,
+                       not_found: Optional[list[int]] = None) -> GuildMembersChunkEvent:
+        return GuildMembersChunkEvent(
+            [entry.member for entry in entries],
+            [entry.presence() for entry in entries if entry.status != "offline"] if presences else None,
+            guild_id, chunk_index, chunk_count, nonce, not_found,
+        )
+
+    async def _stream_members(self, guild_id: int, presences: bool, nonce: Optional[str]) -> None:
+        """Sends all members of guild as GUILD_MEMBERS_CHUNK events, next chunk is loaded when previous is written."""
+        try:
+            async for chunk_index, chunk_count, entries in self.gateway.member_lists.iter_chunks(guild_id):
+                await self.esend(self._members_chunk(guild_id, entries, presences, nonce, chunk_index, chunk_count))
+                await self._drained.wait()
+        except Exception as e:
+            warnings.warn(f"Failed to send members of guild {guild_id} to {self.user_id}: {e.__class__.__name__}: {e}.")
 
 
 class GatewayEvents:
     BOTS_EVENTS_BLACKLIST = {"MESSAGE_ACK"}
+    PRESENCE_DEBOUNCE = 1.0
 
     def __init__(self, gw: Gateway):
         self.gw = gw
         self.send = gw.send
+        self._userdata: dict[int, UserData] = {}
+        self._debounce: dict[int, tuple[float, Optional[Presence]]] = {}
+
+    async def get_userdata(self, user_id: int) -> UserData:
+        if (userdata := self._userdata.get(user_id)) is None:
+            userdata = self._userdata[user_id] = await UserData.get(id=user_id).select_related("user")
+        return userdata
+
+    def invalidate_userdata(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            self._userdata.pop(user_id, None)
+
+    def forget_user(self, user_id: int) -> None:
+        self._userdata.pop(user_id, None)
+        self.gw.related_users.discard(user_id)
 
     async def presence_update(self, user_id: int, presence: Presence):
-        user = await User.get(id=user_id)
-        userdata = await user.data
-        user_ids = [user.id for user in await user.get_related_users()]
+        """
+        Sends first presence update of user immediately, following updates made in PRESENCE_DEBOUNCE seconds
+        are merged into one update (with latest presence) sent at the end of that period.
+        """
+        now = monotonic()
+        if (debounce := self._debounce.get(user_id)) is not None and debounce[0] > now:
+            self._debounce[user_id] = (debounce[0], presence)
+            return
+
+        self._debounce[user_id] = (now + self.PRESENCE_DEBOUNCE, None)
+        get_running_loop().call_later(self.PRESENCE_DEBOUNCE, self._debounce_end, user_id)
+        await self._presence_update(user_id, presence)
+
+    def _debounce_end(self, user_id: int) -> None:
+        if (debounce := self._debounce.pop(user_id, None)) is not None and debounce[1] is not None:
+            get_running_loop().create_task(self.presence_update(user_id, debounce[1]))
+
+    async def _presence_update(self, user_id: int, presence: Presence):
+        userdata = await self.get_userdata(user_id)
+        user_ids = list(await self.gw.related_users.get(user_id))
+        if not self.gw.store.get(user_id=user_id):  # E.g. offline presence after last session was reaped
+            self.forget_user(user_id)
 
         event = PresenceUpdateEvent(userdata, presence)
+        data = await event.json()
+        # Member lists of guilds of this user may be on any gateway process
+        await self.gw.broker.publish(channel="yepcord_sys_events", message={
+            "event": "presence", "user_id": user_id, "status": data["d"]["status"],
+            "activities": data["d"]["activities"],
+        })
 
-        await self.gw.broker.publish(channel="yepcord_events", message={
-            "data": await event.json(),
+        message = {
+            "data": data,
             "event": event.NAME,
-            "users": user_ids,
-            "channel_id": None,
+            "user_ids": user_ids,
             "guild_id": None,
-            "permissions": None,
-        })
-        await self.sendToUsers(RawDispatchEventWrapper(event), user_ids, set())
-
-    async def _send(self, client: GatewayClient, event: RawDispatchEvent) -> None:
-        if client.is_bot and event.data.get("t") in self.BOTS_EVENTS_BLACKLIST:
+            "role_ids": None,
+            "session_id": None,
+            "exclude": [],
+        }
+        # Sessions of these users may be on any gateway process (including this one), and other processes drop
+        # cached presence of user when they receive this event, so it is always published through the broker
+        for channel, user_message in route_message(message):
+            await self.gw.broker.publish(channel=channel, message=user_message)
+
+    async def _send(self, client: GatewayClient, event: EncodedDispatchEvent) -> None:
+        if client.is_bot and event.name in self.BOTS_EVENTS_BLACKLIST:
             return
         await client.esend(event)
 
-    async def sendToUsers(self, event: RawDispatchEvent, user_ids: list[int], sent: set) -> None:
+    async def sendToUsers(self, event: EncodedDispatchEvent, user_ids: list[int], sent: set) -> None:
         for user_id in user_ids:
             for client in self.gw.store.get(user_id=user_id):
                 if client in sent:
@@ -225,30 +493,60 @@ class GatewayEvents:
                 await self._send(client, event)
                 sent.add(client)
 
-    async def sendToGuild(self, event: RawDispatchEvent, guild_id: int, exclude_users: set[int], sent: set) -> None:
-        for client in self.gw.store.get(guild_id=guild_id):
+    async def sendToGuild(self, event: EncodedDispatchEvent, guild_id: int, exclude_users: set[int], sent: set) -> None:
+        for client in self.gw.store.get_by_guild(guild_id):
             if client.user_id in exclude_users or client in sent:
                 continue
             await self._send(client, event)
             sent.add(client)
 
     async def sendToRoles(
-            self, event: RawDispatchEvent, role_ids: list[int], exclude_users: set[int], sent: set[GatewayClient]
+            self, event: EncodedDispatchEvent, role_ids: list[int], exclude_users: set[int], sent: set[GatewayClient]
     ) -> None:
+        for client in self.gw.store.get_by_roles(role_ids):
+            if client.user_id in exclude_users or client in sent:
+                continue
+            await self._send(client, event)
+            sent.add(client)
+
+
+class GuildIndex:
+    __slots__ = ("role_bits", "members", "_free_bits",)
+
+    def __init__(self):
+        self.role_bits: dict[int, int] = {}
+        self.members: dict[int, int] = {}
+        self._free_bits: list[int] = []
+
+    def role_bit(self, role_id: int) -> int:
+        if (bit := self.role_bits.get(role_id)) is None:
+            bit = self.role_bits[role_id] = self._free_bits.pop() if self._free_bits else 1 << len(self.role_bits)
+        return bit
+
+    def roles_mask(self, role_ids: Iterable[int]) -> int:
+        mask = 0
         for role_id in role_ids:
-            for client in self.gw.store.get(role_id=role_id):
-                if client.user_id in exclude_users or client in sent:
-                    continue
-                await self._send(client, event)
-                sent.add(client)
+            mask |= self.role_bit(role_id)
+        return mask
+
+    def delete_role(self, role_id: int) -> None:
+        if (bit := self.role_bits.pop(role_id, None)) is None:
+            return
+        for user_id, mask in self.members.items():
+            self.members[user_id] = mask & ~bit
+        self._free_bits.append(bit)
 
 
 class WsStore:
-    def __init__(self):
+    def __init__(self, on_interest: Optional[Callable[[str, bool], None]] = None,
+                 on_guild_drop: Optional[Callable[[int], None]] = None):
+        self._on_interest = on_interest
+        self._on_guild_drop = on_guild_drop
         self.by_sess_id: dict[str, GatewayClient] = {}
         self.by_user_id: dict[int, set[GatewayClient]] = {}
-        self.by_guild_id: dict[int, set[GatewayClient]] = {}
-        self.by_role_id: dict[int, set[GatewayClient]] = {}
+        self.guilds: dict[int, GuildIndex] = {}
+        self.role_guild: dict[int, int] = {}
+        self.user_guilds: dict[int, set[int]] = {}
 
     def get(self, user_id: int = None, session_id: str = None, guild_id: int = None,
             role_id: int = None) -> set[GatewayClient]:
@@ -258,63 +556,163 @@ class WsStore:
             if client := self.by_sess_id.get(session_id, None):
                 return {client}
         elif guild_id is not None:
-            return self.by_guild_id.get(guild_id, set())
+            return set(self.get_by_guild(guild_id))
         elif role_id is not None:
-            return self.by_role_id.get(role_id, set())
+            return set(self.get_by_roles([role_id]))
         return set()
 
+    def get_by_guild(self, guild_id: int) -> Iterator[GatewayClient]:
+        if (index := self.guilds.get(guild_id)) is None:
+            return
+        for user_id in index.members:
+            yield from self.by_user_id.get(user_id, ())
+
+    def get_by_roles(self, role_ids: Iterable[int]) -> Iterator[GatewayClient]:
+        masks: dict[int, int] = {}
+        for role_id in role_ids:
+            if role_id in self.guilds:  # @everyone role
+                masks[role_id] = -1
+            elif (guild_id := self.role_guild.get(role_id)) is not None and masks.get(guild_id) != -1:
+                masks[guild_id] = masks.get(guild_id, 0) | self.guilds[guild_id].role_bits[role_id]
+
+        for guild_id, mask in masks.items():
+            for user_id, roles in self.guilds[guild_id].members.items():
+                if mask == -1 or roles & mask:
+                    yield from self.by_user_id.get(user_id, ())
+
+    def _guild_index(self, guild_id: int) -> GuildIndex:
+        if guild_id not in self.guilds:
+            self.guilds[guild_id] = GuildIndex()
+            if self._on_interest is not None:
+                self._on_interest(guild_channel(guild_id), True)
+        return self.guilds[guild_id]
+
+    def _drop_guild(self, guild_id: int) -> None:
+        index = self.guilds.pop(guild_id)
+        if self._on_interest is not None:
+            self._on_interest(guild_channel(guild_id), False)
+        if self._on_guild_drop is not None:
+            self._on_guild_drop(guild_id)
+        for role_id in index.role_bits:
+            del self.role_guild[role_id]
+        for user_id in index.members:
+            self.user_guilds[user_id].discard(guild_id)
+
+    def _remove_member(self, guild_id: int, user_id: int) -> None:
+        if (index := self.guilds.get(guild_id)) is None:
+            return
+        index.members.pop(user_id, None)
+        self.user_guilds.get(user_id, set()).discard(guild_id)
+        if not index.members:
+            self._drop_guild(guild_id)
+
+    def add(self, client: GatewayClient, guilds_roles: dict[int, list[int]]) -> None:
+        user_id = client.user_id
+        if user_id not in self.by_user_id:
+            self.by_user_id[user_id] = set()
+            if self._on_interest is not None:
+                self._on_interest(user_channel(user_id), True)
+        self.by_user_id[user_id].add(client)
+        self.by_sess_id[client.sid] = client
+
+        if user_id not in self.user_guilds:
+            self.user_guilds[user_id] = set()
+        for guild_id, role_ids in guilds_roles.items():
+            index = self._guild_index(guild_id)
+            index.members[user_id] = index.roles_mask(role_ids)
+            for role_id in role_ids:
+                self.role_guild[role_id] = guild_id
+            self.user_guilds[user_id].add(guild_id)
+
+    def remove(self, client: GatewayClient) -> None:
+        if self.by_sess_id.get(client.sid) is client:
+            del self.by_sess_id[client.sid]
+        if (clients := self.by_user_id.get(client.user_id)) is None:
+            return
+        clients.discard(client)
+        if clients:
+            return
+
+        del self.by_user_id[client.user_id]
+        if self._on_interest is not None:
+            self._on_interest(user_channel(client.user_id), False)
+        for guild_id in self.user_guilds.pop(client.user_id, set()):
+            self._remove_member(guild_id, client.user_id)
+
     def subscribe(self, guild_id: int = None, role_id: int = None, *user_ids: int) -> None:
-        if guild_id is not None:
-            if guild_id not in self.by_guild_id:
-                self.by_guild_id[guild_id] = set()
-            for user_id in user_ids:
-                self.by_guild_id[guild_id].update(self.get(user_id))
-            self.subscribe(None, guild_id, *user_ids)
+        if guild_id is None and (guild_id := self.role_guild.get(role_id)) is None:
+            return
+        if role_id == guild_id:
+            role_id = None
 
-        if role_id is not None:
-            if role_id not in self.by_role_id:
-                self.by_role_id[role_id] = set()
-            for user_id in user_ids:
-                self.by_role_id[role_id].update(self.get(user_id))
+        for user_id in user_ids:
+            if user_id not in self.by_user_id:
+                continue
+            index = self._guild_index(guild_id)
+            mask = index.members.get(user_id, 0)
+            if role_id is not None:
+                mask |= index.role_bit(role_id)
+                self.role_guild[role_id] = guild_id
+            index.members[user_id] = mask
+            self.user_guilds[user_id].add(guild_id)
 
     def unsubscribe(self, guild_id: int = None, role_id: int = None, *user_ids: int, delete: bool = False) -> None:
-        if guild_id is not None:
-            if guild_id not in self.by_guild_id:
+        if guild_id is None and (guild_id := self.role_guild.get(role_id)) is None:
+            return
+        if (index := self.guilds.get(guild_id)) is None:
+            return
+
+        if role_id is not None and role_id != guild_id:
+            if role_id not in index.role_bits:
                 return
             if delete:
-                del self.by_guild_id[guild_id]
-            else:
-                for user_id in user_ids:
-                    self.by_guild_id[guild_id].difference_update(self.get(user_id))
-            self.unsubscribe(role_id=guild_id, *user_ids, delete=delete)
-
-        if role_id is not None:
-            if role_id not in self.by_role_id:
+                index.delete_role(role_id)
+                del self.role_guild[role_id]
                 return
-            if delete:
-                del self.by_role_id[role_id]
-            else:
-                for user_id in user_ids:
-                    self.by_role_id[role_id].difference_update(self.get(user_id))
+            bit = index.role_bits[role_id]
+            for user_id in user_ids:
+                if user_id in index.members:
+                    index.members[user_id] &= ~bit
+            return
+
+        if delete:
+            return self._drop_guild(guild_id)
+        for user_id in user_ids:
+            self._remove_member(guild_id, user_id)
 
 
 class Gateway:
     def __init__(self):
         self.broker = getBroker()
-        self.broker.subscriber("yepcord_events")(self.mcl_yepcordEventsCallback)
+        self.shards: set[int] = set()
+        self.subscriptions: Optional[DynamicSubscriptions] = None
+        if interest_subscriptions():
+            self.subscriptions = DynamicSubscriptions(self.broker, self.mcl_yepcordEventsCallback)
+            self.local_channels = {EVENTS_CHANNEL}
+        else:
+            self.shards = set(local_shards())
+            self.local_channels = {events_channel(shard) for shard in self.shards}
+        for channel in sorted(self.local_channels):
+            self.broker.subscriber(channel)(self.mcl_yepcordEventsCallback)
         self.broker.subscriber("yepcord_sys_events")(self.mcl_yepcordSysEventsCallback)
-        self.store = WsStore()
+        self.related_users = RelatedUsers()
+        self.guild_cache = GuildCache()
         self.presences = Presences(self)
+        # Only guilds whose events are received by this process can be kept up to date
+        self.member_lists = MemberLists(self.presences, lambda guild_id: guild_id in self.store.guilds)
+        self.store = WsStore(self.subscriptions.want if self.subscriptions is not None else None, self._guild_dropped)
         self.ev = GatewayEvents(self)
 
         self.redis: Union[Redis, FakeRedis, None] = None
+        self.dropped_slow_clients = 0
+        self.heartbeats = TimerWheel(Config.GATEWAY_KEEP_ALIVE_DELAY + Config.GATEWAY_HEARTBEAT_GRACE, self.reap)
+        self.reaped_clients = 0
 
     async def init(self):
         await self.broker.start()
 
         def _init_fake_redis():
             self.redis = FakeRedis()
-            self.redis.run()
 
         try:
             self.redis = await init_redis_pool()
@@ -325,11 +723,37 @@ class Gateway:
             _init_fake_redis()
 
     async def stop(self):
+        self.heartbeats.close()
+        await self.presences.flush()
+        if self.subscriptions is not None:
+            await self.subscriptions.close()
         await self.broker.close()
         await self.redis.close()
 
+    def _guild_dropped(self, guild_id: int) -> None:
+        # Events of guild are no longer received by this process
+        self.guild_cache.invalidate(guild_id)
+        self.member_lists.drop_guild(guild_id)
+
     async def mcl_yepcordEventsCallback(self, body: dict) -> None:
-        event = RawDispatchEvent(body["data"])
+        if (batch := body.get("batch")) is not None:  # Events dispatched by one api request (GatewayDispatcher.batch)
+            for message in batch:
+                await self.mcl_yepcordEventsCallback(message)
+            return
+        if (changed_guild_id := body.get("guild_changed")) is not None:
+            self.guild_cache.invalidate(changed_guild_id)
+        elif body["data"]["t"] == MessageCreateEvent.NAME:
+            self.guild_cache.set_last_message_id(int(body["data"]["d"]["channel_id"]), int(body["data"]["d"]["id"]))
+        elif body["data"]["t"] in (MessageDeleteEvent.NAME, MessageBulkDeleteEvent.NAME) \
+                and (guild_id := body["data"]["d"].get("guild_id")) is not None:
+            data = body["data"]["d"]
+            self.guild_cache.delete_messages(int(guild_id), int(data["channel_id"]), data.get("ids") or [data["id"]])
+        elif body["data"]["t"] == PresenceUpdateEvent.NAME:
+            self.presences.invalidate(int(body["data"]["d"]["user"]["id"]))
+        elif body["data"]["t"] == UserUpdateEvent.NAME and body["user_ids"]:
+            self.ev.invalidate_userdata(body["user_ids"])
+        await self.member_lists.handle_event(body)
+        event = EncodedDispatchEvent(body["data"])
         sent = set()
         if body["user_ids"] is not None:
             await self.ev.sendToUsers(event, body["user_ids"], sent)
@@ -342,18 +766,43 @@ class Gateway:
                 await list(client)[0].esend(event)
 
     async def mcl_yepcordSysEventsCallback(self, body: dict) -> None:
-        if body["event"] not in {"sub", "unsub"}:
-            return
-
-        if (guild_id := body["guild_id"]) is not None:
-            kw = {} if body["event"] == "sub" else {"delete": body["delete"]}
-            func = self.store.subscribe if body["event"] == "sub" else self.store.unsubscribe
-            func(guild_id, *body["user_ids"], **kw)
-
-        if (role_id := body["role_id"]) is not None:
-            kw = {} if body["event"] == "sub" else {"delete": body["delete"]}
-            func = self.store.subscribe if body["event"] == "sub" else self.store.unsubscribe
-            func(role_id=role_id, *body["user_ids"], **kw)
+        if body["event"] == "sub":
+            self.store.subscribe(body["guild_id"], body["role_id"], *body["user_ids"])
+            if self.subscriptions is not None:  # Message is acknowledged only when guild events can be received
+                await self.subscriptions.wait()
+        elif body["event"] == "unsub":
+            self.store.unsubscribe(body["guild_id"], body["role_id"], *body["user_ids"], delete=body["delete"])
+        elif body["event"] == "related":
+            self.related_users.update(body["user_ids"], body["other_ids"], body["removed"])
+        elif body["event"] == "presence":
+            self.presences.invalidate(body["user_id"])  # Even if this process has no related users of this user
+            await self.member_lists.presence_update(body["user_id"], body["status"], body["activities"])
+
+    def metrics(self) -> dict:
+        clients = list(self.store.by_sess_id.values())
+        return {
+            "shards": sorted(self.shards),
+            "subscriptions": len(self.local_channels) + len(self.subscriptions.channels if self.subscriptions else ()),
+            "clients": len(clients),
+            "outbound_queue": {
+                "messages": sum(client.queue_size for client in clients),
+                "bytes": sum(client.queue_bytes for client in clients),
+                "max_messages": max((client.queue_size for client in clients), default=0),
+            },
+            "resumable_sessions": sum(1 for client in clients if not client.connected),
+            "replay_buffer_bytes": sum(client.replay_size for client in clients),
+            "dropped_slow_clients": self.dropped_slow_clients,
+            "reaped_clients": self.reaped_clients,
+            "presences": self.presences.metrics(),
+            "related_users": {"users": len(self.related_users), "loads": self.related_users.loads},
+            "guild_cache": {
+                "guilds": len(self.guild_cache), "hits": self.guild_cache.hits, "misses": self.guild_cache.misses,
+            },
+            "member_lists": {
+                "guilds": len(self.member_lists), "lists": self.member_lists.list_count,
+                "loads": self.member_lists.loads,
+            },
+        }
 
     # noinspection PyMethodMayBeStatic
     async def send(self, client: GatewayClient, op: int, **data) -> None:
@@ -372,19 +821,31 @@ class Gateway:
     async def add_client(self, ws: Websocket) -> None:
         client = GatewayClient(ws, self)
         setattr(ws, "_yepcord_client", client)
-        await client.send({"op": GatewayOp.HELLO, "t": None, "s": None, "d": {"heartbeat_interval": 45000}})
+        self.heartbeats.touch(client)
+        await client.send({
+            "op": GatewayOp.HELLO, "t": None, "s": None,
+            "d": {"heartbeat_interval": Config.GATEWAY_KEEP_ALIVE_DELAY * 1000},
+        })
 
-    async def authenticated(self, client: GatewayClient, presence: Presence) -> None:
-        if client.user_id not in self.store.by_user_id:
-            self.store.by_user_id[client.user_id] = set()
-        self.store.by_user_id[client.user_id].add(client)
-        self.store.by_sess_id[client.sid] = client
+    @staticmethod
+    async def get_guilds_roles(user_id: int) -> dict[int, list[int]]:
+        guilds = {
+            guild_id: []
+            for guild_id in await GuildMember.filter(user__id=user_id).values_list("guild_id", flat=True)
+        }
+        for guild_id, role_id in await Role.filter(guildmembers__user__id=user_id).values_list("guild_id", "id"):
+            if guild_id in guilds:
+                guilds[guild_id].append(role_id)
 
-        for member in await GuildMember.filter(user__id=client.user_id).select_related("guild"):
-            self.store.subscribe(member.guild.id, None, client.user_id)
-            for role in await member.roles.all():
-                self.store.subscribe(None, role.id, client.user_id)
+        return guilds
 
+    async def authenticated(self, client: GatewayClient, presence: Presence) -> None:
+        self.store.add(client, await self.get_guilds_roles(client.user_id))
+        if self.subscriptions is not None:
+            await self.subscriptions.wait()
+        await self.online(client, presence)
+
+    async def online(self, client: GatewayClient, presence: Presence) -> None:
         if presence:
             await self.ev.presence_update(client.user_id, presence)
             await self.presences.set_or_refresh(client.user_id, presence)
@@ -393,6 +854,32 @@ class Gateway:
         if client in self.store.get(user_id=client.user_id):
             self.store.by_user_id[client.user_id].remove(client)
 
+    def expire_session(self, client: GatewayClient) -> None:
+        if client.connected:
+            return
+        client.expire()
+        self.store.remove(client)
+        self.member_lists.remove_client(client)
+        if not self.store.get(user_id=client.user_id):
+            self.presences.discard_local(client.user_id)
+            self.ev.forget_user(client.user_id)
+
+    def reap(self, client: GatewayClient) -> None:
+        """Called by heartbeat timer wheel for connections that stopped sending heartbeats."""
+        if not client.connected:
+            return
+        self.reaped_clients += 1
+        ws = client.ws
+        client.disconnect()
+        get_running_loop().create_task(ws.close(4009))  # Session timed out, client may not resume
+        self.expire_session(client)
+        if client.user_id is not None and not self.store.get(user_id=client.user_id):
+            get_running_loop().create_task(self.offline(client.user_id))
+
+    async def offline(self, user_id: int) -> None:
+        await self.presences.remove(user_id)
+        await self.ev.presence_update(user_id, Presence(user_id, "offline"))
+
     async def process(self, ws: Websocket, data: dict):
         op = data["op"]
         kwargs = {}
@@ -403,7 +890,7 @@ class Gateway:
             if not _client:
                 await client.send({"op": GatewayOp.INV_SESSION})
                 await client.send({"op": GatewayOp.RECONNECT})
-                return await ws.close(4009)
+                return client.close(4009)
             kwargs["new_client"] = client
             client = _client[0]
 
@@ -412,12 +899,13 @@ class Gateway:
             if func:
                 return await func(data.get("d"), **kwargs)
 
-        print("-" * 16)
-        print(f"  Unknown op code: {op}")
-        print(f"  Data: {data}")
+        # Not closing with 4001: clients send opcodes that are not implemented yet (voice, newer op codes)
+        log.debug("Unknown op code %s, data: %r", op, data)
 
     async def disconnect(self, ws: Websocket):
-        getattr(ws, "_yepcord_client").disconnect()
+        client: GatewayClient = getattr(ws, "_yepcord_client")
+        if client.ws is ws:
+            client.disconnect()
 
     async def getFriendsPresences(self, uid: int) -> list[dict]:
         presences = []
@@ -427,8 +915,9 @@ class Gateway:
             for relationship in await user.get_relationships()
             if relationship.type == RelationshipType.FRIEND
         ]
+        friends_presences = await self.presences.get_many(friends)
         for friend in friends:
-            if presence := await self.presences.get(friend):
+            if presence := friends_presences.get(friend):
                 presences.append({
                     "user_id": str(friend),
                     "status": presence.public_status,
@@ -21,6 +21,7 @@ from quart import Quart, websocket, Websocket
 from tortoise.contrib.quart import register_tortoise
 
 from .compression import WsCompressor
+from .encoding import WsEncoding
 from ..yepcord.config import Config
 from .gateway import Gateway
 
@@ -53,15 +54,28 @@ async def set_cors_headers(response):
     return response
 
 
+@app.get("/metrics")
+async def gateway_metrics():
+    if not Config.GATEWAY_METRICS:
+        return "Not Found", 404
+    return gw.metrics()
+
+
 @app.websocket("/")
 async def ws_gateway():
     # noinspection PyProtectedMember,PyUnresolvedReferences
     ws: Websocket = websocket._get_current_object()
-    setattr(ws, "compressor", WsCompressor.create_compressor(websocket.args.get("compress")))
+    setattr(ws, "compressor", WsCompressor.create_compressor(websocket.args.get("compress"), websocket.args))
+    setattr(ws, "encoding", encoding := WsEncoding.get(websocket.args.get("encoding")))
     await gw.add_client(ws)
     while True:
         try:
-            data = await ws.receive_json()
+            try:
+                data = encoding.decode(await ws.receive())
+            except (ValueError, TypeError, RecursionError):
+                await ws.close(4002)  # Decode error
+                await gw.disconnect(ws)
+                return
             await shield(create_task(gw.process(ws, data)))
         except CancelledError:
             await gw.disconnect(ws)
@@ -0,0 +1,675 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from asyncio import Task, get_running_loop, shield
+from bisect import bisect_left, insort
+from time import time
+from typing import Optional, TYPE_CHECKING, AsyncIterator, Iterable, Callable
+from zlib import crc32
+
+from .events import GuildMembersListUpdateEvent, EncodedDispatchEvent
+from ..yepcord.enums import GuildPermissions
+from ..yepcord.models import Guild, GuildMember, Role, UserData, Channel, PermissionOverwrite
+from ..yepcord.permissions import PermissionEngine, apply_overwrites
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .gateway import GatewayClient
+    from .presences import Presences
+
+Range = tuple[int, int]
+
+# Events that may change member groups (hoisted roles), member visibility (role permissions, channel overwrites)
+# or guild owner, member lists of guild are rebuilt when any of them is received
+INVALIDATE_EVENTS = {
+    "GUILD_UPDATE", "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE", "CHANNEL_UPDATE", "CHANNEL_DELETE",
+}
+
+
+class MemberEntry:
+    __slots__ = ("user_id", "member", "role_ids", "status", "activities",)
+
+    def __init__(self, user_id: int, member: dict, role_ids: list[int], status: str = "offline",
+                 activities: Optional[list] = None):
+        self.user_id = user_id
+        self.member = member
+        self.role_ids = role_ids
+        self.status = status
+        self.activities = activities or []
+
+    @property
+    def name(self) -> str:
+        return (self.member.get("nick") or self.member["user"]["username"]).casefold()
+
+    @property
+    def search_names(self) -> set[str]:
+        names = {self.member["user"]["username"].casefold()}
+        if nick := self.member.get("nick"):
+            names.add(nick.casefold())
+        return names
+
+    def presence(self) -> dict:
+        return {
+            "user": {"id": str(self.user_id)},
+            "status": self.status,
+            "client_status": {} if self.status == "offline" else {"desktop": self.status},
+            "activities": [] if self.status == "offline" else self.activities,
+        }
+
+    def item(self) -> dict:
+        return {"member": self.member | {"presence": self.presence()}}
+
+
+async def load_entries(members: list[GuildMember], presences: Presences, member_roles: dict[int, list[int]] = None,
+                       userdatas: dict[int, UserData] = None) -> list[MemberEntry]:
+    """
+    Creates entries (with member objects and presences) of members with a fixed number of queries.
+    Roles and userdata are loaded by member/user ids if they are not passed.
+    """
+    if not members:
+        return []
+    if member_roles is None:
+        member_roles = {member.user_id: [] for member in members}
+        for user_id, role_id in await GuildMember.filter(id__in=[member.id for member in members]).values_list(
+                "user_id", "roles__id"
+        ):
+            if role_id is not None:
+                member_roles[user_id].append(role_id)
+    if userdatas is None:
+        userdatas = {
+            userdata.id: userdata
+            for userdata in await UserData.filter(id__in=list(member_roles)).select_related("user")
+        }
+    member_presences = await presences.get_many(member_roles)
+
+    entries = []
+    for member in members:
+        if (userdata := userdatas.get(member.user_id)) is None:
+            continue
+        role_ids = member_roles[member.user_id]
+        entry = MemberEntry(member.user_id, member.ds_json_preloaded(role_ids, userdata), role_ids)
+        if (presence := member_presences.get(member.user_id)) is not None:
+            entry.status = presence.public_status
+            entry.activities = presence.activities
+        entries.append(entry)
+
+    return entries
+
+
+class GuildMembers:
+    """Members of guild (with their presences) and everything needed to group them and check channel visibility."""
+
+    __slots__ = ("id", "owner_id", "roles", "hoisted", "entries", "lists", "channels", "_names",)
+
+    def __init__(self, guild_id: int, owner_id: int, roles: dict[int, tuple[int, int, bool]],
+                 entries: dict[int, MemberEntry]):
+        self.id = guild_id
+        self.owner_id = owner_id
+        self.roles = roles
+        self.entries = entries
+        self.lists: dict[str, MemberList] = {}
+        self.channels: dict[Optional[int], str] = {}
+        self._names: Optional[list[tuple[str, int]]] = None
+
+        hoisted = sorted(
+            (role_id for role_id, (_, _, hoist) in roles.items() if hoist and role_id != guild_id),
+            key=lambda role_id: (-roles[role_id][1], role_id)
+        )
+        self.hoisted = {role_id: rank for rank, role_id in enumerate(hoisted)}
+
+    @property
+    def group_ids(self) -> list[str]:
+        return [str(role_id) for role_id in self.hoisted] + ["online", "offline"]
+
+    def permissions(self, entry: MemberEntry) -> int:
+        permissions = self.roles.get(self.id, (0,))[0]
+        for role_id in entry.role_ids:
+            if (role := self.roles.get(role_id)) is not None:
+                permissions |= role[0]
+        return permissions
+
+    def list_id(self, overwrites: list[tuple[int, int, int]]) -> str:
+        """List id is "everyone" if everyone can see channel, otherwise hash of VIEW_CHANNEL overwrites of channel."""
+        rules = []
+        for target_id, allow, deny in overwrites:
+            if allow & GuildPermissions.VIEW_CHANNEL:
+                rules.append(f"allow:{target_id}")
+            elif deny & GuildPermissions.VIEW_CHANNEL:
+                rules.append(f"deny:{target_id}")
+        if not rules and self.roles.get(self.id, (0,))[0] & GuildPermissions.VIEW_CHANNEL:
+            return "everyone"
+        return str(crc32(",".join(sorted(rules)).encode("utf8")))
+
+    def add(self, entry: MemberEntry) -> None:
+        self.entries[entry.user_id] = entry
+        if self._names is not None:
+            for name in entry.search_names:
+                insort(self._names, (name, entry.user_id))
+
+    def remove(self, user_id: int) -> Optional[MemberEntry]:
+        if (entry := self.entries.pop(user_id, None)) is not None and self._names is not None:
+            for name in entry.search_names:
+                del self._names[bisect_left(self._names, (name, user_id))]
+        return entry
+
+    def update(self, entry: MemberEntry, member: dict) -> None:
+        self.remove(entry.user_id)
+        entry.member = member
+        entry.role_ids = [int(role_id) for role_id in member["roles"]]
+        self.add(entry)
+
+    def search(self, query: str, limit: int) -> list[MemberEntry]:
+        """Returns members whose username or nick starts with query (case-insensitive)."""
+        if self._names is None:  # Index is built on first search and then kept up to date by add/remove
+            self._names = sorted(
+                (name, entry.user_id) for entry in self.entries.values() for name in entry.search_names
+            )
+        query = query.casefold()
+        result: dict[int, MemberEntry] = {}
+        for idx in range(bisect_left(self._names, (query,)), len(self._names)):
+            name, user_id = self._names[idx]
+            if len(result) >= limit or not name.startswith(query):
+                break
+            result[user_id] = self.entries[user_id]
+        return list(result.values())
+
+    def get_list(self, list_id: str, overwrites: list[tuple[int, int, int]]) -> MemberList:
+        if (member_list := self.lists.get(list_id)) is None:
+            member_list = self.lists[list_id] = MemberList(self, list_id, overwrites)
+            if list_id == "everyone":
+                member_list.fill(self.entries.values())
+            else:
+                engine = PermissionEngine(
+                    self.id, self.owner_id, {role_id: role[0] for role_id, role in self.roles.items()},
+                    {0: member_list.overwrites}, {user_id: entry.role_ids for user_id, entry in self.entries.items()},
+                )
+                member_list.fill(
+                    self.entries[user_id] for user_id in engine.user_ids_with(0, GuildPermissions.VIEW_CHANNEL)
+                )
+        return member_list
+
+
+class MemberList:
+    """
+    Members of guild that can see channel, sorted by group (highest hoisted role for online members, then "online",
+    then "offline"), name and id. Every non-empty group has a header item right before its members,
+    so member at sorted position i has index i + (number of non-empty groups up to its group).
+    """
+
+    __slots__ = ("guild", "id", "overwrites", "keys", "counts", "member_keys", "subscribers",)
+
+    def __init__(self, guild: GuildMembers, list_id: str, overwrites: list[tuple[int, int, int]]):
+        self.guild = guild
+        self.id = list_id
+        self.overwrites = {
+            target_id: (allow, deny)
+            for target_id, allow, deny in overwrites
+            if (allow | deny) & GuildPermissions.VIEW_CHANNEL
+        }
+        self.keys: list[tuple[int, str, int]] = []
+        self.counts = [0] * (len(guild.hoisted) + 2)
+        self.member_keys: dict[int, tuple[int, str, int]] = {}
+        self.subscribers: dict[GatewayClient, list[Range]] = {}
+
+    @property
+    def member_count(self) -> int:
+        return len(self.keys)
+
+    @property
+    def online_count(self) -> int:
+        return len(self.keys) - self.counts[-1]
+
+    def groups(self) -> list[dict]:
+        return [
+            {"id": group_id, "count": count}
+            for group_id, count in zip(self.guild.group_ids, self.counts)
+            if count
+        ]
+
+    def visible(self, entry: MemberEntry) -> bool:
+        if self.id == "everyone" or entry.user_id == self.guild.owner_id:
+            return True
+        permissions = self.guild.permissions(entry)
+        if permissions & GuildPermissions.ADMINISTRATOR:
+            return True
+
+        permissions = apply_overwrites(permissions, self.guild.id, entry.user_id, entry.role_ids, self.overwrites)
+        return bool(permissions & GuildPermissions.VIEW_CHANNEL)
+
+    def _key(self, entry: MemberEntry) -> tuple[int, str, int]:
+        if entry.status == "offline":
+            rank = len(self.counts) - 1
+        else:
+            rank = min((self.guild.hoisted[role_id] for role_id in entry.role_ids if role_id in self.guild.hoisted),
+                       default=len(self.counts) - 2)
+        return rank, entry.name, entry.user_id
+
+    def _index(self, key: tuple[int, str, int]) -> int:
+        return bisect_left(self.keys, key) + sum(1 for rank in range(key[0] + 1) if self.counts[rank])
+
+    def _header(self, rank: int) -> dict:
+        return {"group": {"id": self.guild.group_ids[rank], "count": self.counts[rank]}}
+
+    def fill(self, entries: Iterable[MemberEntry]) -> None:
+        """Adds members (already checked to be visible) to empty list"""
+        for entry in entries:
+            key = self.member_keys[entry.user_id] = self._key(entry)
+            self.counts[key[0]] += 1
+        self.keys = sorted(self.member_keys.values())
+
+    def insert(self, entry: MemberEntry, ops: Optional[list[dict]] = None) -> None:
+        if not self.visible(entry):
+            return
+        key = self.member_keys[entry.user_id] = self._key(entry)
+        rank = key[0]
+        self.counts[rank] += 1
+        insort(self.keys, key)
+        if ops is None:
+            return
+        index = self._index(key)
+        if self.counts[rank] == 1:
+            ops.append({"op": "INSERT", "index": index - 1, "item": self._header(rank)})
+        ops.append({"op": "INSERT", "index": index, "item": entry.item()})
+
+    def remove(self, user_id: int, ops: Optional[list[dict]] = None) -> None:
+        if (key := self.member_keys.pop(user_id, None)) is None:
+            return
+        index = self._index(key)
+        del self.keys[bisect_left(self.keys, key)]
+        self.counts[key[0]] -= 1
+        if ops is None:
+            return
+        ops.append({"op": "DELETE", "index": index})
+        if not self.counts[key[0]]:
+            ops.append({"op": "DELETE", "index": index - 1})
+
+    def update(self, entry: MemberEntry, ops: list[dict]) -> None:
+        if (key := self.member_keys.get(entry.user_id)) is not None and key == self._key(entry) \
+                and self.visible(entry):
+            ops.append({"op": "UPDATE", "index": self._index(key), "item": entry.item()})
+            return
+        self.remove(entry.user_id, ops)
+        self.insert(entry, ops)
+
+    def items(self, start: int, end: int) -> list[dict]:
+        items = []
+        position = offset = 0
+        for rank, count in enumerate(self.counts):
+            if not count:
+                continue
+            if position > end:
+                break
+            if position + count >= start:
+                if position >= start:
+                    items.append(self._header(rank))
+                first = max(start - position - 1, 0)
+                last = min(end - position - 1, count - 1)
+                items.extend(
+                    self.guild.entries[key[2]].item() for key in self.keys[offset + first:offset + last + 1]
+                )
+            position += count + 1
+            offset += count
+        return items
+
+    def event(self, ops: list[dict]) -> GuildMembersListUpdateEvent:
+        return GuildMembersListUpdateEvent(
+            self.guild.id, self.id, self.member_count, self.online_count, self.groups(), ops
+        )
+
+
+class Subscription:
+    __slots__ = ("channel_id", "member_list", "ranges",)
+
+    def __init__(self, channel_id: Optional[int], member_list: MemberList, ranges: list[Range]):
+        self.channel_id = channel_id
+        self.member_list = member_list
+        self.ranges = ranges
+
+
+class MemberLists:
+    """
+    Member lists (GUILD_MEMBER_LIST_UPDATE) of guilds that sessions of this gateway process are subscribed to
+    with LAZY_REQUEST. Members of guild are loaded once (with a fixed number of queries) and then kept up to date
+    with member add/update/remove and presence events, every change is sent to subscribers as INSERT/UPDATE/DELETE
+    ops (UPDATE only to sessions whose ranges include changed member). Loaded guilds are also used to search members
+    for GUILD_MEMBERS requests. List is dropped when it has no subscribers, guild is dropped when sessions of its
+    members are no longer connected to this process (since events of guild are not received after that). Guilds
+    for which `is_local` returns False can't be kept up to date, so they are only used for member searches and are
+    kept for NON_LOCAL_TTL seconds.
+    """
+
+    MAX_RANGES = 5
+    CHUNK_SIZE = 1000
+    NON_LOCAL_TTL = 10
+
+    def __init__(self, presences: Presences, is_local: Optional[Callable[[int], bool]] = None):
+        self._presences = presences
+        self._is_local = is_local or (lambda guild_id: True)
+        self._guilds: dict[int, GuildMembers] = {}
+        self._non_local: dict[int, tuple[float, GuildMembers]] = {}
+        self._user_guilds: dict[int, set[int]] = {}
+        self._clients: dict[GatewayClient, dict[int, Subscription]] = {}
+        self._loading: dict[int, Task] = {}
+        self._dirty: set[int] = set()
+        self._dropped: set[int] = set()
+        self._loading_presences: dict[int, tuple[str, list]] = {}
+        self.loads = 0
+
+    def __len__(self) -> int:
+        return len(self._guilds)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._guilds
+
+    @property
+    def list_count(self) -> int:
+        return sum(len(guild.lists) for guild in self._guilds.values())
+
+    async def _load_guild(self, guild_id: int) -> Optional[GuildMembers]:
+        owner_id = await Guild.filter(id=guild_id).values_list("owner_id", flat=True)
+        if not owner_id:
+            return
+        roles = {
+            role_id: (permissions, position, hoist)
+            for role_id, permissions, position, hoist in await Role.filter(guild_id=guild_id).values_list(
+                "id", "permissions", "position", "hoist"
+            )
+        }
+        members = await GuildMember.filter(guild_id=guild_id)
+        member_roles = {member.user_id: [] for member in members}
+        for user_id, role_id in await GuildMember.filter(guild_id=guild_id).values_list("user_id", "roles__id"):
+            if role_id is not None:
+                member_roles[user_id].append(role_id)
+        userdatas = {
+            userdata.id: userdata
+            for userdata in await UserData.filter(user__guildmembers__guild_id=guild_id).select_related("user")
+        }
+        entries = await load_entries(members, self._presences, member_roles, userdatas)
+
+        self.loads += 1
+        return GuildMembers(guild_id, owner_id[0], roles, {entry.user_id: entry for entry in entries})
+
+    async def _load(self, guild_id: int) -> Optional[GuildMembers]:
+        try:
+            while True:  # Member events received while guild was loading may be missing from loaded guild
+                self._dirty.discard(guild_id)
+                guild = await self._load_guild(guild_id)
+                if guild_id not in self._dirty:
+                    break
+            if guild is None:
+                return
+            if guild_id in self._dropped:  # Returned to waiting requests, but not kept
+                return guild
+            if not self._is_local(guild_id):
+                now = time()
+                self._non_local = {
+                    non_local_id: (expires_at, non_local)
+                    for non_local_id, (expires_at, non_local) in self._non_local.items() if expires_at > now
+                }
+                self._non_local[guild_id] = (now + self.NON_LOCAL_TTL, guild)
+                return guild
+
+            for user_id, (status, activities) in self._loading_presences.items():
+                if (entry := guild.entries.get(user_id)) is not None:
+                    entry.status = status
+                    entry.activities = activities
+            self._guilds[guild_id] = guild
+            for user_id in guild.entries:
+                self._user_guilds.setdefault(user_id, set()).add(guild_id)
+            return guild
+        finally:
+            del self._loading[guild_id]
+            self._dropped.discard(guild_id)
+            if not self._loading:
+                self._loading_presences.clear()
+
+    async def _get_guild(self, guild_id: int) -> Optional[GuildMembers]:
+        if (guild := self._guilds.get(guild_id)) is not None:
+            return guild
+        if (non_local := self._non_local.pop(guild_id, None)) is not None:
+            expires_at, guild = non_local
+            if expires_at > time() and not self._is_local(guild_id):
+                self._non_local[guild_id] = non_local
+                return guild
+        if (task := self._loading.get(guild_id)) is None:
+            task = self._loading[guild_id] = get_running_loop().create_task(self._load(guild_id))
+        return await shield(task)
+
+    async def _get_list(self, guild: GuildMembers, channel_id: Optional[int]) -> Optional[MemberList]:
+        if (list_id := guild.channels.get(channel_id)) is not None and list_id in guild.lists:
+            return guild.lists[list_id]
+
+        overwrites = []
+        if channel_id is not None:
+            if not await Channel.exists(id=channel_id, guild_id=guild.id):
+                return
+            overwrites = [
+                (role_id or user_id, allow, deny)
+                for role_id, user_id, allow, deny in await PermissionOverwrite.filter(channel_id=channel_id)
+                .values_list("target_role_id", "target_user_id", "allow", "deny")
+            ]
+        if self._guilds.get(guild.id) is not guild:  # Guild was invalidated while overwrites were loading
+            return
+
+        list_id = guild.channels[channel_id] = guild.list_id(overwrites)
+        return guild.get_list(list_id, overwrites)
+
+    def _drop_guild(self, guild_id: int) -> Optional[GuildMembers]:
+        if (guild := self._guilds.pop(guild_id, None)) is None:
+            return
+        for user_id in guild.entries:
+            if (guilds := self._user_guilds.get(user_id)) is not None:
+                guilds.discard(guild_id)
+                if not guilds:
+                    del self._user_guilds[user_id]
+        return guild
+
+    def _unsubscribe(self, client: GatewayClient, guild_id: int) -> None:
+        if (subscription := self._clients.get(client, {}).pop(guild_id, None)) is None:
+            return
+        if not self._clients[client]:
+            del self._clients[client]
+
+        member_list = subscription.member_list
+        member_list.subscribers.pop(client, None)
+        guild = member_list.guild
+        if not member_list.subscribers and guild.lists.get(member_list.id) is member_list:
+            del guild.lists[member_list.id]
+
+    async def subscribe(self, client: GatewayClient, guild_id: int, channel_id: Optional[int],
+                        ranges: list[Range]) -> None:
+        """Subscribes client to member list of channel, sends SYNC for every requested range."""
+        if not self._is_local(guild_id):  # Lists of guild could not be updated
+            return
+        if (guild := await self._get_guild(guild_id)) is None or (entry := guild.entries.get(client.user_id)) is None:
+            return
+        if (member_list := await self._get_list(guild, channel_id)) is None or not member_list.visible(entry):
+            return
+
+        ops = []
+        previous = self._clients.get(client, {}).get(guild_id)
+        if previous is not None and previous.member_list is member_list:
+            ops.extend({"op": "INVALIDATE", "range": list(range_)} for range_ in previous.ranges
+                       if range_ not in ranges)
+        if previous is not None:
+            self._unsubscribe(client, guild_id)
+
+        ops.extend({"op": "SYNC", "range": list(range_), "items": member_list.items(*range_)} for range_ in ranges)
+        member_list.subscribers[client] = ranges
+        self._clients.setdefault(client, {})[guild_id] = Subscription(channel_id, member_list, ranges)
+        await client.esend(member_list.event(ops))
+
+    async def search(self, guild_id: int, query: str, limit: int) -> list[MemberEntry]:
+        if (guild := await self._get_guild(guild_id)) is None:
+            return []
+        return guild.search(query, limit)
+
+    async def load_members(self, guild_id: int, user_ids: list[int]) -> list[MemberEntry]:
+        return await load_entries(
+            await GuildMember.filter(guild_id=guild_id, user_id__in=user_ids).order_by("id"), self._presences
+        )
+
+    async def iter_chunks(self, guild_id: int) -> AsyncIterator[tuple[int, int, list[MemberEntry]]]:
+        """
+        Yields (chunk index, chunk count, entries) for all members of guild. Members are loaded page by page
+        (keyset pagination by member id), so only one chunk of members is kept in memory at a time.
+        """
+        chunk_count = max((await GuildMember.filter(guild_id=guild_id).count() - 1) // self.CHUNK_SIZE + 1, 1)
+        last_id = 0
+        for chunk_index in range(chunk_count):
+            members = await GuildMember.filter(guild_id=guild_id, id__gt=last_id).order_by("id").limit(self.CHUNK_SIZE)
+            if members:
+                last_id = members[-1].id
+            yield chunk_index, chunk_count, await load_entries(members, self._presences)
+
+    def remove_client(self, client: GatewayClient) -> None:
+        for guild_id in list(self._clients.get(client, {})):
+            self._unsubscribe(client, guild_id)
+
+    async def _send_ops(self, member_list: MemberList, ops: list[dict]) -> None:
+        if not ops:
+            return
+        events: dict[tuple[int, ...], EncodedDispatchEvent] = {}
+        for client, ranges in list(member_list.subscribers.items()):
+            client_ops = tuple(
+                idx for idx, op in enumerate(ops)
+                if op["op"] != "UPDATE" or any(start <= op["index"] <= end for start, end in ranges)
+            )
+            if not client_ops:
+                continue
+            if (event := events.get(client_ops)) is None:
+                event = events[client_ops] = EncodedDispatchEvent(
+                    await member_list.event([ops[idx] for idx in client_ops]).json()
+                )
+            await client.esend(event)
+
+    async def _update(self, guild: GuildMembers, entry: MemberEntry) -> None:
+        for member_list in list(guild.lists.values()):
+            ops = []
+            member_list.update(entry, ops)
+            await self._send_ops(member_list, ops)
+
+    async def presence_update(self, user_id: int, status: str, activities: list) -> None:
+        if self._loading:
+            self._loading_presences[user_id] = (status, activities)
+        for guild_id in list(self._user_guilds.get(user_id, ())):
+            guild = self._guilds[guild_id]
+            entry = guild.entries[user_id]
+            if entry.status == status and entry.activities == activities:
+                continue
+            entry.status = status
+            entry.activities = activities
+            await self._update(guild, entry)
+
+    async def member_add(self, guild_id: int, member: dict) -> None:
+        if guild_id in self._loading:
+            self._dirty.add(guild_id)
+        if (guild := self._guilds.get(guild_id)) is None:
+            return
+        user_id = int(member["user"]["id"])
+        if user_id in guild.entries:
+            return await self.member_update(guild_id, member)
+
+        entry = MemberEntry(user_id, member, [int(role_id) for role_id in member["roles"]])
+        if (presence := await self._presences.get(user_id)) is not None:
+            entry.status = presence.public_status
+            entry.activities = presence.activities
+        if self._guilds.get(guild_id) is not guild or user_id in guild.entries:
+            return
+        guild.add(entry)
+        self._user_guilds.setdefault(user_id, set()).add(guild_id)
+        for member_list in list(guild.lists.values()):
+            ops = []
+            member_list.insert(entry, ops)
+            await self._send_ops(member_list, ops)
+
+    async def member_update(self, guild_id: int, member: dict) -> None:
+        if guild_id in self._loading:
+            self._dirty.add(guild_id)
+        if (guild := self._guilds.get(guild_id)) is None:
+            return
+        user_id = int(member["user"]["id"])
+        if (entry := guild.entries.get(user_id)) is None:
+            return await self.member_add(guild_id, member)
+
+        guild.update(entry, member)
+        await self._update(guild, entry)
+
+    async def member_remove(self, guild_id: int, user_id: int) -> None:
+        if guild_id in self._loading:
+            self._dirty.add(guild_id)
+        if (guild := self._guilds.get(guild_id)) is None or guild.remove(user_id) is None:
+            return
+        if (guilds := self._user_guilds.get(user_id)) is not None:
+            guilds.discard(guild_id)
+            if not guilds:
+                del self._user_guilds[user_id]
+
+        for client, subscriptions in list(self._clients.items()):
+            if client.user_id == user_id and guild_id in subscriptions:
+                self._unsubscribe(client, guild_id)
+        for member_list in list(guild.lists.values()):
+            ops = []
+            member_list.remove(user_id, ops)
+            await self._send_ops(member_list, ops)
+
+    def invalidate(self, guild_id: int) -> None:
+        """Drops members of guild and sends every subscriber of its lists a new SYNC of subscribed ranges."""
+        if guild_id in self._loading:
+            self._dirty.add(guild_id)
+        if self._drop_guild(guild_id) is None:
+            return
+        subscriptions = [
+            (client, subscriptions[guild_id])
+            for client, subscriptions in self._clients.items()
+            if guild_id in subscriptions
+        ]
+        get_running_loop().create_task(self._resync(guild_id, subscriptions))
+
+    async def _resync(self, guild_id: int, subscriptions: list[tuple[GatewayClient, Subscription]]) -> None:
+        for client, subscription in subscriptions:
+            if self._clients.get(client, {}).get(guild_id) is not subscription:
+                continue  # Client is already subscribed to another list (or unsubscribed)
+            self._unsubscribe(client, guild_id)
+            await self.subscribe(client, guild_id, subscription.channel_id, subscription.ranges)
+
+    def drop_guild(self, guild_id: int) -> None:
+        if guild_id in self._loading:
+            self._dropped.add(guild_id)
+        self._drop_guild(guild_id)
+        for client, subscriptions in list(self._clients.items()):
+            if guild_id in subscriptions:
+                self._unsubscribe(client, guild_id)
+
+    async def handle_event(self, body: dict) -> None:
+        """Applies dispatched event (received from broker) to member lists."""
+        if not self._guilds and not self._loading:
+            return
+        name = body["data"]["t"]
+        data = body["data"]["d"]
+        if name == "GUILD_MEMBER_ADD":
+            await self.member_add(int(data["guild_id"]), {k: v for k, v in data.items() if k != "guild_id"})
+        elif name == "GUILD_MEMBER_UPDATE":
+            await self.member_update(int(data["guild_id"]), {k: v for k, v in data.items() if k != "guild_id"})
+        elif name == "GUILD_MEMBER_REMOVE":
+            await self.member_remove(int(data["guild_id"]), int(data["user"]["id"]))
+        elif name == "GUILD_DELETE":
+            self.drop_guild(int(data["id"]))
+        elif name in INVALIDATE_EVENTS and (guild_id := body.get("guild_changed")) is not None:
+            self.invalidate(guild_id)
@@ -18,8 +18,11 @@
 
 from __future__ import annotations
 
+import warnings
+from asyncio import get_running_loop, shield, sleep, Task, TimerHandle, AbstractEventLoop
 from json import loads, dumps
-from typing import Optional, TYPE_CHECKING
+from time import monotonic
+from typing import Optional, TYPE_CHECKING, Iterable
 
 from ..yepcord.config import Config
 
@@ -55,8 +58,28 @@ class Presence:
 
 
 class Presences:
+    """
+    Presences are stored in redis, so they are visible to every gateway process.
+    Presences of users connected to this process are also kept in memory (these are authoritative, since only this
+    process changes them), presences of other users are cached for GATEWAY_PRESENCE_CACHE_TTL seconds or until
+    PRESENCE_UPDATE of that user is received from the broker.
+    Writes of all sessions are queued and sent to redis in a single pipeline.
+    """
+
+    WRITE_INTERVAL = 1.0
+
     def __init__(self, gateway: Gateway):
         self._gateway = gateway
+        self._local: dict[int, Presence] = {}
+        self._remote: dict[int, tuple[Optional[Presence], float]] = {}
+        self._next_prune = 0.0
+        self._writes: dict[int, tuple[Optional[Presence], bool]] = {}
+        self._flush_task: Optional[Task] = None
+        self._flush_handle: Optional[TimerHandle] = None
+        self._flush_loop: Optional[AbstractEventLoop] = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
 
     #async def _expiration_handler(self, message: dict[str, str]) -> None:
     #    if "presence_" not in message["data"]:
@@ -64,21 +87,134 @@ class Presences:
     #    user_id = int(message["data"][9:])
     #    await self._gateway.ev.presence_update(user_id, Presence(user_id, "offline"))
 
+    def _queue_write(self, user_id: int, presence: Optional[Presence], overwrite: bool) -> None:
+        if presence is None:
+            self._local.pop(user_id, None)
+        elif overwrite or user_id not in self._local:
+            self._local[user_id] = presence
+        self._remote.pop(user_id, None)
+
+        if overwrite or user_id not in self._writes:
+            self._writes[user_id] = (presence, overwrite)
+
+    def refresh(self, user_id: int, presence: Presence = None) -> None:
+        """
+        Queues refresh of presence without waiting for it to be written (used for heartbeats).
+        Queued refreshes of all sessions are written with a single pipeline every WRITE_INTERVAL seconds.
+        """
+        self._queue_write(user_id, presence, False)
+        loop = get_running_loop()
+        if self._flush_handle is None or self._flush_loop is not loop:
+            self._flush_loop = loop
+            self._flush_handle = loop.call_later(self.WRITE_INTERVAL, self._start_flush)
+
     async def set_or_refresh(self, user_id: int, presence: Presence = None, overwrite=False):
+        self._queue_write(user_id, presence, overwrite)
+        await self.flush()
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        get_running_loop().create_task(self._flush_queued())
+
+    async def _flush_queued(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            warnings.warn(f"Failed to write presences: {e.__class__.__name__}: {e}.")
+
+    async def flush(self) -> None:
+        if self._flush_task is None or self._flush_task.get_loop() is not get_running_loop():
+            self._flush_task = get_running_loop().create_task(self._write_pending())
+        await shield(self._flush_task)
+
+    async def _write_pending(self) -> None:
+        await sleep(0)  # Let writes from other sessions made in this loop iteration join the pipeline
+        self._flush_task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        writes, self._writes = self._writes, {}
+        if not writes:
+            return
+
+        ex = int(Config.GATEWAY_KEEP_ALIVE_DELAY * 1.25)
         pipe = self._gateway.redis.pipeline()
-        await pipe.set(
-            f"presence_{user_id}",
-            dumps({
-                "status": presence.status if presence else "offline",
-                "activities": presence.activities if presence else [],
-            }),
-            ex=int(Config.GATEWAY_KEEP_ALIVE_DELAY * 1.25),
-            nx=not overwrite,
-        )
-        await pipe.expire(f"presence_{user_id}", int(Config.GATEWAY_KEEP_ALIVE_DELAY * 1.25))
+        for user_id, (presence, overwrite) in writes.items():
+            await pipe.set(
+                f"presence_{user_id}",
+                dumps({
+                    "status": presence.status if presence else "offline",
+                    "activities": presence.activities if presence else [],
+                }),
+                ex=ex,
+                nx=not overwrite,
+            )
+            await pipe.expire(f"presence_{user_id}", ex)
         await pipe.execute()
+        self.writes += 1
 
-    async def get(self, user_id: int) -> Optional[Presence]:
-        if (presence := await self._gateway.redis.get(f"presence_{user_id}")) is None:
+    def _get_cached(self, user_id: int, now: float) -> tuple[bool, Optional[Presence]]:
+        if user_id in self._local and any(client.connected for client in self._gateway.store.get(user_id=user_id)):
+            return True, self._local[user_id]
+        if (cached := self._remote.get(user_id)) is not None and cached[1] > now:
+            return True, cached[0]
+        return False, None
+
+    def _prune(self, now: float) -> None:
+        if now < self._next_prune:
             return
-        return Presence(user_id, **loads(presence))
+        self._next_prune = now + Config.GATEWAY_PRESENCE_CACHE_TTL
+        self._remote = {user_id: cached for user_id, cached in self._remote.items() if cached[1] > now}
+
+    async def get(self, user_id: int) -> Optional[Presence]:
+        return (await self.get_many([user_id])).get(user_id)
+
+    async def get_many(self, user_ids: Iterable[int]) -> dict[int, Presence]:
+        now = monotonic()
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            cached, presence = self._get_cached(user_id, now)
+            if not cached:
+                missing.append(user_id)
+                continue
+            self.hits += 1
+            if presence is not None:
+                result[user_id] = presence
+
+        self.misses += len(missing)
+        if not missing:
+            return result
+
+        values = await self._gateway.redis.mget([f"presence_{user_id}" for user_id in missing])
+        expires_at = monotonic() + Config.GATEWAY_PRESENCE_CACHE_TTL
+        for user_id, presence in zip(missing, values):
+            if presence is not None:
+                presence = result[user_id] = Presence(user_id, **loads(presence))
+            if Config.GATEWAY_PRESENCE_CACHE_TTL > 0:
+                self._remote[user_id] = (presence, expires_at)
+
+        self._prune(now)
+        return result
+
+    def invalidate(self, user_id: int) -> None:
+        self._remote.pop(user_id, None)
+
+    def discard_local(self, user_id: int) -> None:
+        self._local.pop(user_id, None)
+
+    async def remove(self, user_id: int) -> None:
+        self._local.pop(user_id, None)
+        self._remote.pop(user_id, None)
+        self._writes.pop(user_id, None)
+        await self._gateway.redis.delete(f"presence_{user_id}")
+
+    def metrics(self) -> dict:
+        return {
+            "local": len(self._local),
+            "remote": len(self._remote),
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending_writes": len(self._writes),
+            "write_pipelines": self.writes,
+        }
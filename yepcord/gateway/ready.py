@@ -0,0 +1,329 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import datetime
+from typing import Iterable, Optional, Union
+
+from tortoise.expressions import Q
+from tortoise.functions import Max, Count
+
+from ..yepcord.config import Config
+from ..yepcord.enums import ChannelType, RelationshipType, GuildPermissions
+from ..yepcord.models import User, UserData, Guild, GuildMember, Channel, Role, Sticker, Emoji, GuildEvent, \
+    ThreadMember, PermissionOverwrite, Message, HiddenDmChannel, ReadState, Relationship
+from ..yepcord.permissions import PermissionEngine
+from ..yepcord.snowflake import Snowflake
+
+
+class GuildCache:
+    """
+    Guild sections of READY/GUILD_CREATE (everything except per-user joined_at and threads), shared by all sessions
+    of this gateway process. Every cached guild has a version, which is bumped (and cached guild is dropped) when
+    GatewayDispatcher dispatches event that changes guild (see GUILD_CACHE_EVENTS), so guild loaded while it was
+    changed is not cached. Only guilds that have connected members are cached, since only events of these guilds
+    are guaranteed to be received by this process, other guilds are dropped with invalidate().
+    """
+
+    def __init__(self):
+        self._guilds: dict[int, dict] = {}
+        self._channels: dict[int, dict] = {}
+        self._versions: dict[int, int] = {}
+        self._loading: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._guilds)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._guilds
+
+    def get_many(self, guild_ids: Iterable[int]) -> dict[int, dict]:
+        result = {}
+        for guild_id in guild_ids:
+            if (guild := self._guilds.get(guild_id)) is not None:
+                result[guild_id] = guild
+        self.hits += len(result)
+        return result
+
+    def start_loading(self, guild_ids: list[int]) -> dict[int, int]:
+        self.misses += len(guild_ids)
+        for guild_id in guild_ids:
+            self._loading[guild_id] = self._loading.get(guild_id, 0) + 1
+        return {guild_id: self._versions.setdefault(guild_id, 0) for guild_id in guild_ids}
+
+    def finish_loading(self, versions: dict[int, int], guilds: dict[int, dict]) -> None:
+        for guild_id, version in versions.items():
+            if (guild := guilds.get(guild_id)) is not None and self._versions.get(guild_id) == version:
+                self._drop(guild_id)
+                self._guilds[guild_id] = guild
+                for channel in guild["channels"]:
+                    self._channels[int(channel["id"])] = channel
+
+            self._loading[guild_id] -= 1
+            if not self._loading[guild_id]:
+                del self._loading[guild_id]
+                if guild_id not in self._guilds:
+                    self._versions.pop(guild_id, None)
+
+    def _drop(self, guild_id: int) -> None:
+        if (guild := self._guilds.pop(guild_id, None)) is None:
+            return
+        for channel in guild["channels"]:
+            self._channels.pop(int(channel["id"]), None)
+
+    def invalidate(self, guild_id: int) -> None:
+        self._drop(guild_id)
+        if guild_id in self._loading:
+            self._versions[guild_id] += 1
+        else:
+            self._versions.pop(guild_id, None)
+
+    def set_last_message_id(self, channel_id: int, message_id: int) -> None:
+        if (channel := self._channels.get(channel_id)) is not None and "last_message_id" in channel:
+            channel["last_message_id"] = str(message_id)
+
+    def delete_messages(self, guild_id: int, channel_id: int, message_ids: list[Union[int, str]]) -> None:
+        """Drops guild if last message of its channel was deleted, since previous message of channel is unknown"""
+        if guild_id in self._loading:  # Loaded guild may still have deleted message as last one
+            self.invalidate(guild_id)
+        elif (channel := self._channels.get(channel_id)) is not None \
+                and channel.get("last_message_id") in {str(message_id) for message_id in message_ids}:
+            self.invalidate(guild_id)
+
+
+class ReadyLoader:
+    """
+    Loads guilds, private channels, read states, relationships and related users of READY event.
+    Every collection is fetched for all guilds/channels of user with one query, so number of queries
+    does not depend on number of guilds or channels user has.
+    With lazy guilds, READY only gets unavailable guild stubs and full guilds are loaded later (in batches)
+    with load_guilds and sent as GUILD_CREATE events.
+    If cache is passed, guilds found in it are not loaded from database.
+    With GATEWAY_HIDE_INACCESSIBLE_CHANNELS, channels user can not view are removed from (shared) guild objects.
+    """
+
+    __slots__ = ("user", "cache", "_userdata",)
+
+    def __init__(self, user: User, cache: Optional[GuildCache] = None):
+        self.user = user
+        self.cache = cache
+        self._userdata: dict[int, UserData] = {}
+
+    async def load(self, lazy_guilds: bool = False) -> dict:
+        if lazy_guilds:
+            guilds = [
+                {"id": str(guild_id), "unavailable": True}
+                for guild_id in await GuildMember.filter(user_id=self.user.id).values_list("guild_id", flat=True)
+            ]
+        else:
+            guilds = await self.load_guilds()
+        relationships = await self._load_relationships()
+        private_channels = await self._load_private_channels()
+        read_states = await self._load_read_states()
+
+        related_ids = await self.user.get_related_user_ids()
+        await self._load_userdata(related_ids)
+
+        return {
+            "users": [self._userdata[user_id].ds_json for user_id in sorted(related_ids) if user_id in self._userdata],
+            "guilds": guilds,
+            "relationships": relationships,
+            "private_channels": private_channels,
+            "read_states": read_states,
+        }
+
+    async def _load_userdata(self, user_ids: Iterable[int]) -> None:
+        user_ids = set(user_ids) - self._userdata.keys()
+        if not user_ids:
+            return
+        for userdata in await UserData.filter(id__in=user_ids).select_related("user"):
+            self._userdata[userdata.id] = userdata
+
+    @staticmethod
+    async def _last_message_ids(channel_ids: list[int]) -> dict[int, int]:
+        if not channel_ids:
+            return {}
+        return dict(
+            await Message.filter(channel_id__in=channel_ids).annotate(last_id=Max("id")).group_by("channel_id")
+            .values_list("channel_id", "last_id")
+        )
+
+    async def load_guilds(self, guild_ids: Optional[list[int]] = None) -> list[dict]:
+        members = GuildMember.filter(user_id=self.user.id)
+        if guild_ids is not None:
+            members = members.filter(guild_id__in=guild_ids)
+        members = await members.values_list("guild_id", "id")
+        if not members:
+            return []
+        guild_ids = [guild_id for guild_id, _ in members]
+
+        guilds = self.cache.get_many(guild_ids) if self.cache is not None else {}
+        if missing := [guild_id for guild_id in guild_ids if guild_id not in guilds]:
+            if self.cache is None:
+                guilds |= await self._load_guilds(missing)
+            else:
+                versions = self.cache.start_loading(missing)
+                loaded = {}
+                try:
+                    guilds |= (loaded := await self._load_guilds(missing))
+                finally:
+                    self.cache.finish_loading(versions, loaded)
+
+        channels = {}
+        if Config.GATEWAY_HIDE_INACCESSIBLE_CHANNELS:
+            channels = await self._visible_channels(guilds)
+
+        threads = {guild_id: [] for guild_id in guild_ids}
+        for thread in await ThreadMember.filter(guild_id__in=guild_ids, user_id=self.user.id).select_related(
+                "channel", "user", "guild"
+        ):
+            threads[thread.guild_id].append(thread.ds_json())
+
+        return [
+            guilds[guild_id] | {
+                "joined_at": Snowflake.toDatetime(member_id).strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
+                "threads": threads[guild_id],
+                **({"channels": channels[guild_id]} if guild_id in channels else {}),
+            }
+            for guild_id, member_id in members
+            if guild_id in guilds
+        ]
+
+    async def _visible_channels(self, guilds: dict[int, dict]) -> dict[int, list[dict]]:
+        if not guilds:
+            return {}
+        member_roles = {guild_id: [] for guild_id in guilds}
+        for guild_id, role_id in await GuildMember.filter(user_id=self.user.id, guild_id__in=list(guilds)) \
+                .values_list("guild_id", "roles__id"):
+            if role_id is not None:
+                member_roles[guild_id].append(role_id)
+
+        result = {}
+        for guild_id, guild in guilds.items():
+            engine = PermissionEngine.from_guild_json(guild, {self.user.id: member_roles[guild_id]})
+            visible = set(engine.channels_with(
+                self.user.id, [int(channel["id"]) for channel in guild["channels"]], GuildPermissions.VIEW_CHANNEL,
+            ))
+            result[guild_id] = [channel for channel in guild["channels"] if int(channel["id"]) in visible]
+        return result
+
+    async def _load_guilds(self, guild_ids: list[int]) -> dict[int, dict]:
+        """Loads guild sections of READY that are the same for every member (everything except joined_at/threads)"""
+        guilds = await Guild.filter(id__in=guild_ids).select_related("owner")
+        stickers = await Sticker.filter(guild_id__in=guild_ids).select_related("guild")
+        roles = await Role.filter(guild_id__in=guild_ids)
+        member_counts = dict(
+            await GuildMember.filter(guild_id__in=guild_ids).annotate(count=Count("id")).group_by("guild_id")
+            .values_list("guild_id", "count")
+        )
+        events = await GuildEvent.filter(guild_id__in=guild_ids).select_related("channel", "guild", "creator")
+        emojis = await Emoji.filter(guild_id__in=guild_ids)
+        channels = await Channel.filter(guild_id__in=guild_ids) \
+            .exclude(type__in=[ChannelType.GUILD_PUBLIC_THREAD, ChannelType.GUILD_PRIVATE_THREAD]) \
+            .select_related("guild", "parent")
+        channel_ids = [channel.id for channel in channels]
+        overwrites = {channel_id: [] for channel_id in channel_ids}
+        if channel_ids:
+            for overwrite in await PermissionOverwrite.filter(channel_id__in=channel_ids) \
+                    .select_related("target_role", "target_user"):
+                overwrites[overwrite.channel_id].append(overwrite.ds_json())
+        last_message_ids = await self._last_message_ids(channel_ids)
+        await self._load_userdata(sticker.user_id for sticker in stickers if sticker.user_id is not None)
+
+        collections = {guild.id: {
+            "stickers": [], "roles": [], "events": [], "emojis": [], "channels": [],
+        } for guild in guilds}
+        for sticker in stickers:
+            data = await sticker.ds_json(with_user=False)
+            if sticker.user_id is not None and sticker.user_id in self._userdata:
+                data["user"] = self._userdata[sticker.user_id].ds_json
+            collections[sticker.guild_id]["stickers"].append(data)
+        for role in roles:
+            collections[role.guild_id]["roles"].append(role.ds_json())
+        for event in events:
+            collections[event.guild_id]["events"].append(await event.ds_json())
+        for emoji in emojis:
+            collections[emoji.guild_id]["emojis"].append(await emoji.ds_json(False))
+        for channel in channels:
+            collections[channel.guild_id]["channels"].append(channel.ds_json_preloaded(
+                last_message_ids.get(channel.id), [], overwrites[channel.id],
+            ))
+
+        result = {}
+        for guild in guilds:
+            guild_collections = collections[guild.id]
+            result[guild.id] = guild.ds_json_preloaded(
+                stickers=guild_collections["stickers"],
+                roles=guild_collections["roles"],
+                member_count=member_counts.get(guild.id, 0),
+                events=guild_collections["events"],
+                emojis=guild_collections["emojis"],
+                for_gateway=True,
+            )
+            result[guild.id]["channels"] = guild_collections["channels"]
+
+        return result
+
+    async def _load_relationships(self) -> list[dict]:
+        return [
+            await relationship.ds_json(self.user)
+            for relationship in await Relationship.filter(
+                Q(from_user=self.user) | Q(to_user=self.user)
+            ).select_related("from_user", "to_user")
+            if not (relationship.type == RelationshipType.BLOCK and relationship.from_user.id != self.user.id)
+        ]
+
+    async def _load_private_channels(self) -> list[dict]:
+        hidden = set(await HiddenDmChannel.filter(user_id=self.user.id).values_list("channel_id", flat=True))
+        channels = [
+            channel
+            for channel in await Channel.filter(recipients__id=self.user.id).select_related("owner")
+            if channel.id not in hidden
+        ]
+        if not channels:
+            return []
+
+        channel_ids = [channel.id for channel in channels]
+        recipients = {channel_id: [] for channel_id in channel_ids}
+        for channel_id, recipient_id in await Channel.filter(id__in=channel_ids).values_list("id", "recipients__id"):
+            if recipient_id is not None and recipient_id != self.user.id:
+                recipients[channel_id].append(recipient_id)
+        last_message_ids = await self._last_message_ids(channel_ids)
+
+        return [
+            channel.ds_json_preloaded(last_message_ids.get(channel.id), recipients[channel.id], [])
+            for channel in channels
+        ]
+
+    async def _load_read_states(self) -> list[dict]:
+        if self.user.is_bot:
+            return []
+
+        states = await ReadState.filter(user_id=self.user.id).select_related("channel")
+        if not states:
+            return []
+
+        last_pins: dict[int, Optional[datetime]] = {}
+        for channel_id, pinned_timestamp in await Message.filter(
+                channel_id__in=[state.channel.id for state in states], pinned_timestamp__not_isnull=True,
+        ).values_list("channel_id", "pinned_timestamp"):
+            if channel_id not in last_pins or pinned_timestamp > last_pins[channel_id]:
+                last_pins[channel_id] = pinned_timestamp
+
+        return [state.ds_json_preloaded(last_pins.get(state.channel.id)) for state in states]
@@ -0,0 +1,79 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Iterable
+
+from ..yepcord.models import User
+
+
+class RelatedUsers:
+    """
+    Users related to users of this gateway process (friends, pending requests and dm recipients), i.e. users that
+    receive their presence updates. Related users are loaded from database once and then kept up to date by "related"
+    system events, dispatched by code that creates or removes relationships and dm channels.
+    """
+
+    def __init__(self):
+        self._graph: dict[int, set[int]] = {}
+        self._loading: set[int] = set()
+        self._changed: set[int] = set()
+        self.loads = 0
+
+    def __len__(self) -> int:
+        return len(self._graph)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._graph
+
+    async def get(self, user_id: int) -> set[int]:
+        while (related := self._graph.get(user_id)) is None:
+            self._changed.discard(user_id)
+            self._loading.add(user_id)
+            try:
+                related = await User(id=user_id).get_related_user_ids()
+            finally:
+                self._loading.discard(user_id)
+            self.loads += 1
+            if user_id not in self._changed:  # Otherwise relations were changed while loading, so load them again
+                self._graph[user_id] = related
+
+        return related
+
+    def update(self, user_ids: Iterable[int], other_ids: Iterable[int], removed: bool = False) -> None:
+        user_ids = set(user_ids)
+        other_ids = set(other_ids)
+        affected = user_ids | other_ids
+        self._changed.update(affected & self._loading)
+
+        if removed:
+            # User may still be related through another relationship or dm channel, so related users are reloaded
+            for user_id in affected:
+                self._graph.pop(user_id, None)
+            return
+
+        for user_id in user_ids:
+            for other_id in other_ids:
+                if user_id == other_id:
+                    continue
+                if user_id in self._graph:
+                    self._graph[user_id].add(other_id)
+                if other_id in self._graph:
+                    self._graph[other_id].add(user_id)
+
+    def discard(self, user_id: int) -> None:
+        self._graph.pop(user_id, None)
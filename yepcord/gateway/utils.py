@@ -15,8 +15,11 @@
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from asyncio import get_running_loop, AbstractEventLoop, TimerHandle
+from collections import deque
 from enum import Enum, auto
-from typing import Optional
+from math import ceil
+from typing import Optional, Iterator, Callable, Hashable, Union
 from zlib import compressobj, Z_FULL_FLUSH
 
 from redis.asyncio import Redis
@@ -28,7 +31,7 @@ from ..yepcord.utils import b64decode
 def require_auth(func):
     async def wrapped(self, *args, **kwargs):
         if self.user_id is None:
-            return self.ws.close(4005)
+            return self.close(4005)
         return await func(self, *args, **kwargs)
 
     return wrapped
@@ -74,3 +77,113 @@ class ZlibCompressor:
 
     def __call__(self, data):
         return self._obj.compress(data) + self._obj.flush(Z_FULL_FLUSH)
+
+
+def byte_size(data: Union[str, bytes]) -> int:
+    """Size of payload as it is sent over websocket (utf8 encoded)"""
+    if isinstance(data, str) and not data.isascii():
+        return len(data.encode("utf8"))
+    return len(data)
+
+
+class ReplayBuffer:
+    """Last dispatches sent to client, limited by total size in bytes"""
+
+    __slots__ = ("_items", "_size", "_max_size", "_evicted_seq",)
+
+    def __init__(self, max_size: int):
+        self._items: deque[tuple[int, Union[str, bytes], int]] = deque()
+        self._size = 0
+        self._max_size = max_size
+        self._evicted_seq = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def append(self, seq: int, data: Union[str, bytes]) -> None:
+        size = byte_size(data)
+        self._items.append((seq, data, size))
+        self._size += size
+        while self._size > self._max_size:
+            self._evicted_seq, _, evicted_size = self._items.popleft()
+            self._size -= evicted_size
+
+    def can_replay(self, seq: int, current_seq: int) -> bool:
+        return self._evicted_seq <= seq <= current_seq
+
+    def since(self, seq: int) -> Iterator[Union[str, bytes]]:
+        for item_seq, data, _ in self._items:
+            if item_seq > seq:
+                yield data
+
+    def size_since(self, seq: int) -> int:
+        return sum(size for item_seq, _, size in self._items if item_seq > seq)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._size = 0
+
+
+class TimerWheel:
+    """
+    Tracks deadlines of many items (e.g. gateway clients waiting for heartbeat) with a single loop timer.
+    Items are stored in a ring of slots, one slot per `resolution` seconds, so (re)scheduling an item is O(1) and
+    every tick only visits items that actually expired. Item expires between `timeout` and `timeout + resolution`
+    seconds after last touch.
+    """
+
+    __slots__ = ("_slots", "_positions", "_tick", "_resolution", "_callback", "_loop", "_handle",)
+
+    def __init__(self, timeout: float, callback: Callable[[Hashable], None], resolution: float = 1.0):
+        self._slots: list[set] = [set() for _ in range(ceil(timeout / resolution) + 2)]
+        self._positions: dict[Hashable, int] = {}
+        self._tick = 0
+        self._resolution = resolution
+        self._callback = callback
+        self._loop: Optional[AbstractEventLoop] = None
+        self._handle: Optional[TimerHandle] = None
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, item: Hashable) -> bool:
+        return item in self._positions
+
+    def touch(self, item: Hashable) -> None:
+        self.discard(item)
+        slot = (self._tick - 1) % len(self._slots)
+        self._slots[slot].add(item)
+        self._positions[item] = slot
+        self._schedule()
+
+    def discard(self, item: Hashable) -> None:
+        if (slot := self._positions.pop(item, None)) is not None:
+            self._slots[slot].discard(item)
+
+    def advance(self) -> None:
+        self._tick += 1
+        slot = self._slots[self._tick % len(self._slots)]
+        expired = list(slot)
+        slot.clear()
+        for item in expired:
+            del self._positions[item]
+            self._callback(item)
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop = None
+
+    def _schedule(self) -> None:
+        loop = get_running_loop()
+        if self._handle is not None and self._loop is loop:
+            return
+        self._loop = loop
+        self._handle = loop.call_later(self._resolution, self._run)
+
+    def _run(self) -> None:
+        self._handle = None
+        self.advance()
+        if self._positions:
+            self._schedule()
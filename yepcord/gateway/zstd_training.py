@@ -0,0 +1,218 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from datetime import date
+from random import Random
+from typing import Any, Sequence
+
+import zstandard
+from tortoise.exceptions import DoesNotExist
+
+from .encoding import JSON
+from .events import ReadyEvent, PresenceUpdateEvent, MessageCreateEvent, EncodedDispatchEvent, GuildCreateEvent
+from .presences import Presence
+from .ready import ReadyLoader
+from ..yepcord.enums import ChannelType
+from ..yepcord.models import User, Message, UserData, UserSettings, Guild, GuildMember, Role, Emoji, Channel, \
+    Attachment
+from ..yepcord.snowflake import Snowflake
+
+
+# Fields that are removed from samples: dictionary is served to anyone, so nothing private may end up in it
+_PRIVATE_KEYS = {
+    "email", "phone", "session_id", "sessions", "analytics_token", "auth_token", "token", "user_settings_proto",
+    "country_code", "ip",
+}
+# Fields whose values are kept as is (enum-like values, not user-authored and not identifying)
+_PUBLIC_VALUE_KEYS = {
+    "t", "status", "desktop", "mobile", "web", "client", "os", "theme", "data_mode", "session_type", "region",
+    "features", "locale", "preferred_locale", "geo_ordered_rtc_regions",
+}
+
+
+def _mask(value: str) -> str:
+    return "".join("0" if char.isdigit() else "x" if char.isalpha() else char for char in value)
+
+
+def scrub(value: Any, key: str = None) -> Any:
+    """
+    Removes private fields from payload and masks every other string (ids, timestamps, names, message content, urls)
+    except enum-like values: digits are replaced with "0" and letters with "x", so only structure of payload is kept.
+    Large integers (timestamps in milliseconds) are replaced with a number of the same length.
+    """
+
+    if isinstance(value, dict):
+        return {
+            (_mask(str(item_key)) if str(item_key).isdigit() else item_key): scrub(item, item_key)
+            for item_key, item in value.items() if item_key not in _PRIVATE_KEYS
+        }
+    if isinstance(value, list):
+        return [scrub(item, key) for item in value]
+    if isinstance(value, str) and key not in _PUBLIC_VALUE_KEYS:
+        return _mask(value)
+    if type(value) is int and abs(value) >= 10 ** 9:
+        return 10 ** (len(str(abs(value))) - 1)
+    return value
+
+
+_WORDS = (
+    "the", "a", "to", "is", "it", "you", "and", "i", "that", "of", "in", "for", "on", "this", "what", "lol", "yeah",
+    "just", "so", "have", "be", "with", "can", "do", "but", "not", "know", "think", "anyone", "game", "server",
+    "tonight", "update", "working", "thanks", "please", "link", "voice", "later", "today", "check", "new", "build",
+)
+_CHANNEL_NAMES = ("announcements", "rules", "off-topic", "memes", "help", "dev", "music", "media", "bots", "events")
+# Typical shapes of activities sent by clients in PRESENCE_UPDATE (playing, streaming, listening, custom status)
+SYNTHETIC_ACTIVITIES = [
+    [],
+    [{"name": "Minecraft", "type": 0, "created_at": 1700000000000, "timestamps": {"start": 1700000000000},
+      "application_id": "356875570916753438"}],
+    [{"name": "Spotify", "type": 2, "created_at": 1700000000000, "id": "spotify:1", "flags": 48,
+      "details": "Song title", "state": "Artist; Other artist", "sync_id": "4cOdK2wGLETKBW3PvgPWqT",
+      "session_id": "0123456789abcdef0123456789abcdef", "party": {"id": "spotify:634241071368626240"},
+      "timestamps": {"start": 1700000000000, "end": 1700000200000},
+      "assets": {"large_image": "spotify:ab67616d0000b273", "large_text": "Album name"}}],
+    [{"name": "Twitch", "type": 1, "created_at": 1700000000000, "url": "https://www.twitch.tv/channel",
+      "details": "Stream title", "state": "Just Chatting", "assets": {"large_image": "twitch:channel"}}],
+    [{"name": "Custom Status", "type": 4, "state": "Working on something", "created_at": 1700000000000,
+      "emoji": {"name": "\U0001f4bb"}}],
+]
+
+
+def _sentence(rnd: Random, words: int) -> str:
+    return " ".join(rnd.choice(_WORDS) for _ in range(words)).capitalize()
+
+
+async def populate_synthetic(users_count: int = 200, guilds_count: int = 10, messages_count: int = 1000,
+                             seed: int = 0) -> None:
+    """
+    Creates synthetic users, guilds (with channels, roles, emojis and members) and messages (with mentions,
+    links, embeds and attachments) whose shapes resemble production data. Used to train shipped dictionary
+    (on empty database), so that nothing from real instances ends up in it.
+    """
+
+    rnd = Random(seed)
+    users = []
+    for idx in range(users_count):
+        user = await User.create(id=Snowflake.makeId(), email=f"user{idx}@yepcord.test", password="")
+        await UserData.create(
+            id=user.id, user=user, birth=date(2000, 1, 1), discriminator=rnd.randint(1, 9999),
+            username=f"{rnd.choice(_WORDS)}{rnd.choice(_WORDS)}{rnd.randint(0, 999)}",
+            avatar=f"{rnd.getrandbits(128):032x}" if rnd.random() < .7 else None,
+            bio=_sentence(rnd, rnd.randint(0, 12)), public_flags=rnd.choice((0, 0, 64, 128, 256)),
+        )
+        custom_status = {"text": _sentence(rnd, rnd.randint(1, 4))} if rnd.random() < .2 else None
+        await UserSettings.create(id=user.id, user=user, custom_status=custom_status)
+        users.append(user)
+
+    channels = []
+    for guild_idx in range(guilds_count):
+        owner = rnd.choice(users)
+        guild = await Guild.Y.create(owner, f"{_sentence(rnd, rnd.randint(1, 3))} server")
+        guild_channels = list(await Channel.filter(guild=guild, type=ChannelType.GUILD_TEXT))
+        category = await Channel.filter(guild=guild, type=ChannelType.GUILD_CATEGORY).first()
+        for position, name in enumerate(rnd.sample(_CHANNEL_NAMES, rnd.randint(2, len(_CHANNEL_NAMES))), 1):
+            guild_channels.append(await Channel.create(
+                id=Snowflake.makeId(), type=ChannelType.GUILD_TEXT, guild=guild, name=name, position=position,
+                parent=category, topic=_sentence(rnd, rnd.randint(3, 12)) if rnd.random() < .5 else None,
+                nsfw=False, rate_limit=rnd.choice((0, 0, 5, 30)), flags=0,
+            ))
+        channels.extend(guild_channels)
+
+        roles = [
+            await Role.create(id=Snowflake.makeId(), guild=guild, name=_sentence(rnd, 1), position=position,
+                              color=rnd.getrandbits(24), hoist=rnd.random() < .5, mentionable=rnd.random() < .3,
+                              permissions=rnd.choice((1071698660929, 8, 2248473465835073)))
+            for position in range(1, rnd.randint(2, 8))
+        ]
+        for _ in range(rnd.randint(0, 10)):
+            await Emoji.create(id=Snowflake.makeId(), name=rnd.choice(_WORDS) + rnd.choice(_WORDS), user=owner,
+                               guild=guild, animated=rnd.random() < .2)
+
+        for user in rnd.sample(users, rnd.randint(1, len(users))):
+            if user == owner:
+                continue
+            member = await GuildMember.create(id=Snowflake.makeId(), user=user, guild=guild,
+                                              nick=_sentence(rnd, 1) if rnd.random() < .2 else None)
+            for role in rnd.sample(roles, rnd.randint(0, min(3, len(roles)))):
+                await member.roles.add(role)
+
+    for _ in range(messages_count):
+        channel = rnd.choice(channels)
+        content = _sentence(rnd, rnd.randint(1, 25))
+        embeds = []
+        if rnd.random() < .1:
+            content = f"<@{rnd.choice(users).id}> {content}"
+        if rnd.random() < .1:
+            url = f"https://example.com/{rnd.choice(_WORDS)}/{rnd.getrandbits(32)}"
+            content = f"{content} {url}"
+            embeds.append({"type": "link", "url": url, "title": _sentence(rnd, 5),
+                           "description": _sentence(rnd, 20), "thumbnail": {
+                               "url": f"{url}.png", "proxy_url": f"{url}.png", "width": 400, "height": 400}})
+        message = await Message.create(id=Snowflake.makeId(), channel=channel, guild_id=channel.guild_id,
+                                       author=rnd.choice(users), content=content, embeds=embeds)
+        if rnd.random() < .05:
+            await Attachment.create(id=Snowflake.makeId(), channel=channel, message=message,
+                                    filename=f"{rnd.choice(_WORDS)}.png", size=rnd.randint(10 ** 4, 10 ** 7),
+                                    content_type="image/png", metadata={"width": 1920, "height": 1080})
+
+
+class _SampleClient:
+    def __init__(self):
+        self.sid = hex(Snowflake.makeId())[2:]
+
+
+async def collect_samples(limit: int = 1000, activities: Sequence[list[dict]] = ([],),
+                          scrubbed: bool = True) -> list[bytes]:
+    """
+    Serializes READY, PRESENCE_UPDATE, GUILD_CREATE and MESSAGE_CREATE payloads of existing users, guilds and messages
+    exactly like gateway sends them to clients (READY is sent as regular payload, other events as broker dispatches).
+    Presences of users cycle through `activities`.
+    Payloads are scrubbed (see scrub()), so samples contain no private or user-authored data. `scrubbed=False` is
+    only meant for benchmarks on synthetic data.
+    """
+
+    clean = scrub if scrubbed else (lambda value: value)
+    samples = []
+    for seq, user in enumerate(await User.filter(is_bot=False, deleted=False).limit(limit), 1):
+        try:
+            ready = await ReadyEvent(user, _SampleClient()).json()  # type: ignore
+        except DoesNotExist:  # User without data or settings
+            continue
+        samples.append(JSON.encode(clean(ready) | {"s": 1}).encode("utf8"))
+
+        settings = await user.settings
+        presence = Presence(user.id, "online", settings.custom_status, list(activities[seq % len(activities)]))
+        event = PresenceUpdateEvent(await user.data, presence)
+        samples.append(EncodedDispatchEvent(clean(await event.json())).encode(seq).encode("utf8"))
+
+    for seq, guild in enumerate(await Guild.all().limit(limit).select_related("owner"), 1):
+        for guild_obj in await ReadyLoader(guild.owner).load_guilds([guild.id]):
+            event = GuildCreateEvent(guild_obj)
+            samples.append(EncodedDispatchEvent(clean(await event.json())).encode(seq).encode("utf8"))
+
+    messages = await Message.filter(ephemeral=False, channel_id__isnull=False, author_id__isnull=False)\
+        .order_by("-id").limit(limit).select_related(*Message.DEFAULT_RELATED, "channel__guild")
+    for seq, message in enumerate(messages, 1):
+        event = MessageCreateEvent(await message.ds_json())
+        samples.append(EncodedDispatchEvent(clean(await event.json())).encode(seq).encode("utf8"))
+
+    return samples
+
+
+def train(samples: list[bytes], size: int = 16 * 1024) -> zstandard.ZstdCompressionDict:
+    return zstandard.train_dictionary(size, samples)
@@ -17,13 +17,14 @@
 """
 
 from time import time
-from typing import Union, Optional, Callable, Awaitable, TypeVar
+from typing import Union, Optional, Callable, Awaitable, TypeVar, Any
 
 from fast_depends import Depends
-from quart import request
+from quart import request, g
 from typing_extensions import ParamSpec
 
 from yepcord.rest_api.utils import getSessionFromToken
+from yepcord.yepcord.enums import GUILD_CHANNELS
 from yepcord.yepcord.errors import InvalidDataErr, Errors, UnknownApplication, UnknownInvite, UnknownMessage, \
     UnknownRole, UnknownGuildTemplate, MissingAccess, Unauthorized
 from yepcord.yepcord.models import Session, Authorization, Bot, User, Channel, Message, Webhook, Invite, Guild, \
@@ -36,6 +37,33 @@ T = TypeVar("T")
 P = ParamSpec("P")
 
 
+class RequestCache:
+    """
+    Identity map of one request: entities loaded by dependencies (channel, guild, member of current user) are
+    fetched at most once per request and the same objects are shared between dependencies and route body.
+    """
+
+    __slots__ = ("_entities",)
+
+    def __init__(self):
+        self._entities: dict[tuple, Any] = {}
+
+    async def get(self, key: tuple, load: Callable[[], Awaitable[T]]) -> T:
+        if key not in self._entities:
+            self._entities[key] = await load()
+        return self._entities[key]
+
+
+def requestCache() -> RequestCache:
+    if (cache := g.get("request_cache")) is None:
+        cache = g.request_cache = RequestCache()
+    return cache
+
+
+async def getGuildMember(guild: Guild, user_id: int) -> Optional[GuildMember]:
+    return await requestCache().get((GuildMember, guild.id, user_id), lambda: guild.get_member(user_id))
+
+
 def depRaise(func: Callable[P, Awaitable[Optional[T]]], status_code: int, error: dict) -> Callable[P, Awaitable[T]]:
     async def wrapper(res=Depends(func)):
         if res is None:
@@ -67,9 +95,13 @@ def depUser(allow_without_user: bool = False):
 
 
 async def depChannelO(channel_id: Optional[int] = None, user: User = Depends(depUser())) -> Optional[Channel]:
-    if (channel := await Channel.Y.get(channel_id)) is None:
+    if (channel := await requestCache().get((Channel, channel_id), lambda: Channel.Y.get(channel_id))) is None:
         return
-    if not await channel.user_can_access(user.id):
+    if channel.type in GUILD_CHANNELS:
+        can_access = await getGuildMember(channel.guild, user.id) is not None
+    else:
+        can_access = await channel.user_can_access(user.id)
+    if not can_access:
         raise Unauthorized
 
     return channel
@@ -136,9 +168,12 @@ async def depInvite(invite: Optional[str] = None) -> Invite:
 
 
 async def depGuildO(guild: Optional[int] = None, user: User = Depends(depUser())) -> Optional[Guild]:
-    if (guild := await Guild.get_or_none(id=guild).select_related("owner")) is None:
+    guild_id = guild
+    if (guild := await requestCache().get(
+            (Guild, guild_id), lambda: Guild.get_or_none(id=guild_id).select_related("owner")
+    )) is None:
         return
-    if not await GuildMember.filter(guild=guild, user=user).exists():
+    if await getGuildMember(guild, user.id) is None:
         raise MissingAccess
 
     return guild
@@ -148,7 +183,7 @@ depGuild = depRaise(depGuildO, 404, Errors.make(10004))
 
 
 async def depGuildMember(guild: Guild = Depends(depGuild), user: User = Depends(depUser())) -> GuildMember:
-    return await GuildMember.get(guild=guild, user=user).select_related("user", "guild", "guild__owner")
+    return await getGuildMember(guild, user.id)
 
 
 async def depRole(role: int, guild: Guild = Depends(depGuild)) -> Role:
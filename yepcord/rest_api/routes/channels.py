@@ -25,7 +25,7 @@ from emoji import is_emoji
 from quart import request
 from tortoise.expressions import Q
 
-from ..dependencies import DepUser, DepChannel, DepMessage
+from ..dependencies import DepUser, DepChannel, DepMessage, getGuildMember
 from ..models.channels import ChannelUpdate, MessageCreate, MessageUpdate, InviteCreate, PermissionOverwriteModel, \
     WebhookCreate, GetReactionsQuery, MessageAck, CreateThread, CommandsSearchQS, SearchQuery, GetMessagesQuery
 from ..utils import _getMessage, processMessage
@@ -130,8 +130,10 @@ async def delete_channel(user: User = DepUser, channel: Channel = DepChannel):
                           type=MessageType.RECIPIENT_REMOVE, extra_data={"user": user.id})
         await getGw().dispatch(MessageCreateEvent(await message.ds_json()), channel=channel)
         await channel.recipients.remove(user)
+        recipient_ids = [recipient.id for recipient in await channel.recipients.all()]
+        await getGw().dispatchRelatedUsers([user.id], recipient_ids, removed=True)
         await getGw().dispatch(ChannelRecipientRemoveEvent(channel.id, (await user.data).ds_json),
-                               user_ids=[user.id for user in await channel.recipients.all()])
+                               user_ids=recipient_ids)
         await getGw().dispatch(DMChannelDeleteEvent(await channel.ds_json()), user_ids=[user.id])
         if await channel.recipients.filter().count() == 0:
             await channel.delete()
@@ -140,7 +142,7 @@ async def delete_channel(user: User = DepUser, channel: Channel = DepChannel):
             await channel.save()
             await getGw().dispatch(DMChannelUpdateEvent(channel), channel=channel)
     elif channel.type in GUILD_CHANNELS:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.MANAGE_CHANNELS, channel=channel)
 
         entry = await AuditLogEntry.utils.channel_delete(user, channel)
@@ -165,7 +167,7 @@ async def delete_channel(user: User = DepUser, channel: Channel = DepChannel):
 @channels.get("/<int:channel_id>/messages", qs_cls=GetMessagesQuery, allow_bots=True)
 async def get_messages(query_args: GetMessagesQuery, user: User = DepUser, channel: Channel = DepChannel):
     if channel.guild is not None:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
     messages = await channel.get_messages(**query_args.model_dump())
     messages = [await message.ds_json(user_id=user.id) for message in messages]
@@ -179,7 +181,7 @@ async def send_message(user: User = DepUser, channel: Channel = DepChannel):
         if await Relationship.utils.is_blocked(oth, user):
             raise CannotSendToThisUser
     elif channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.SEND_MESSAGES, GuildPermissions.VIEW_CHANNEL,
                                      GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
 
@@ -191,12 +193,13 @@ async def send_message(user: User = DepUser, channel: Channel = DepChannel):
             await channel.dm_unhide(other_user)
             await getGw().dispatch(DMChannelCreateEvent(channel, channel_json_kwargs={"user_id": other_user.id}),
                                    user_ids=[other_user.id])
-    await getGw().dispatch(MessageCreateEvent(await message.ds_json()), channel=message.channel,
+    message_json = await message.ds_json()
+    await getGw().dispatch(MessageCreateEvent(message_json), channel=message.channel,
                            permissions=GuildPermissions.VIEW_CHANNEL)
     await user.update_read_state(channel, 0, message.id)
     await getGw().dispatch(MessageAckEvent({"version_id": 1, "message_id": str(message.id),
                                             "channel_id": str(message.channel.id)}), user_ids=[user.id])
-    return await message.ds_json()
+    return message_json
 
 
 @channels.delete("/<int:channel_id>/messages/<int:message>", allow_bots=True)
@@ -204,7 +207,7 @@ async def delete_message(user: User = DepUser, channel: Channel = DepChannel, me
     if message.author != user:
         if channel.type not in GUILD_CHANNELS:
             raise CannotExecuteOnDM
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.MANAGE_MESSAGES, GuildPermissions.VIEW_CHANNEL,
                                      GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
     guild_id = channel.guild.id if channel.guild else None
@@ -220,7 +223,7 @@ async def edit_message(data: MessageUpdate, user: User = DepUser, channel: Chann
     if message.author != user:
         raise CannotEditAnotherUserMessage
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.SEND_MESSAGES, GuildPermissions.VIEW_CHANNEL,
                                      GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
     await message.update(**data.to_json(), edit_timestamp=datetime.now())
@@ -232,7 +235,7 @@ async def edit_message(data: MessageUpdate, user: User = DepUser, channel: Chann
 @channels.get("/<int:channel_id>/messages/<int:message>", allow_bots=True)
 async def get_message(user: User = DepUser, channel: Channel = DepChannel, message: Message = DepMessage):
     if channel.guild is not None:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
     if message.ephemeral and message.author != user:
         raise UnknownMessage
@@ -265,7 +268,7 @@ async def delete_message_ack(user: User = DepUser, channel: Channel = DepChannel
 @channels.post("/<int:channel_id>/typing", allow_bots=True)
 async def send_typing_event(user: User = DepUser, channel: Channel = DepChannel):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.VIEW_CHANNEL, channel=channel)
     await getGw().dispatch(TypingEvent(user.id, channel.id), channel=channel, permissions=GuildPermissions.VIEW_CHANNEL)
     return "", 204
@@ -281,6 +284,8 @@ async def add_recipient(target_user: int, user: User = DepUser, channel: Channel
         recipients = await channel.recipients.filter(~Q(id=user.id))
         recipients.append(target_user)
         new_channel = await Channel.Y.create_dm_group(user, recipients)
+        recipient_ids = [user.id, *(recipient.id for recipient in recipients)]
+        await getGw().dispatchRelatedUsers(recipient_ids, recipient_ids)
         await getGw().dispatch(DMChannelCreateEvent(new_channel), channel=channel)
     elif channel.type == ChannelType.GROUP_DM:
         recipients = await channel.recipients.all()
@@ -292,6 +297,7 @@ async def add_recipient(target_user: int, user: User = DepUser, channel: Channel
             await ReadState.update_from_message(message)
             await getGw().dispatch(MessageCreateEvent(await message.ds_json()), channel=message.channel)
             await channel.recipients.add(target_user)
+            await getGw().dispatchRelatedUsers([target_user.id], [recipient.id for recipient in recipients])
             target_user_data = await target_user.data
             await getGw().dispatch(ChannelRecipientAddEvent(channel.id, target_user_data.ds_json),
                                    user_ids=[recipient.id for recipient in recipients])
@@ -314,6 +320,7 @@ async def delete_recipient(target_user: int, user: User = DepUser, channel: Chan
         await ReadState.update_from_message(message)
         await getGw().dispatch(MessageCreateEvent(await message.ds_json()), channel=message.channel)
         await channel.recipients.remove(target_user)
+        await getGw().dispatchRelatedUsers([target_user.id], [recipient.id for recipient in recipients], removed=True)
         target_user_data = await target_user.data
         await getGw().dispatch(ChannelRecipientRemoveEvent(channel.id, target_user_data.ds_json),
                                user_ids=[recipient.id for recipient in recipients])
@@ -324,7 +331,7 @@ async def delete_recipient(target_user: int, user: User = DepUser, channel: Chan
 @channels.put("/<int:channel_id>/pins/<int:message>", allow_bots=True)
 async def pin_message(user: User = DepUser, channel: Channel = DepChannel, message: Message = DepMessage):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.MANAGE_CHANNELS, GuildPermissions.VIEW_CHANNEL, channel=channel)
     if not message.pinned:
         if await Message.filter(pinned_timestamp__not_isnull=True, channel=message.channel).count() >= 50:
@@ -363,7 +370,7 @@ async def unpin_message(user: User = DepUser, channel: Channel = DepChannel, mes
 @channels.get("/<int:channel_id>/pins", allow_bots=True)
 async def get_pinned_messages(user: User = DepUser, channel: Channel = DepChannel):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(
             GuildPermissions.VIEW_CHANNEL, GuildPermissions.READ_MESSAGE_HISTORY,
             channel=channel,
@@ -380,7 +387,7 @@ async def get_pinned_messages(user: User = DepUser, channel: Channel = DepChanne
 async def add_message_reaction(reaction: str, user: User = DepUser, channel: Channel = DepChannel,
                                message: Message = DepMessage):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.ADD_REACTIONS, GuildPermissions.READ_MESSAGE_HISTORY,
                                      GuildPermissions.VIEW_CHANNEL, channel=channel)
     if not is_emoji(reaction) and not (reaction := await Emoji.Y.get_by_reaction(reaction)):
@@ -399,7 +406,7 @@ async def add_message_reaction(reaction: str, user: User = DepUser, channel: Cha
 async def remove_message_reaction(reaction: str, user: User = DepUser, channel: Channel = DepChannel,
                                   message: Message = DepMessage):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.ADD_REACTIONS, GuildPermissions.READ_MESSAGE_HISTORY,
                                      GuildPermissions.VIEW_CHANNEL, channel=channel)
     if not is_emoji(reaction) and not (reaction := await Emoji.Y.get_by_reaction(reaction)):
@@ -418,7 +425,7 @@ async def remove_message_reaction(reaction: str, user: User = DepUser, channel:
 async def get_message_reactions(query_args: GetReactionsQuery, reaction: str, user: User = DepUser,
                                 channel: Channel = DepChannel, message: Message = DepMessage):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.ADD_REACTIONS, GuildPermissions.READ_MESSAGE_HISTORY,
                                      GuildPermissions.VIEW_CHANNEL, channel=channel)
     if not is_emoji(reaction) and not (reaction := await Emoji.Y.get_by_reaction(reaction)):
@@ -439,7 +446,7 @@ async def get_message_reactions(query_args: GetReactionsQuery, reaction: str, us
 @channels.get("/<int:channel_id>/messages/search", qs_cls=SearchQuery)
 async def search_messages(query_args: SearchQuery, user: User = DepUser, channel: Channel = DepChannel):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.READ_MESSAGE_HISTORY, GuildPermissions.VIEW_CHANNEL,
                                      channel=channel)
     messages, total = await channel.search_messages(query_args.model_dump(exclude_defaults=True))
@@ -452,7 +459,7 @@ async def search_messages(query_args: SearchQuery, user: User = DepUser, channel
 @channels.post("/<int:channel_id>/invites", body_cls=InviteCreate, allow_bots=True)
 async def create_invite(data: InviteCreate, user: User = DepUser, channel: Channel = DepChannel):
     if channel.guild:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.CREATE_INSTANT_INVITE)
     invite = await Invite.create(
         id=Snowflake.makeId(), channel=channel, inviter=user, **data.model_dump(include={"max_age", "max_uses"}),
@@ -469,7 +476,7 @@ async def create_or_update_permission_overwrite(data: PermissionOverwriteModel,
                                                 channel: Channel = DepChannel):
     if not channel.guild:
         raise CannotExecuteOnDM
-    if not (member := await channel.guild.get_member(user.id)):
+    if not (member := await getGuildMember(channel.guild, user.id)):
         raise MissingAccess
     target = await channel.guild.get_role(target_id) if data.type == 0 else await User.get_or_none(id=target_id)
     if target is None or (isinstance(target, Role) and target.guild != channel.guild):
@@ -500,7 +507,7 @@ async def create_or_update_permission_overwrite(data: PermissionOverwriteModel,
 async def delete_permission_overwrite(target_id: int, user: User = DepUser, channel: Channel = DepChannel):
     if not channel.guild:
         raise CannotExecuteOnDM
-    if not (member := await channel.guild.get_member(user.id)):
+    if not (member := await getGuildMember(channel.guild, user.id)):
         raise MissingAccess
     await member.checkPermission(GuildPermissions.MANAGE_CHANNELS, GuildPermissions.MANAGE_ROLES, channel=channel)
     overwrite = await channel.get_permission_overwrite(target_id)
@@ -524,7 +531,7 @@ async def delete_permission_overwrite(target_id: int, user: User = DepUser, chan
 async def get_channel_invites(user: User = DepUser, channel: Channel = DepChannel):
     if not channel.guild:
         raise CannotExecuteOnDM
-    if not (member := await channel.guild.get_member(user.id)):
+    if not (member := await getGuildMember(channel.guild, user.id)):
         raise MissingAccess
     await member.checkPermission(GuildPermissions.VIEW_CHANNEL, channel=channel)
     return [
@@ -538,7 +545,7 @@ async def get_channel_invites(user: User = DepUser, channel: Channel = DepChanne
 async def create_webhook(data: WebhookCreate, user: User = DepUser, channel: Channel = DepChannel):
     if not channel.guild:
         raise CannotExecuteOnDM
-    member = await channel.guild.get_member(user.id)
+    member = await getGuildMember(channel.guild, user.id)
     await member.checkPermission(GuildPermissions.MANAGE_WEBHOOKS)
 
     webhook = await Webhook.create(id=Snowflake.makeId(), type=WebhookType.INCOMING, name=data.name,
@@ -553,7 +560,7 @@ async def create_webhook(data: WebhookCreate, user: User = DepUser, channel: Cha
 async def get_channel_webhooks(user: User = DepUser, channel: Channel = DepChannel):
     if not channel.guild:
         raise CannotExecuteOnDM
-    member = await channel.guild.get_member(user.id)
+    member = await getGuildMember(channel.guild, user.id)
     await member.checkPermission(GuildPermissions.MANAGE_WEBHOOKS)
 
     return [
@@ -568,7 +575,7 @@ async def create_thread(
 ):
     if not channel.guild:
         raise CannotExecuteOnDM
-    member = await channel.guild.get_member(user.id)
+    member = await getGuildMember(channel.guild, user.id)
     await member.checkPermission(GuildPermissions.CREATE_PUBLIC_THREADS, channel=channel)
 
     thread = await Channel.create(id=message.id, type=ChannelType.GUILD_PUBLIC_THREAD, guild=channel.guild,
@@ -665,7 +672,7 @@ async def search_application_commands(
 @channels.get("/<int:channel_id>/messages/<int:message>/interaction-data", allow_bots=True)
 async def get_message_interaction(user: User = DepUser, channel: Channel = DepChannel, message: Message = DepMessage):
     if channel.guild is not None:
-        member = await channel.guild.get_member(user.id)
+        member = await getGuildMember(channel.guild, user.id)
         await member.checkPermission(GuildPermissions.READ_MESSAGE_HISTORY, channel=channel)
     if message.ephemeral and message.author != user:
         raise UnknownMessage
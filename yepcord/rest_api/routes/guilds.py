@@ -314,8 +314,6 @@ async def kick_member(user_id: int, user: User = DepUser, guild: Guild = DepGuil
     if not await member.perm_checker.canKickOrBan(target_member):
         raise MissingPermissions
     await getGw().dispatchUnsub([target_member.user.id], guild.id)
-    for role in await target_member.roles.all():
-        await getGw().dispatchUnsub([target_member.user.id], role_id=role.id)
     await target_member.delete()
     if target_member.user.is_bot:
         await process_bot_kick(user, target_member)
@@ -341,8 +339,6 @@ async def ban_member(user_id: int, data: BanMember, user: User = DepUser, guild:
     reason = request.headers.get("x-audit-log-reason", "")
     if target_member is not None:
         await getGw().dispatchUnsub([target_member.user.id], guild.id)
-        for role in await target_member.roles.all():
-            await getGw().dispatchUnsub([target_member.user.id], role_id=role.id)
         await target_member.delete()
         if target_member.user.is_bot:
             await process_bot_kick(user, target_member)
@@ -514,7 +510,7 @@ async def delete_role(user: User = DepUser, guild: Guild = DepGuild, member: Gui
 
     await guild.set_template_dirty()
 
-    await getGw().dispatchUnsub([], role_id=role.id, delete=True)
+    await getGw().dispatchUnsub([], guild.id, role_id=role.id, delete=True)
 
     return "", 204
 
@@ -563,7 +559,7 @@ async def add_role_members(data: AddRoleMembers, user: User = DepUser, guild: Gu
             await getGw().dispatch(GuildMemberUpdateEvent(guild.id, target_member_json), guild_id=guild.id)
             members[str(target_member.user.id)] = target_member_json
 
-    await getGw().dispatchSub([int(user_id) for user_id in members], role_id=role.id)
+    await getGw().dispatchSub([int(user_id) for user_id in members], guild.id, role_id=role.id)
     return members
 
 
@@ -585,9 +581,9 @@ async def update_member(data: MemberUpdate, target_user: str, user: User = DepUs
                 raise MissingPermissions
         added, removed = await target_member.set_roles_from_list(roles)
         for role_id in added:
-            await getGw().dispatchSub([target_user], role_id=role_id)
+            await getGw().dispatchSub([target_user], guild.id, role_id=role_id)
         for role_id in removed:
-            await getGw().dispatchUnsub([target_user], role_id=role_id)
+            await getGw().dispatchUnsub([target_user], guild.id, role_id=role_id)
         data.roles = None
     if data.nick is not None:
         await member.checkPermission(
@@ -615,6 +611,27 @@ async def update_member(data: MemberUpdate, target_user: str, user: User = DepUs
     return await target_member.ds_json()
 
 
+@guilds.get("/<int:guild>/members/<string:target_user>/permissions", allow_bots=True)
+async def get_member_permissions(target_user: str, user: User = DepUser, guild: Guild = DepGuild,
+                                 member: GuildMember = DepGuildMember):
+    target_user = user.id if target_user == "@me" else int(target_user)
+    if target_user != user.id:
+        await member.checkPermission(GuildPermissions.MANAGE_ROLES)
+    engine = await getGw().permissions.get(guild.id)
+    if engine is None or (permissions := engine.permissions(target_user)) is None:
+        raise UnknownUser
+    channel_ids = await Channel.filter(guild=guild).order_by("position", "id").values_list("id", flat=True)
+
+    return {
+        "user_id": str(target_user),
+        "permissions": str(permissions),
+        "channels": {
+            str(channel_id): str(users[target_user])
+            for channel_id, users in engine.compute(channel_ids, [target_user]).items()
+        },
+    }
+
+
 @guilds.get("/<int:guild>/vanity-url", allow_bots=True)
 async def get_vanity_url(guild: Guild = DepGuild, member: GuildMember = DepGuildMember):
     await member.checkPermission(GuildPermissions.MANAGE_GUILD)
@@ -717,14 +734,10 @@ async def delete_guild(data: GuildDelete, user: User = DepUser, guild: Guild = D
             if not (len(data.code) == 8 and await user.use_backup_code(data.code)):
                 raise Invalid2FaCode
 
-    role_ids = [role.id for role in await guild.get_roles(True)]
-
     await guild.delete()
     await getGw().dispatch(GuildDeleteEvent(guild.id), user_ids=[user.id])
 
     await getGw().dispatchUnsub([], guild.id, delete=True)
-    for role_id in role_ids:
-        await getGw().dispatchUnsub([], role_id=role_id, delete=True)
 
     return "", 204
 
@@ -20,7 +20,7 @@ from ..dependencies import DepInvite, DepUser
 from ..models.invites import GetInviteQuery
 from ..y_blueprint import YBlueprint
 from ...gateway.events import MessageCreateEvent, DMChannelCreateEvent, ChannelRecipientAddEvent, GuildCreateEvent, \
-    InviteDeleteEvent
+    InviteDeleteEvent, GuildMemberAddEvent
 from ...yepcord.ctx import getGw
 from ...yepcord.enums import ChannelType, GuildPermissions, MessageType
 from ...yepcord.errors import UnknownInvite, UserBanned, MissingAccess
@@ -60,6 +60,7 @@ async def use_invite(user: User = DepUser, invite: Invite = DepInvite):
             )
             await ReadState.update_from_message(message)
             await channel.recipients.add(user)
+            await getGw().dispatchRelatedUsers([user.id], [recipient.id for recipient in recipients])
             await getGw().dispatch(ChannelRecipientAddEvent(channel.id, (await user.data).ds_json),
                                    user_ids=[recipient.id for recipient in recipients])
             await getGw().dispatch(MessageCreateEvent(await message.ds_json()),
@@ -77,8 +78,9 @@ async def use_invite(user: User = DepUser, invite: Invite = DepInvite):
             if await GuildBan.exists(guild=guild, user=user):
                 raise UserBanned
             inv["new_member"] = True
-            await GuildMember.create(id=Snowflake.makeId(), user=user, guild=guild)
+            new_member = await GuildMember.create(id=Snowflake.makeId(), user=user, guild=guild)
             await getGw().dispatch(GuildCreateEvent(await guild.ds_json(user_id=user.id)), user_ids=[user.id])
+            await getGw().dispatch(GuildMemberAddEvent(guild.id, await new_member.ds_json()), guild_id=guild.id)
             if guild.system_channel:
                 sys_channel = await Channel.Y.get(guild.system_channel)
                 message = await Message.create(
@@ -25,7 +25,7 @@ from ..models.oauth2 import AppAuthorizeGetQs, ExchangeCode, AppAuthorizePostQs,
 from ..utils import captcha
 from ..y_blueprint import YBlueprint
 from ...gateway.events import GuildCreateEvent, MessageCreateEvent, GuildAuditLogEntryCreateEvent, \
-    GuildRoleCreateEvent, IntegrationCreateEvent
+    GuildRoleCreateEvent, IntegrationCreateEvent, GuildMemberAddEvent
 from ...yepcord.config import Config
 from ...yepcord.ctx import getGw
 from ...yepcord.enums import ApplicationScope, GuildPermissions, MessageType
@@ -124,6 +124,7 @@ async def authorize_application(query_args: AppAuthorizePostQs, data: AppAuthori
                                permissions=GuildPermissions.MANAGE_GUILD)
         await getGw().dispatch(GuildRoleCreateEvent(guild.id, bot_role.ds_json()), guild_id=guild.id,
                                permissions=GuildPermissions.MANAGE_ROLES)
+        await getGw().dispatch(GuildMemberAddEvent(guild.id, await bot_member.ds_json()), guild_id=guild.id)
         entries = [
             await AuditLogEntry.utils.role_create(user, bot_role),
             await AuditLogEntry.utils.bot_add(user, guild, bot.user),
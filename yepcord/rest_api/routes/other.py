@@ -18,6 +18,7 @@
 
 from quart import Blueprint
 
+from ...gateway.compression import zstd_dictionary
 from ...yepcord.config import Config
 from ...yepcord.errors import InvalidDataErr, Errors
 
@@ -238,7 +239,20 @@ async def api_stickerpacks_get():
 
 @other.get("/api/v9/gateway")
 async def api_gateway():
-    return {"url": f"wss://{Config.GATEWAY_HOST}"}
+    result = {"url": f"wss://{Config.GATEWAY_HOST}"}
+    if (dictionary := zstd_dictionary()) is not None:
+        result["zstd_dictionary"] = {
+            "id": str(dictionary.dict_id()),
+            "url": f"https://{Config.PUBLIC_HOST}/api/v9/gateway/zstd-dictionary",
+        }
+    return result
+
+
+@other.get("/api/v9/gateway/zstd-dictionary")
+async def api_gateway_zstd_dictionary():
+    if (dictionary := zstd_dictionary()) is None:
+        return b"", 404
+    return dictionary.as_bytes(), 200, {"Content-Type": "application/octet-stream"}
 
 
 @other.get("/api/v9/instance")
@@ -241,6 +241,7 @@ async def new_relationship(data: RelationshipRequest, user: User = DepUser):
     if target_user == user:
         raise AlreadyFriends
     await Relationship.utils.request(user, target_user)
+    await getGw().dispatchRelatedUsers([user.id], [target_user.id])
 
     await getGw().dispatch(RelationshipAddEvent(user.id, await user.userdata, 3), [target_user.id])
     await getGw().dispatch(RelationshipAddEvent(target_user.id, await target_user.userdata, 4), [user.id])
@@ -353,6 +354,7 @@ async def accept_relationship_or_block(data: RelationshipPut, user_id: int, user
 
         if not await Relationship.utils.accept(from_user, user):
             await Relationship.utils.request(user, from_user)
+            await getGw().dispatchRelatedUsers([user.id], [from_user.id])
 
             await getGw().dispatch(RelationshipAddEvent(user.id, await user.userdata, 3), [from_user.id])
             await getGw().dispatch(RelationshipAddEvent(from_user.id, await from_user.userdata, 4), [user.id])
@@ -365,6 +367,8 @@ async def accept_relationship_or_block(data: RelationshipPut, user_id: int, user
     elif data.type == 2:
         block_user = target_user_data.user
         result = await Relationship.utils.block(user, block_user)
+        if result["block"] or result["delete"]:
+            await getGw().dispatchRelatedUsers([user.id], [block_user.id], removed=True)
         for d in result["delete"]:
             await getGw().dispatch(RelationshipRemoveEvent(d["rel"], d["type"]), [d["id"]])
         if result["block"]:
@@ -378,6 +382,8 @@ async def delete_relationship(user_id: int, user: User = DepUser):
     if (target_user := await User.y.get(user_id)) is None:
         return "", 204
     result = await Relationship.utils.delete(user, target_user)
+    if result["delete"]:
+        await getGw().dispatchRelatedUsers([user.id], [target_user.id], removed=True)
     for d in result["delete"]:
         await getGw().dispatch(RelationshipRemoveEvent(d["rel"], d["type"]), [d["id"]])
     return "", 204
@@ -393,8 +399,6 @@ async def leave_guild(user: User = DepUser, guild: Guild = DepGuild, member: Gui
     if user == guild.owner:
         raise InvalidGuild
     await getGw().dispatchUnsub([user.id], guild.id)
-    for role in await member.roles.all():
-        await getGw().dispatchUnsub([user.id], role_id=role.id)
 
     await member.delete()
     await getGw().dispatch(GuildMemberRemoveEvent(guild.id, (await user.data).ds_json), user_ids=[user.id])
@@ -424,6 +428,7 @@ async def new_dm_channel(data: DmChannelCreate, user: User = DepUser):
         channel = await Channel.Y.create_dm_group(user, [], data.name)
     else:
         channel = await Channel.Y.create_dm_group(user, recipients_users, data.name)
+    await getGw().dispatchRelatedUsers([user.id, *recipients], [user.id, *recipients])
     await getGw().dispatch(DMChannelCreateEvent(channel), channel=channel)
     return await channel.ds_json(with_ids=False, user_id=user.id)
 
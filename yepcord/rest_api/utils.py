@@ -188,8 +188,10 @@ def makeEmbedError(code, path=None, replaces=None):
 
 
 async def process_stickers(sticker_ids: list[int]):
-    stickers = await Sticker.filter(id__in=sticker_ids).select_related("guild")
     stickers_data = {"sticker_items": [], "stickers": []}
+    if not sticker_ids:
+        return stickers_data
+    stickers = await Sticker.filter(id__in=sticker_ids).select_related("guild")
     for sticker in stickers:
         if sticker is None:
             continue
@@ -25,6 +25,7 @@ from quart import Blueprint, g
 from quart_schema import validate_request, validate_querystring
 
 from yepcord.yepcord.config import Config
+from yepcord.yepcord.ctx import getGw
 
 validate_funcs = {"body": validate_request, "qs": validate_querystring}
 
@@ -111,6 +112,24 @@ def apply_oauth(src_func: T_route, scopes: list[str]) -> T_route:
     return wrapped
 
 
+def apply_dispatch_batch(src_func: T_route) -> T_route:
+    applied = getattr(src_func, "_patches", set())
+    if "dispatch_batch" in applied:
+        return src_func
+
+    @wraps(src_func)
+    async def wrapped(*args, **kwargs):
+        async with getGw().batch():
+            return await src_func(*args, **kwargs)
+
+    applied.add("dispatch_batch")
+    setattr(wrapped, "_patches", applied)
+    if len(applied) > 1:  # pragma: no cover
+        delattr(src_func, "_patches")
+
+    return wrapped
+
+
 class YBlueprint(Blueprint):
     @setupmethod
     def route(self, rule: str, **options: Any) -> Callable[[T_route], T_route]:
@@ -145,6 +164,8 @@ class YBlueprint(Blueprint):
                 f = apply_allow_bots(f)
             if oauth_scopes := options.pop("oauth_scopes", []):
                 f = apply_oauth(f, oauth_scopes)
+            if "GET" not in options.get("methods", ["GET"]):
+                f = apply_dispatch_batch(f)
 
             endpoint = options.pop("endpoint", None)
             self.add_url_rule(rule, endpoint, f, **options)
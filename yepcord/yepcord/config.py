@@ -117,6 +117,40 @@ class ConfigConnections(BaseModel):
     spotify: ConfigConnectionBase = Field(default_factory=ConfigConnectionBase)
 
 
+class ConfigGatewaySharding(BaseModel):
+    count: int = 1
+    shards: list[int] = Field(default_factory=list)
+
+    @field_validator("count")
+    def validate_count(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("GATEWAY_SHARDING count must be greater than 0!")
+
+        return value
+
+    @field_validator("shards")
+    def validate_shards(cls, value: list[int], info) -> list[int]:
+        count = info.data.get("count", 1)
+        if any(shard < 0 or shard >= count for shard in value):
+            raise ValueError(f"GATEWAY_SHARDING shards must be in range [0, {count})!")
+
+        return sorted(set(value))
+
+
+class ConfigGatewayZstd(BaseModel):
+    level: int = 3
+    window_log: int = 0
+    use_dictionary: bool = True
+    dictionary_path: Optional[str] = None
+
+    @field_validator("window_log")
+    def validate_window_log(cls, value: int) -> int:
+        if value != 0 and (value < 10 or value > 31):
+            raise ValueError("GATEWAY_ZSTD window_log must be 0 (default for level) or in range [10, 31]!")
+
+        return value
+
+
 class ConfigModel(BaseModel):
     DB_CONNECT_STRING: str = "sqlite:///db.sqlite"
     MAIL_CONNECT_STRING: str = "smtp://127.0.0.1:10025?timeout=3"
@@ -130,6 +164,22 @@ class ConfigModel(BaseModel):
     MESSAGE_BROKER: ConfigMessageBrokers = Field(default_factory=ConfigMessageBrokers)
     REDIS_URL: Optional[str] = None
     GATEWAY_KEEP_ALIVE_DELAY: int = 45
+    GATEWAY_HEARTBEAT_GRACE: int = 15
+    GATEWAY_PRESENCE_CACHE_TTL: int = 30
+    GATEWAY_MAX_QUEUE_MESSAGES: int = 1000
+    GATEWAY_MAX_QUEUE_BYTES: int = 16 * 1024 * 1024
+    GATEWAY_METRICS: bool = False
+    GATEWAY_SESSION_TIMEOUT: int = 120
+    GATEWAY_RESUME_BUFFER_SIZE: int = 512 * 1024
+    GATEWAY_LAZY_GUILDS: bool = False
+    GATEWAY_GUILD_CREATE_BATCH: int = 10
+    GATEWAY_GUILD_CREATE_CONCURRENCY: int = 2
+    GATEWAY_HIDE_INACCESSIBLE_CHANNELS: bool = False
+    GATEWAY_BATCH_DISPATCH: bool = True
+    GATEWAY_PERMISSION_CACHE_SIZE: int = 1000
+    GATEWAY_SHARDING: ConfigGatewaySharding = Field(default_factory=ConfigGatewaySharding)
+    GATEWAY_SUBSCRIPTIONS: Literal["shards", "interest"] = "shards"
+    GATEWAY_ZSTD: ConfigGatewayZstd = Field(default_factory=ConfigGatewayZstd)
     BCRYPT_ROUNDS: int = 15
     CAPTCHA: ConfigCaptcha = Field(default_factory=ConfigCaptcha)
     CONNECTIONS: ConfigConnections = Field(default_factory=ConfigConnections)
@@ -153,6 +203,13 @@ class ConfigModel(BaseModel):
 
         return value
 
+    @field_validator("GATEWAY_GUILD_CREATE_BATCH", "GATEWAY_GUILD_CREATE_CONCURRENCY")
+    def validate_gw_guild_create(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("GATEWAY_GUILD_CREATE_BATCH and GATEWAY_GUILD_CREATE_CONCURRENCY must be greater than 0!")
+
+        return value
+
     @field_validator("BCRYPT_ROUNDS")
     def validate_bcrypt_rounds(cls, value: int) -> int:
         if value < 12:
@@ -180,6 +237,22 @@ class _Config(Singleton):
     MESSAGE_BROKER: dict
     REDIS_URL: Optional[str]
     GATEWAY_KEEP_ALIVE_DELAY: int
+    GATEWAY_HEARTBEAT_GRACE: int
+    GATEWAY_PRESENCE_CACHE_TTL: int
+    GATEWAY_MAX_QUEUE_MESSAGES: int
+    GATEWAY_MAX_QUEUE_BYTES: int
+    GATEWAY_METRICS: bool
+    GATEWAY_SESSION_TIMEOUT: int
+    GATEWAY_RESUME_BUFFER_SIZE: int
+    GATEWAY_LAZY_GUILDS: bool
+    GATEWAY_GUILD_CREATE_BATCH: int
+    GATEWAY_GUILD_CREATE_CONCURRENCY: int
+    GATEWAY_HIDE_INACCESSIBLE_CHANNELS: bool
+    GATEWAY_BATCH_DISPATCH: bool
+    GATEWAY_PERMISSION_CACHE_SIZE: int
+    GATEWAY_SHARDING: dict
+    GATEWAY_SUBSCRIPTIONS: str
+    GATEWAY_ZSTD: dict
     BCRYPT_ROUNDS: int
     CAPTCHA: dict
     CONNECTIONS: dict
@@ -18,24 +18,70 @@
 
 from __future__ import annotations
 
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Optional
-
-from tortoise.expressions import RawSQL
+from os import urandom
+from typing import Optional, AsyncIterator
 
 from . import ctx
+from .config import Config
 from .utils.singleton import Singleton
 from .enums import ChannelType
-from .errors import InvalidDataErr
-from .models import Channel, Guild, Role
+from .models import Channel, Guild
 from .mq_broker import getBroker
+from .permissions import PermissionCache
+from .sharding import route_message, shards_count, interest_subscriptions
 from ..gateway.events import DispatchEvent, ChannelPinsUpdateEvent, MessageAckEvent, GuildEmojisUpdate, \
     StickersUpdateEvent
 
+# Events that change guild json sent in READY/GUILD_CREATE, gateways drop cached guild when they receive one of these:
+# guild properties, member_count, channels, roles, emojis, stickers and scheduled events (with user_count).
+# Channels' last_message_id is updated by gateways in place (see GuildCache.set_last_message_id/delete_messages)
+GUILD_CACHE_EVENTS = {
+    "GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE", "GUILD_MEMBER_ADD", "GUILD_MEMBER_REMOVE", "CHANNEL_CREATE",
+    "CHANNEL_UPDATE", "CHANNEL_DELETE", "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+    "GUILD_EMOJIS_UPDATE", "GUILD_STICKERS_UPDATE", "GUILD_SCHEDULED_EVENT_CREATE", "GUILD_SCHEDULED_EVENT_UPDATE",
+    "GUILD_SCHEDULED_EVENT_DELETE", "GUILD_SCHEDULED_EVENT_USER_ADD", "GUILD_SCHEDULED_EVENT_USER_REMOVE",
+}
+
+
+def _changed_guild_id(event_name: str, data: dict, guild_id: Optional[int]) -> Optional[int]:
+    if event_name not in GUILD_CACHE_EVENTS:
+        return
+    if guild_id is not None:
+        return guild_id
+    body = data.get("d") or {}
+    if (changed := body.get("guild_id")) is None and event_name.startswith("GUILD_"):
+        changed = body.get("id")
+    return int(changed) if changed is not None else None
+
+
+class DispatchBatch:
+    """Messages dispatched inside of GatewayDispatcher.batch(), grouped by broker channel (in dispatch order)"""
+
+    __slots__ = ("messages", "closed",)
+
+    def __init__(self):
+        self.messages: dict[str, list[dict]] = {}
+        self.closed = False
+
+    def add(self, channel: str, message: dict) -> None:
+        self.messages.setdefault(channel, []).append(message)
+
+    def pop(self) -> dict[str, list[dict]]:
+        messages, self.messages = self.messages, {}
+        return messages
+
 
 class GatewayDispatcher(Singleton):
     def __init__(self):
         self.broker = getBroker()
+        self.permissions = PermissionCache()
+        self._batch: ContextVar[Optional[DispatchBatch]] = ContextVar("dispatch_batch", default=None)
+        self._origin = urandom(8).hex()
+        # Permission changes dispatched by other processes (see PermissionCache)
+        self.broker.subscriber("yepcord_sys_events")(self._sys_events_callback)
 
     async def init(self) -> GatewayDispatcher:
         await self.broker.start()
@@ -50,8 +96,11 @@ class GatewayDispatcher(Singleton):
                        channel: Optional[Channel] = None, permissions: Optional[int] = 0) -> None:
         if not user_ids and not guild_id and not role_ids and not session_id and not channel:
             return
+        event_data = await event.json()
+        if (change := self.permissions.handle_event(event.NAME, event_data, guild_id)) is not None:
+            await self._publish("yepcord_sys_events", {"event": "permissions", "origin": self._origin, **change})
         data = {
-            "data": await event.json(),
+            "data": event_data,
             "event": event.NAME,
             "user_ids": user_ids,
             "guild_id": guild_id,
@@ -64,11 +113,61 @@ class GatewayDispatcher(Singleton):
             data["role_ids"] = await self.getRolesByPermissions(guild_id, permissions)
         if channel is not None:
             data |= await self.getChannelFilter(channel, permissions)
-        await self.broker.publish(channel="yepcord_events", message=data)
+            if channel.guild_id is not None:
+                guild_id = channel.guild_id
+        if (changed_guild_id := _changed_guild_id(event.NAME, data["data"], guild_id)) is not None:
+            data["guild_changed"] = changed_guild_id
+        shards = None
+        if guild_id is not None and shards_count() > 1 and not interest_subscriptions():
+            # Guild events only go to shards that hold members of guild
+            if (engine := await self.permissions.get(guild_id)) is not None:
+                shards = engine.shards()
+        batch = self._batch.get()
+        for broker_channel, message in route_message(data, guild_id, shards):
+            if batch is not None and not batch.closed:
+                batch.add(broker_channel, message)
+            else:
+                await self._publish(broker_channel, message)
+
+    async def _publish(self, channel: str, message: dict) -> None:
+        await self.broker.publish(channel=channel, message=message)
+
+    async def flush(self) -> None:
+        """Publishes messages dispatched in current batch so far, one message (or envelope) per broker channel"""
+        if (batch := self._batch.get()) is None:
+            return
+        for channel, messages in batch.pop().items():
+            await self._publish(channel, messages[0] if len(messages) == 1 else {"batch": messages})
+
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[None]:
+        """
+        Events dispatched inside of this context (and tasks created in it) are published when it exits:
+        several messages to the same broker channel are published as one {"batch": [...]} envelope, which gateways
+        unpack in order. System events flush batch before they are published, so they are never reordered
+        with events dispatched before them.
+        """
+        if not Config.GATEWAY_BATCH_DISPATCH or self._batch.get() is not None:
+            yield
+            return
+        token = self._batch.set(DispatchBatch())
+        try:
+            yield
+        finally:
+            try:
+                await self.flush()
+            finally:
+                self._batch.get().closed = True
+                self._batch.reset(token)
+
+    async def _sys_events_callback(self, body: dict) -> None:
+        if body["event"] == "permissions" and body["origin"] != self._origin:
+            self.permissions.apply(body)
 
     async def dispatchSys(self, event: str, data: dict) -> None:
         data |= {"event": event}
-        await self.broker.publish(channel="yepcord_sys_events", message=data)
+        await self.flush()
+        await self._publish("yepcord_sys_events", data)
 
     async def dispatchSub(self, user_ids: list[int], guild_id: int = None, role_id: int = None) -> None:
         await self.dispatchSys("sub", {
@@ -85,8 +184,21 @@ class GatewayDispatcher(Singleton):
             "delete": delete,
         })
 
+    async def dispatchRelatedUsers(self, user_ids: list[int], other_ids: list[int], removed: bool = False) -> None:
+        """
+        Notifies gateways that every user from `user_ids` became related (friend, pending request, dm recipient)
+        to every user from `other_ids` and vice versa. If `removed` is True, one of the relations between them was
+        removed, so gateways reload related users of these users.
+        """
+        await self.dispatchSys("related", {
+            "user_ids": user_ids,
+            "other_ids": other_ids,
+            "removed": removed,
+        })
+
     async def dispatchRA(self, op: str, data: dict) -> None:
-        await self.broker.publish(channel="yepcord_remote_auth", message={
+        await self.flush()
+        await self._publish("yepcord_remote_auth", {
             "op": op,
             **data
         })
@@ -110,7 +222,7 @@ class GatewayDispatcher(Singleton):
         if message := await channel.get_last_pinned_message():
             ts = message.pinned_timestamp
         ts = ts.strftime("%Y-%m-%dT%H:%M:%S+00:00")
-        await self.dispatch(ChannelPinsUpdateEvent(channel.id, ts), **(await self.getChannelFilter(channel)))
+        await self.dispatch(ChannelPinsUpdateEvent(channel.id, ts), channel=channel)
 
     async def sendGuildEmojisUpdateEvent(self, guild: Guild) -> None:
         emojis = [
@@ -130,42 +242,14 @@ class GatewayDispatcher(Singleton):
         if channel.type in {ChannelType.DM, ChannelType.GROUP_DM}:
             return {"user_ids": await channel.recipients.all().values_list("id", flat=True)}
 
-        await channel.fetch_related("guild", "guild__owner")
-        roles = {role.id: role.permissions for role in await channel.guild.get_roles()}
-
-        user_ids = set()
-        excluded_user_ids = set()
-        overwrites = await channel.get_permission_overwrites()
-        for overwrite in overwrites:
-            if overwrite.type == 0:
-                role_id = overwrite.target_role.id
-                if role_id not in roles:
-                    continue
-                roles[role_id] &= ~overwrite.deny
-                roles[role_id] |= overwrite.allow
-            else:
-                if not (member := await channel.guild.get_member(overwrite.target_user.id)):
-                    continue
-                try:
-                    await member.checkPermission(permissions, channel=channel)
-                    user_ids.add(member.user.id)
-                except InvalidDataErr:
-                    excluded_user_ids.add(member.user.id)
-
-        result_roles = []
-        for role_id, perms in roles.items():
-            if perms & permissions == permissions or perms & 8 == 8:
-                result_roles.append(role_id)
-
-        user_ids.add(channel.guild.owner.id)
-        if channel.guild.owner.id in excluded_user_ids:
-            excluded_user_ids.remove(channel.guild.owner.id)
-
-        return {"role_ids": result_roles, "user_ids": list(user_ids), "exclude": list(excluded_user_ids)}
+        if (engine := await self.permissions.get(channel.guild_id)) is None:
+            return {"role_ids": [], "user_ids": [], "exclude": []}
+        return engine.channel_filter(channel.id, permissions)
 
     async def getRolesByPermissions(self, guild_id: int, permissions: int = 0) -> list[int]:
-        return await Role.filter(guild__id=guild_id).annotate(perms=RawSQL(f"permissions & {permissions}"))\
-            .filter(perms=permissions).values_list("id", flat=True)
+        if (index := await self.permissions.roles(guild_id)) is None:
+            return []
+        return list(index.role_ids(permissions))
 
 
 ctx._get_gw = GatewayDispatcher.getInstance
@@ -31,6 +31,10 @@ import yepcord.yepcord.models as models
 from ._utils import SnowflakeField, Model
 from ..snowflake import Snowflake
 
+_OVERWRITES_CHANNELS = {
+    ChannelType.GUILD_CATEGORY, ChannelType.GUILD_TEXT, ChannelType.GUILD_VOICE, ChannelType.GUILD_NEWS,
+}
+
 
 class ChannelUtils:
     @staticmethod
@@ -109,19 +113,18 @@ class Channel(Model):
 
     async def get_last_message_id(self) -> int:
         if self._last_message_id is None and \
-                (last_message := await models.Message.filter(channel=self).group_by("-id").first()) is not None:
+                (last_message := await models.Message.filter(channel=self).order_by("-id").first()) is not None:
             self._last_message_id = last_message.id
 
         return self._last_message_id
 
     async def ds_json(self, user_id: int=None, with_ids: bool=True) -> dict:
         last_message_id = await self.get_last_message_id()
-        last_message_id = str(last_message_id) if last_message_id is not None else None
         recipients = []
         if self.type in (ChannelType.DM, ChannelType.GROUP_DM):
             recipients = await (self.recipients.all() if not user_id else self.recipients.filter(~Q(id=user_id)).all())
             if with_ids:
-                recipients = [str(recipient.id) for recipient in recipients]
+                recipients = [recipient.id for recipient in recipients]
             else:
                 _recipients = recipients
                 recipients = []
@@ -129,6 +132,50 @@ class Channel(Model):
                     userdata = await recipient.data
                     recipients.append(userdata.ds_json)
 
+        if self.type != ChannelType.GUILD_PUBLIC_THREAD:
+            overwrites = []
+            if self.type in _OVERWRITES_CHANNELS:
+                overwrites = [overwrite.ds_json() for overwrite in await self.get_permission_overwrites()]
+            return self.ds_json_preloaded(last_message_id, recipients, overwrites, with_ids)
+
+        last_message_id = str(last_message_id) if last_message_id is not None else None
+        message_count = await models.Message.filter(channel=self).count()
+        data: dict = {
+            "id": str(self.id),
+            "type": self.type,
+            "guild_id": str(self.guild.id),
+            "parent_id": str(self.parent.id) if self.parent else None,
+            "owner_id": str(self.owner.id),
+            "name": self.name,
+            "last_message_id": last_message_id,
+            "thread_metadata": (await models.ThreadMetadata.get(channel=self)).ds_json(),
+            "message_count": message_count,
+            "member_count": await models.ThreadMember.filter(channel=self).count(),
+            "rate_limit_per_user": self.rate_limit,
+            "flags": self.flags,
+            "total_message_sent": message_count,
+            "member_ids_preview": [
+                str(member.user.id)
+                for member in await self.get_thread_members()
+            ],
+        }
+        if user_id and (member := await self.get_thread_member(user_id)) is not None:
+            data["member"] = {
+                "muted": False,
+                "mute_config": None,
+                "join_timestamp": member.joined_at.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
+                "flags": 1
+            }
+
+        return data
+
+    def ds_json_preloaded(
+            self, last_message_id: Optional[int], recipients: list, overwrites: list[dict], with_ids: bool = True,
+    ) -> Optional[dict]:
+        last_message_id = str(last_message_id) if last_message_id is not None else None
+        if with_ids:
+            recipients = [str(recipient) for recipient in recipients]
+
         base_data = {
             "id": str(self.id),
             "type": self.type,
@@ -150,9 +197,7 @@ class Channel(Model):
         elif self.type == ChannelType.GUILD_CATEGORY:
             return base_data | {
                 "position": self.position,
-                "permission_overwrites": [
-                    overwrite.ds_json() for overwrite in await self.get_permission_overwrites()
-                ],
+                "permission_overwrites": overwrites,
                 "parent_id": str(self.parent.id) if self.parent else None,
                 "name": self.name,
                 "flags": self.flags,
@@ -163,9 +208,7 @@ class Channel(Model):
                 "topic": self.topic,
                 "rate_limit_per_user": self.rate_limit,
                 "position": self.position,
-                "permission_overwrites": [
-                    overwrite.ds_json() for overwrite in await self.get_permission_overwrites()
-                ],
+                "permission_overwrites": overwrites,
                 "parent_id": str(self.parent.id) if self.parent else None,
                 "name": self.name,
                 "last_message_id": last_message_id,
@@ -179,9 +222,7 @@ class Channel(Model):
                 "rtc_region": self.rtc_region,
                 "rate_limit_per_user": self.rate_limit,
                 "position": self.position,
-                "permission_overwrites": [
-                    overwrite.ds_json() for overwrite in await self.get_permission_overwrites()
-                ],
+                "permission_overwrites": overwrites,
                 "parent_id": str(self.parent.id) if self.parent else None,
                 "name": self.name,
                 "last_message_id": last_message_id,
@@ -193,9 +234,7 @@ class Channel(Model):
             return base_data | {
                 "topic": self.topic,
                 "position": self.position,
-                "permission_overwrites": [
-                    overwrite.ds_json() for overwrite in await self.get_permission_overwrites()
-                ],
+                "permission_overwrites": overwrites,
                 "parent_id": str(self.parent.id) if self.parent else None,
                 "name": self.name,
                 "last_message_id": last_message_id,
@@ -203,34 +242,6 @@ class Channel(Model):
                 "guild_id": str(self.guild.id),
                 "nsfw": self.nsfw
             }
-        elif self.type == ChannelType.GUILD_PUBLIC_THREAD:
-            message_count = await models.Message.filter(channel=self).count()
-            data: dict = base_data | {
-                "guild_id": str(self.guild.id),
-                "parent_id": str(self.parent.id) if self.parent else None,
-                "owner_id": str(self.owner.id),
-                "name": self.name,
-                "last_message_id": last_message_id,
-                "thread_metadata": (await models.ThreadMetadata.get(channel=self)).ds_json(),
-                "message_count": message_count,
-                "member_count": await models.ThreadMember.filter(channel=self).count(),
-                "rate_limit_per_user": self.rate_limit,
-                "flags": self.flags,
-                "total_message_sent": message_count,
-                "member_ids_preview": [
-                    str(member.user.id)
-                    for member in await self.get_thread_members()
-                ],
-            }
-            if user_id and (member := await self.get_thread_member(user_id)) is not None:
-                data["member"] = {
-                    "muted": False,
-                    "mute_config": None,
-                    "join_timestamp": member.joined_at.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
-                    "flags": 1
-                }
-
-            return data
 
     async def get_messages(self, limit: int = 50, before: int = 0, after: int = 0) -> list[models.Message]:
         id_filter = {}
@@ -288,11 +299,12 @@ class Channel(Model):
         )
 
     async def get_permission_overwrites(
-            self, target: Optional[models.GuildMember] = None
+            self, target: Optional[models.GuildMember] = None, role_ids: Optional[list[int]] = None,
     ) -> list[models.PermissionOverwrite]:
         query = models.PermissionOverwrite.filter(channel=self).select_related("target_role", "target_user")
         if target is not None:
-            role_ids = [target.guild.id, *(await target.roles.all().values_list("id", flat=True))]
+            if role_ids is None:
+                role_ids = [target.guild.id, *(await target.roles.all().values_list("id", flat=True))]
             query = query.filter(Q(target_role__id__in=role_ids) | Q(target_user__id=target.user.id)).order_by("type")
 
         return await query
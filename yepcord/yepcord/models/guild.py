@@ -153,16 +153,42 @@ class Guild(Model):
     async def ds_json(
             self, user_id: int, for_gateway: bool = False, with_member: Optional[models.GuildMember] = None,
             with_channels: bool = False
+    ) -> dict:
+        data = self.ds_json_preloaded(
+            stickers=[await sticker.ds_json() for sticker in await self.get_stickers()],
+            roles=[role.ds_json() for role in await self.get_roles()],
+            member_count=await self.get_member_count(),
+            events=[await event.ds_json() for event in await self.get_events()],
+            emojis=[await emoji.ds_json(False) for emoji in await self.get_emojis()],
+            for_gateway=for_gateway,
+        )
+
+        if for_gateway or user_id:
+            member = await self.get_member(user_id)
+            data["joined_at"] = member.joined_at.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00")
+            data["threads"] = [
+                thread.ds_json()
+                for thread in await models.ThreadMember.filter(guild=self, user__id=user_id).select_related(
+                    "channel", "user", "guild"
+                )
+            ]
+        if for_gateway or with_channels:
+            data["channels"] = [await channel.ds_json() for channel in await self.get_channels()]
+        if with_member is not None:
+            data["members"] = [await with_member.ds_json()]
+
+        return data
+
+    def ds_json_preloaded(
+            self, stickers: list[dict], roles: list[dict], member_count: int, events: list[dict], emojis: list[dict],
+            for_gateway: bool = False,
     ) -> dict:
         data = {
             "id": str(self.id),
             "version": int(time() * 1000),  # What is this?
-            "stickers": [
-                await sticker.ds_json()
-                for sticker in await self.get_stickers()
-            ],
+            "stickers": stickers,
             "stage_instances": [],
-            "roles": [role.ds_json() for role in await self.get_roles()],
+            "roles": roles,
             "properties": {
                 "afk_timeout": self.afk_timeout,
                 "splash": self.splash,
@@ -211,17 +237,11 @@ class Guild(Model):
                 "widget_channel_id": None,
             },
             "premium_subscription_count": 30,
-            "member_count": await self.get_member_count(),
+            "member_count": member_count,
             "lazy": True,
             "large": False,
-            "guild_scheduled_events": [
-                await event.ds_json()
-                for event in await self.get_events()
-            ],
-            "emojis": [
-                await emoji.ds_json(False)
-                for emoji in await self.get_emojis()
-            ],
+            "guild_scheduled_events": events,
+            "emojis": emojis,
             "data_mode": "full",
             "application_command_counts": [],
         }
@@ -231,20 +251,6 @@ class Guild(Model):
             del data["properties"]
             data.update(props)
 
-        if for_gateway or user_id:
-            member = await self.get_member(user_id)
-            data["joined_at"] = member.joined_at.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00")
-            data["threads"] = [
-                thread.ds_json()
-                for thread in await models.ThreadMember.filter(guild=self, user__id=user_id).select_related(
-                    "channel", "user", "guild"
-                )
-            ]
-        if for_gateway or with_channels:
-            data["channels"] = [await channel.ds_json() for channel in await self.get_channels()]
-        if with_member is not None:
-            data["members"] = [await with_member.ds_json()]
-
         return data
 
     async def get_roles(self, exclude_default: bool = False) -> list[models.Role]:
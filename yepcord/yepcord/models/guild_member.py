@@ -22,12 +22,14 @@ from datetime import datetime
 from typing import Optional
 
 from tortoise import fields
+from tortoise.expressions import Q
 
 from ..enums import GuildPermissions
 from ..errors import MissingPermissions
 from ._utils import SnowflakeField, Model
 from ..snowflake import Snowflake
 import yepcord.yepcord.models as models
+import yepcord.yepcord.permissions as guild_permissions
 
 
 class PermissionsChecker:
@@ -40,13 +42,19 @@ class PermissionsChecker:
         guild = self.member.guild
         if guild.owner == self.member.user:
             return
-        permissions = await self.member.permissions
+        roles = await self.member.get_roles()
+        permissions = 0
+        for role in roles:
+            permissions |= role.permissions
         if _check(permissions, GuildPermissions.ADMINISTRATOR):
             return
         if channel:
-            for overwrite in await channel.get_permission_overwrites(self.member):
-                permissions &= ~overwrite.deny
-                permissions |= overwrite.allow
+            role_ids = [role.id for role in roles]
+            overwrites = await channel.get_permission_overwrites(self.member, role_ids)
+            permissions = guild_permissions.apply_overwrites(
+                permissions, guild.id, self.member.user.id, role_ids,
+                {overwrite.target.id: (overwrite.allow, overwrite.deny) for overwrite in overwrites},
+            )
 
         for permission in check_permissions:
             if not _check(permissions, permission):
@@ -105,6 +113,12 @@ class GuildMember(Model):
         return Snowflake.toDatetime(self.id)
 
     async def ds_json(self, with_user=True) -> dict:
+        return self.ds_json_preloaded(
+            await self.roles.all().values_list("id", flat=True),
+            (await self.user.userdata) if with_user else None,
+        )
+
+    def ds_json_preloaded(self, role_ids: list[int], userdata: Optional[models.UserData] = None) -> dict:
         data = {
             "avatar": self.avatar,
             "communication_disabled_until": self.communication_disabled_until,
@@ -113,14 +127,14 @@ class GuildMember(Model):
             "nick": self.nick,
             "is_pending": False,
             "pending": False,
-            "premium_since": self.user.created_at.strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
-            "roles": [str(role_id) for role_id in await self.roles.all().values_list("id", flat=True)],
+            "premium_since": Snowflake.toDatetime(self.user_id).strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
+            "roles": [str(role_id) for role_id in role_ids],
             "mute": self.mute,
             "deaf": self.deaf
         }
 
-        if with_user:
-            data["user"] = (await self.user.userdata).ds_json
+        if userdata is not None:
+            data["user"] = userdata.ds_json
 
         return data
 
@@ -129,9 +143,10 @@ class GuildMember(Model):
         return PermissionsChecker(self)
 
     async def get_roles(self, with_default: bool = True) -> list[models.Role]:
-        roles = await self.roles.all()
+        query = Q(guildmembers__id=self.id)
         if with_default:
-            roles.append(await models.Role.get(id=self.guild.id))
+            query |= Q(id=self.guild.id)
+        roles = await models.Role.filter(query)
 
         return sorted(roles, key=lambda r: r.position)
 
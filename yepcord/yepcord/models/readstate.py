@@ -18,6 +18,7 @@
 
 from __future__ import annotations
 
+from datetime import datetime
 from typing import Optional
 
 from tortoise import fields
@@ -41,7 +42,10 @@ class ReadState(Model):
 
     async def ds_json(self) -> dict:
         last_pin = await self.channel.get_last_pinned_message()
-        last_pin_ts = last_pin.pinned_timestamp.strftime("%Y-%m-%dT%H:%M:%S+00:00") if last_pin is not None else None
+        return self.ds_json_preloaded(last_pin.pinned_timestamp if last_pin is not None else None)
+
+    def ds_json_preloaded(self, last_pin_timestamp: Optional[datetime]) -> dict:
+        last_pin_ts = last_pin_timestamp.strftime("%Y-%m-%dT%H:%M:%S+00:00") if last_pin_timestamp is not None else None
         return {
             "mention_count": self.count,
             "last_pin_timestamp": last_pin_ts,
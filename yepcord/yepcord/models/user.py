@@ -322,18 +322,22 @@ class User(Model):
             if not (relationship.type == RelationshipType.BLOCK and relationship.from_user.id != self.id)
         ]
 
-    async def get_related_users(self) -> list[models.User]:
-        users = {
-            relationship.other_user(self).id: relationship.other_user(self)
-            for relationship in await self.get_relationships()
-        }
-        for channel in await models.Channel.filter(recipients__id=self.id):
-            for recipient in await channel.recipients.all():
-                if recipient.id in users or recipient == self:
-                    continue
-                users[recipient.id] = recipient
+    async def get_related_user_ids(self) -> set[int]:
+        user_ids = set()
+        relationships = await models.Relationship.filter(Q(from_user=self) | Q(to_user=self))\
+            .values_list("from_user_id", "to_user_id", "type")
+        for from_user_id, to_user_id, type_ in relationships:
+            if type_ == RelationshipType.BLOCK and from_user_id != self.id:
+                continue
+            user_ids.add(to_user_id if from_user_id == self.id else from_user_id)
+
+        channels = models.Channel.filter(recipients__id=self.id).values_list("id", flat=True)
+        user_ids.update(await User.filter(recipients__id__in=Subquery(channels)).values_list("id", flat=True))
+        user_ids.discard(self.id)
+        return user_ids
 
-        return list(users.values())
+    async def get_related_users(self) -> list[models.User]:
+        return await User.filter(id__in=await self.get_related_user_ids())
 
     async def get_mfa_key(self) -> str | None:
         return cast(str, await models.UserSettings.get(user=self).values_list("mfa", flat=True))
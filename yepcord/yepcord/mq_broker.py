@@ -19,14 +19,14 @@
 import asyncio
 import warnings
 from json import dumps, loads
-from typing import Union, Optional, Callable, Coroutine
+from typing import Union, Optional, Callable, Coroutine, Any
 
 import websockets.exceptions
 from async_timeout import timeout
-from faststream.rabbit import RabbitBroker
-from faststream.redis import RedisBroker
-from faststream.kafka import KafkaBroker
-from faststream.nats import NatsBroker
+from faststream.rabbit import RabbitBroker, RabbitRouter
+from faststream.redis import RedisBroker, RedisRouter
+from faststream.kafka import KafkaBroker, KafkaRouter
+from faststream.nats import NatsBroker, NatsRouter
 from websockets.client import connect
 from websockets.legacy.client import WebSocketClientProtocol
 from websockets.legacy.server import WebSocketServer
@@ -170,6 +170,90 @@ class WsBroker:
 
         return _handle
 
+    def unsubscribe(self, channel: str, func: Callable) -> None:
+        if (handlers := self._handlers.get(channel)) is None:
+            return
+        handlers.discard(func)
+        if not handlers:
+            del self._handlers[channel]
+
+
+class DynamicSubscriptions:
+    """
+    Broker subscriptions that are added and removed at runtime.
+    Changes are applied one by one in background task, so quick subscribe-unsubscribe sequences can't race.
+    Subscribers are created with separate routers and are not registered in broker, so they are owned (started and
+    closed) only by this object.
+    """
+
+    _routers = {
+        RabbitBroker: RabbitRouter,
+        RedisBroker: RedisRouter,
+        KafkaBroker: KafkaRouter,
+        NatsBroker: NatsRouter,
+    }
+
+    def __init__(self, broker: Union[RabbitBroker, RedisBroker, KafkaBroker, NatsBroker, WsBroker], handler: Callable):
+        self._broker = broker
+        self._handler = handler
+        self._active: dict[str, Any] = {}
+        self._wanted: set[str] = set()
+        self._pending: dict[str, None] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def channels(self) -> set[str]:
+        return set(self._active)
+
+    def want(self, channel: str, subscribed: bool) -> None:
+        if subscribed:
+            self._wanted.add(channel)
+        else:
+            self._wanted.discard(channel)
+        self._pending[channel] = None
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._sync())
+
+    async def wait(self) -> None:
+        """Waits until all requested changes are applied, i.e. subscribers of wanted channels are started"""
+        while self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    async def close(self) -> None:
+        self._wanted.clear()
+        self._pending.clear()
+        await self.wait()
+        for channel in list(self._active):
+            await self._unsubscribe(channel, self._active.pop(channel))
+
+    async def _subscribe(self, channel: str) -> Any:
+        if isinstance(self._broker, WsBroker):
+            return self._broker.subscriber(channel)(self._handler)
+
+        subscriber = self._routers[type(self._broker)]().subscriber(channel)
+        subscriber(self._handler)
+        self._broker.setup_subscriber(subscriber)
+        await subscriber.start()
+        return subscriber
+
+    async def _unsubscribe(self, channel: str, subscriber: Any) -> None:
+        if isinstance(self._broker, WsBroker):
+            return self._broker.unsubscribe(channel, self._handler)
+
+        await subscriber.close()
+
+    async def _sync(self) -> None:
+        while self._pending:
+            channel = next(iter(self._pending))
+            del self._pending[channel]
+            try:
+                if channel in self._wanted and channel not in self._active:
+                    self._active[channel] = await self._subscribe(channel)
+                elif channel not in self._wanted and channel in self._active:
+                    await self._unsubscribe(channel, self._active.pop(channel))
+            except Exception as e:  # pragma: no cover
+                warnings.warn(f"Failed to change subscription to {channel}: {e.__class__.__name__}: {e}.")
+
 
 _brokers = {
     "rabbitmq": RabbitBroker,
@@ -0,0 +1,473 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Optional, Iterable, Iterator, Callable, Awaitable, Any
+
+import yepcord.yepcord.models as models
+from .config import Config
+from .enums import GuildPermissions
+from .sharding import user_shard
+
+ALL_PERMISSIONS = 562949953421311
+
+# Events after which cached permission engine of guild is dropped
+PERMISSION_EVENTS = {
+    "GUILD_UPDATE", "GUILD_DELETE", "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE", "GUILD_ROLE_CREATE",
+    "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+}
+# Events that change roles (or membership) of one member, they are applied to cached engine in place
+MEMBER_PERMISSION_EVENTS = {"GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE"}
+
+Overwrites = dict[int, tuple[int, int]]  # Role or user id -> (allow, deny)
+
+
+def apply_overwrites(permissions: int, guild_id: int, user_id: int, role_ids: Iterable[int],
+                     overwrites: Overwrites) -> int:
+    """
+    Applies channel overwrites to guild permissions of member: @everyone overwrite, then overwrites of all member roles
+    at once (allow wins over deny), then overwrite of member itself.
+    """
+    if (overwrite := overwrites.get(guild_id)) is not None:
+        permissions = (permissions & ~overwrite[1]) | overwrite[0]
+    allow = deny = 0
+    for role_id in role_ids:
+        if role_id != guild_id and (overwrite := overwrites.get(role_id)) is not None:
+            allow |= overwrite[0]
+            deny |= overwrite[1]
+    permissions = (permissions & ~deny) | allow
+    if (overwrite := overwrites.get(user_id)) is not None:
+        permissions = (permissions & ~overwrite[1]) | overwrite[0]
+    return permissions
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+def _bits(permissions: int) -> Iterator[int]:
+    while permissions:
+        bit = permissions & -permissions
+        yield bit
+        permissions ^= bit
+
+
+class RoleIndex:
+    """
+    Role ids of guild by permission bit, used to find roles that have all of given permissions without a query.
+    Roles with ADMINISTRATOR have every permission.
+    """
+
+    __slots__ = ("all", "admins", "_by_bit",)
+
+    def __init__(self, roles: dict[int, int]):
+        self.all = frozenset(roles)
+        self.admins = frozenset(
+            role_id for role_id, permissions in roles.items() if permissions & GuildPermissions.ADMINISTRATOR
+        )
+        by_bit: dict[int, set[int]] = {}
+        for role_id, permissions in roles.items():
+            for bit in _bits(permissions):
+                by_bit.setdefault(bit, set()).add(role_id)
+        self._by_bit = {bit: frozenset(role_ids) for bit, role_ids in by_bit.items()}
+
+    @classmethod
+    async def load(cls, guild_id: int) -> Optional[RoleIndex]:
+        roles = dict(await models.Role.filter(guild_id=guild_id).values_list("id", "permissions"))
+        return cls(roles) if roles else None
+
+    def role_ids(self, permissions: int = 0) -> set[int]:
+        result = set(self.all)
+        for bit in _bits(permissions):
+            if not (result := result & self._by_bit.get(bit, frozenset())):
+                break
+        return result | self.admins
+
+
+class PermissionEngine:
+    """
+    Computes effective permissions of many members in many channels at once.
+    Members with the same set of roles have the same permissions in every channel (unless they have user overwrite),
+    so members are grouped into role-set classes and permissions are computed once per class and channel.
+    Every member has an index, and class members (and results of members_with) are int bitsets of these indexes,
+    so audience of channel is a few bitwise operations on ints instead of loop over members.
+    Roles and overwrites are fixed for lifetime of engine (it is dropped when they change), members are updated
+    in place with set_member/remove_member.
+    """
+
+    __slots__ = ("id", "owner_id", "roles", "overwrites", "_users", "_index", "_free", "_member_class", "_classes",
+                 "_class_roles", "_class_base", "_class_members", "_holders", "_role_index", "_shard_members",)
+
+    def __init__(self, guild_id: int, owner_id: int, roles: dict[int, int], overwrites: dict[int, Overwrites],
+                 member_roles: dict[int, Iterable[int]]):
+        self.id = guild_id
+        self.owner_id = owner_id
+        self.roles = roles
+        self.overwrites = overwrites
+        self._users: list[Optional[int]] = []
+        self._index: dict[int, int] = {}
+        self._free: list[int] = []
+        self._member_class: dict[int, int] = {}
+        self._classes: dict[frozenset[int], int] = {}
+        self._class_roles: list[frozenset[int]] = []
+        self._class_base: list[int] = []
+        self._class_members: list[int] = []
+        self._holders: Optional[dict[int, int]] = None
+        self._role_index: Optional[RoleIndex] = None
+        self._shard_members: dict[int, int] = {}
+        for user_id, role_ids in member_roles.items():
+            self.set_member(user_id, role_ids)
+
+    @classmethod
+    async def load(cls, guild_id: int) -> Optional[PermissionEngine]:
+        owner_id = await models.Guild.filter(id=guild_id).first().values_list("owner_id", flat=True)
+        if owner_id is None:
+            return None
+        roles = dict(await models.Role.filter(guild_id=guild_id).values_list("id", "permissions"))
+
+        overwrites: dict[int, Overwrites] = {}
+        for channel_id, role_id, user_id, allow, deny in await models.PermissionOverwrite.filter(
+                channel__guild_id=guild_id,
+        ).values_list("channel_id", "target_role_id", "target_user_id", "allow", "deny"):
+            if (target_id := role_id or user_id) is not None:
+                overwrites.setdefault(channel_id, {})[target_id] = (allow, deny)
+
+        member_roles: dict[int, list[int]] = {}
+        for user_id, role_id in await models.GuildMember.filter(guild_id=guild_id).values_list("user_id", "roles__id"):
+            roles_ = member_roles.setdefault(user_id, [])
+            if role_id is not None:
+                roles_.append(role_id)
+
+        return cls(guild_id, owner_id, roles, overwrites, member_roles)
+
+    @classmethod
+    def from_guild_json(cls, guild: dict, member_roles: dict[int, Iterable[int]]) -> PermissionEngine:
+        """Creates engine from guild object of READY/GUILD_CREATE (roles and channels with permission_overwrites)"""
+        return cls(
+            int(guild["id"]),
+            int(guild["owner_id"] if "owner_id" in guild else guild["properties"]["owner_id"]),
+            {int(role["id"]): int(role["permissions"]) for role in guild["roles"]},
+            {
+                int(channel["id"]): {
+                    int(overwrite["id"]): (int(overwrite["allow"]), int(overwrite["deny"]))
+                    for overwrite in channel.get("permission_overwrites", ())
+                }
+                for channel in guild["channels"]
+            },
+            member_roles,
+        )
+
+    def __len__(self) -> int:
+        return len(self._member_class)
+
+    @property
+    def role_index(self) -> RoleIndex:
+        if self._role_index is None:
+            self._role_index = RoleIndex(self.roles)
+        return self._role_index
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._member_class
+
+    def _class(self, role_ids: Iterable[int]) -> int:
+        key = frozenset(role_id for role_id in role_ids if role_id in self.roles and role_id != self.id)
+        if (class_idx := self._classes.get(key)) is not None:
+            return class_idx
+
+        base = self.roles.get(self.id, 0)
+        for role_id in key:
+            base |= self.roles[role_id]
+        class_idx = self._classes[key] = len(self._class_roles)
+        self._class_roles.append(key)
+        self._class_base.append(ALL_PERMISSIONS if base & GuildPermissions.ADMINISTRATOR else base)
+        self._class_members.append(0)
+        return class_idx
+
+    def set_member(self, user_id: int, role_ids: Iterable[int]) -> None:
+        if (idx := self._index.get(user_id)) is None:
+            idx = self._index[user_id] = self._free.pop() if self._free else len(self._users)
+            if idx == len(self._users):
+                self._users.append(user_id)
+            self._users[idx] = user_id
+            shard = user_shard(user_id)
+            self._shard_members[shard] = self._shard_members.get(shard, 0) + 1
+        else:
+            self._class_members[self._member_class[user_id]] &= ~(1 << idx)
+        class_idx = self._member_class[user_id] = self._class(role_ids)
+        self._class_members[class_idx] |= 1 << idx
+        self._holders = None
+
+    def remove_member(self, user_id: int) -> None:
+        if (idx := self._index.pop(user_id, None)) is None:
+            return
+        self._class_members[self._member_class.pop(user_id)] &= ~(1 << idx)
+        self._users[idx] = None
+        self._free.append(idx)
+        self._holders = None
+        shard = user_shard(user_id)
+        self._shard_members[shard] -= 1
+        if not self._shard_members[shard]:
+            del self._shard_members[shard]
+
+    def shards(self) -> set[int]:
+        """Returns gateway shards (see sharding.user_shard) of guild members"""
+        return set(self._shard_members)
+
+    def _user_ids(self, bits: int) -> list[int]:
+        users = self._users
+        return [users[idx] for idx, bit in enumerate(reversed(bin(bits)[2:])) if bit == "1"]
+
+    def _bit(self, user_id: int) -> int:
+        return 1 << idx if (idx := self._index.get(user_id)) is not None else 0
+
+    def permissions(self, user_id: int, channel_id: Optional[int] = None) -> Optional[int]:
+        """Returns permissions of member in channel (or in guild if channel_id is None), None if user is not member"""
+        if (class_idx := self._member_class.get(user_id)) is None:
+            return None
+        base = self._class_base[class_idx]
+        if user_id == self.owner_id or base & GuildPermissions.ADMINISTRATOR:
+            return ALL_PERMISSIONS
+        if channel_id is None:
+            return base
+        return apply_overwrites(base, self.id, user_id, self._class_roles[class_idx],
+                                self.overwrites.get(channel_id, {}))
+
+    def class_permissions(self, channel_id: int) -> list[int]:
+        """Returns permissions of every role-set class in channel, ignoring user overwrites"""
+        overwrites = self.overwrites.get(channel_id)
+        if not overwrites:
+            return self._class_base.copy()
+
+        everyone_allow, everyone_deny = overwrites.get(self.id, (0, 0))
+        role_overwrites = {
+            role_id: overwrite
+            for role_id, overwrite in overwrites.items()
+            if role_id in self.roles and role_id != self.id
+        }
+        result = []
+        for role_ids, base in zip(self._class_roles, self._class_base):
+            if base & GuildPermissions.ADMINISTRATOR:
+                result.append(base)
+                continue
+            base = (base & ~everyone_deny) | everyone_allow
+            if role_overwrites:
+                allow = deny = 0
+                for role_id in role_ids:
+                    if (overwrite := role_overwrites.get(role_id)) is not None:
+                        allow |= overwrite[0]
+                        deny |= overwrite[1]
+                base = (base & ~deny) | allow
+            result.append(base)
+        return result
+
+    def members_with(self, channel_id: int, permissions: int) -> int:
+        """Returns bitset (of member indexes) of members that have all of `permissions` in channel"""
+        bits = 0
+        for class_permissions, members in zip(self.class_permissions(channel_id), self._class_members):
+            if class_permissions & permissions == permissions:
+                bits |= members
+        for target_id in self.overwrites.get(channel_id, ()):
+            if target_id in self.roles or (bit := self._bit(target_id)) == 0:
+                continue
+            if self.permissions(target_id, channel_id) & permissions == permissions:
+                bits |= bit
+            else:
+                bits &= ~bit
+        return bits | self._bit(self.owner_id)
+
+    def user_ids_with(self, channel_id: int, permissions: int) -> list[int]:
+        return self._user_ids(self.members_with(channel_id, permissions))
+
+    def channels_with(self, user_id: int, channel_ids: Iterable[int], permissions: int) -> list[int]:
+        return [
+            channel_id for channel_id in channel_ids
+            if (self.permissions(user_id, channel_id) or 0) & permissions == permissions
+        ]
+
+    def compute(self, channel_ids: Iterable[int],
+                user_ids: Optional[Iterable[int]] = None) -> dict[int, dict[int, int]]:
+        """Returns permissions of members (all members if user_ids is None) in every channel from channel_ids"""
+        user_ids = [user_id for user_id in (self._member_class if user_ids is None else user_ids)
+                    if user_id in self._member_class]
+        result = {}
+        for channel_id in channel_ids:
+            classes = self.class_permissions(channel_id)
+            overwrites = self.overwrites.get(channel_id, {})
+            result[channel_id] = {
+                user_id: classes[self._member_class[user_id]]
+                if user_id not in overwrites and user_id != self.owner_id else self.permissions(user_id, channel_id)
+                for user_id in user_ids
+            }
+        return result
+
+    def _role_holders(self) -> dict[int, int]:
+        if self._holders is None:
+            self._holders = holders = {self.id: 0}
+            for role_ids, members in zip(self._class_roles, self._class_members):
+                holders[self.id] |= members
+                for role_id in role_ids:
+                    holders[role_id] = holders.get(role_id, 0) | members
+        return self._holders
+
+    def channel_filter(self, channel_id: int, permissions: int = 0) -> dict:
+        """
+        Returns audience of channel event (role_ids, user_ids and excluded user_ids of broker message).
+        Roles are selected (largest first) if most of their members can see event, members that can see event but
+        have no selected roles are sent by user id, members of selected roles that can not see it are excluded.
+        Owner is always sent by user id.
+        """
+        owner_bit = self._bit(self.owner_id)
+        visible = self.members_with(channel_id, permissions) & ~owner_bit
+        overwrites = self.overwrites.get(channel_id, {})
+
+        role_ids = []
+        covered = 0
+        for role_id, holders in sorted(self._role_holders().items(), key=lambda item: -_popcount(item[1])):
+            if not (holders := holders & ~owner_bit):
+                continue
+            if holders & ~covered and _popcount(holders & visible) >= _popcount(holders & ~visible):
+                role_ids.append(role_id)
+                covered |= holders
+        for role_id, role_permissions in self.roles.items():
+            if self._holders.get(role_id, 0) & ~owner_bit:
+                continue
+            # Nobody (except owner) has this role, it is selected if role alone would be enough to see event
+            if (overwrite := overwrites.get(role_id)) is not None:
+                role_permissions = (role_permissions & ~overwrite[1]) | overwrite[0]
+            if role_permissions & permissions == permissions or role_permissions & GuildPermissions.ADMINISTRATOR:
+                role_ids.append(role_id)
+
+        return {
+            "role_ids": role_ids,
+            "user_ids": [self.owner_id, *self._user_ids(visible & ~covered)],
+            "exclude": self._user_ids(covered & ~visible),
+        }
+
+
+class PermissionCache:
+    """
+    Permission engines of guilds, used by GatewayDispatcher to compute audience of channel events without queries,
+    and role indexes of guilds without engine, used to find roles with permissions for guild-wide events.
+    Every guild being loaded has a version, which is bumped by invalidate() and member updates, so engine loaded
+    while guild roles, overwrites or member roles were changed is not cached. GatewayDispatcher updates cached guilds
+    itself when it dispatches events from PERMISSION_EVENTS/MEMBER_PERMISSION_EVENTS, which every route that changes
+    roles, overwrites, channels or member roles does, and broadcasts changes returned by handle_event() to other
+    processes, which apply them with apply(). At most GATEWAY_PERMISSION_CACHE_SIZE least recently used engines
+    (and as many role indexes) are kept.
+    """
+
+    def __init__(self):
+        self._guilds: OrderedDict[int, PermissionEngine] = OrderedDict()
+        self._role_indexes: OrderedDict[int, RoleIndex] = OrderedDict()
+        self._versions: dict[int, int] = {}
+        self._loading: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._guilds)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._guilds
+
+    @staticmethod
+    def _cached(cache: OrderedDict[int, Any], guild_id: int) -> Any:
+        if (result := cache.get(guild_id)) is not None:
+            cache.move_to_end(guild_id)
+        return result
+
+    async def _load(self, guild_id: int, load: Callable[[int], Awaitable[Any]], cache: OrderedDict[int, Any]) -> Any:
+        self.misses += 1
+        version = self._versions.setdefault(guild_id, 0)
+        self._loading[guild_id] = self._loading.get(guild_id, 0) + 1
+        result = None
+        try:
+            result = await load(guild_id)
+        finally:
+            self._loading[guild_id] -= 1
+            if result is not None and self._versions[guild_id] == version:
+                cache[guild_id] = result
+                while len(cache) > Config.GATEWAY_PERMISSION_CACHE_SIZE:
+                    cache.popitem(last=False)
+            if not self._loading[guild_id]:
+                del self._loading[guild_id]
+                del self._versions[guild_id]
+
+        return result
+
+    async def get(self, guild_id: int) -> Optional[PermissionEngine]:
+        if (engine := self._cached(self._guilds, guild_id)) is not None:
+            self.hits += 1
+            return engine
+        return await self._load(guild_id, PermissionEngine.load, self._guilds)
+
+    async def roles(self, guild_id: int) -> Optional[RoleIndex]:
+        """Returns role index of guild, from cached engine if guild has one (only roles are loaded otherwise)"""
+        if (engine := self._cached(self._guilds, guild_id)) is not None:
+            self.hits += 1
+            return engine.role_index
+        if (index := self._cached(self._role_indexes, guild_id)) is not None:
+            self.hits += 1
+            return index
+        return await self._load(guild_id, RoleIndex.load, self._role_indexes)
+
+    def invalidate(self, guild_id: int) -> None:
+        self._guilds.pop(guild_id, None)
+        self._role_indexes.pop(guild_id, None)
+        if guild_id in self._versions:
+            self._versions[guild_id] += 1
+
+    def member_update(self, guild_id: int, user_id: int, role_ids: Optional[Iterable[int]]) -> None:
+        """Applies new roles of member (role_ids is None if member was removed) to cached engine of guild"""
+        if guild_id in self._versions:
+            self._versions[guild_id] += 1
+        if (engine := self._guilds.get(guild_id)) is None:
+            return
+        if role_ids is None:
+            engine.remove_member(user_id)
+        else:
+            engine.set_member(user_id, role_ids)
+
+    def apply(self, change: dict) -> None:
+        """Applies change returned by handle_event() (possibly in another process)"""
+        if change.get("user_id") is None:
+            self.invalidate(change["guild_id"])
+        else:
+            self.member_update(change["guild_id"], change["user_id"], change["roles"])
+
+    def handle_event(self, event_name: str, data: dict, guild_id: Optional[int]) -> Optional[dict]:
+        """Applies dispatched event to cached guilds, returns applied change if event changes permissions"""
+        if event_name not in PERMISSION_EVENTS and event_name not in MEMBER_PERMISSION_EVENTS:
+            return
+        body = data.get("d") or {}
+        if guild_id is None and (guild_id := body.get("guild_id")) is None and event_name.startswith("GUILD_"):
+            guild_id = body.get("id")
+        if guild_id is None:
+            return
+        change = {"guild_id": int(guild_id)}
+        user_id = (body.get("user") or {}).get("id")
+        if event_name in PERMISSION_EVENTS or user_id is None:
+            pass
+        elif event_name == "GUILD_MEMBER_REMOVE":
+            change |= {"user_id": int(user_id), "roles": None}
+        elif "roles" in body:
+            change |= {"user_id": int(user_id), "roles": [int(role_id) for role_id in body["roles"]]}
+        self.apply(change)
+        return change
@@ -0,0 +1,116 @@
+"""
+    YEPCord: Free open source selfhostable fully discord-compatible chat
+    Copyright (C) 2022-2024 RuslanUC
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Iterator, Optional, Iterable
+
+from .config import Config
+
+EVENTS_CHANNEL = "yepcord_events"
+
+
+def interest_subscriptions() -> bool:
+    return Config.GATEWAY_SUBSCRIPTIONS == "interest"
+
+
+def shards_count() -> int:
+    return Config.GATEWAY_SHARDING["count"]
+
+
+def user_shard(user_id: int) -> int:
+    return (user_id >> 22) % shards_count()
+
+
+def local_shards() -> list[int]:
+    return Config.GATEWAY_SHARDING["shards"] or list(range(shards_count()))
+
+
+def events_channel(shard: int) -> str:
+    if shards_count() == 1:
+        return EVENTS_CHANNEL
+    return f"{EVENTS_CHANNEL}.{shard}"
+
+
+def guild_channel(guild_id: int) -> str:
+    return f"{EVENTS_CHANNEL}.guild.{guild_id}"
+
+
+def user_channel(user_id: int) -> str:
+    return f"{EVENTS_CHANNEL}.user.{user_id}"
+
+
+def _split_users(user_ids: Optional[list[int]]) -> dict[int, list[int]]:
+    result = {}
+    for user_id in user_ids or []:
+        result.setdefault(user_shard(user_id), []).append(user_id)
+    return result
+
+
+def split_message(message: dict, shards: Optional[Iterable[int]] = None) -> Iterator[tuple[int, dict]]:
+    """
+    Splits gateway dispatch message into per-shard messages.
+    Messages that only target users are published only to shards of these users (with user_ids narrowed to shard).
+    Guild/role messages (and messages that change guild, so every shard drops its cached guild) are published
+    to `shards` (shards of guild members) and shards of targeted users, or to every shard if `shards` is None.
+    Session messages are published to every shard since gateway can't know which shard holds session.
+    """
+
+    if shards_count() == 1:
+        yield 0, message
+        return
+
+    users = _split_users(message["user_ids"])
+    excluded = _split_users(message.get("exclude"))
+    targets = set(users)
+    if message["session_id"] is not None:
+        targets = set(range(shards_count()))
+    elif message["guild_id"] is not None or message["role_ids"] is not None \
+            or message.get("guild_changed") is not None:
+        targets |= set(range(shards_count()) if shards is None else shards)
+
+    for shard in sorted(targets):
+        yield shard, message | {
+            "user_ids": users.get(shard, []) if message["user_ids"] is not None else None,
+            "exclude": excluded.get(shard, []),
+        }
+
+
+def route_message(message: dict, guild_id: Optional[int] = None,
+                  shards: Optional[Iterable[int]] = None) -> Iterator[tuple[str, dict]]:
+    """
+    Returns broker channels (and messages for them) gateway dispatch message needs to be published to.
+    `shards` are shards of members of guild (see split_message), they are only used without "interest" mode.
+    In "interest" mode guild-scoped messages are published to guild channel, user-scoped ones - to channels of
+    every user, session-scoped (or guild-scoped messages with unknown guild) - to common events channel.
+    User-scoped messages that change guild are also published (without recipients) to channel of that guild, so every
+    gateway that has cached guild drops it.
+    """
+
+    if not interest_subscriptions():
+        for shard, shard_message in split_message(message, shards):
+            yield events_channel(shard), shard_message
+        return
+
+    if message["session_id"] is not None or (guild_id is None and message["role_ids"] is not None):
+        yield EVENTS_CHANNEL, message
+    elif guild_id is not None:
+        yield guild_channel(guild_id), message
+    else:
+        for user_id in message["user_ids"] or []:
+            yield user_channel(user_id), message | {"user_ids": [user_id], "exclude": []}
+        if (changed := message.get("guild_changed")) is not None:
+            yield guild_channel(changed), message | {"user_ids": None, "exclude": []}
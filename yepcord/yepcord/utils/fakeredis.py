@@ -1,98 +1,227 @@
-from asyncio import sleep, set_event_loop, new_event_loop
-from collections import defaultdict
-from threading import Thread
-from time import time
-from typing import Optional, Union
+from asyncio import get_running_loop, AbstractEventLoop, TimerHandle
+from math import ceil
+from typing import Optional, Union, Set
 
-
-class Value:
-    __slots__ = ("ex", "value")
-
-    def __init__(self, value: str, ex: int):
-        self.value = value
-        self.ex = ex
-
-    def expired(self) -> bool:
-        return 0 < self.ex < time()
+from redis.exceptions import ResponseError
 
 
 class FakeRedis:
-    def __init__(self, interval: int = 30):
-        self._interval = interval
-        self._kv: dict[str, Value] = {}
-        self._sets: dict[str, set] = defaultdict(set)
-        self._exp = defaultdict(set)
-        self._thread: Union[Thread, None] = None
-
-    def run(self):
-        self._thread = Thread(target=self._run_thread, daemon=True)
-        self._thread.start()
-
-    def _run_thread(self):
-        loop = new_event_loop()
-        set_event_loop(loop)
-        loop.run_until_complete(self._run_task())
-
-    def pipeline(self):
-        return self
-
-    async def _run_task(self):
-        last = int(time() // self._interval - 5)
-        while self._thread is not None:
-            await sleep(self._interval)
-            this = int(time() // self._interval - 1)
-            for i in range(last, this + 1):
-                exp = self._exp.pop(i, set())
-                for key in exp:
-                    if key in self._kv and self._kv[key].expired():
-                        del self._kv[key]
-
-                del exp
-            last = this
-
-    async def set(self, key: str, value: str, ex: int = None, nx: bool=False):
-        exp_time = int(time() + ex) if ex is not None else 0
-        val = self._kv.get(key, None)
-        if val is not None and not val.expired() and nx:
+    """
+    In-process replacement of redis for single-node deployments, implements subset of redis commands used by yepcord
+    (strings with TTL, sets and pipelines). Everything runs on the event loop that uses it.
+    Keys are expired lazily (expired key is never returned) and by a hashed timer wheel: every key with TTL is put into
+    the slot of its deadline, and every `resolution` seconds one slot is visited, so each key is checked once
+    per wheel rotation (keys with deadline further than one rotation stay in slot until their round).
+    """
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64):
+        self._data: dict[str, Union[str, Set[str]]] = {}
+        self._deadlines: dict[str, float] = {}
+        self._slot_of: dict[str, int] = {}
+        self._slots: list[Set[str]] = [set() for _ in range(slots)]
+        self._resolution = resolution
+        self._tick: Optional[int] = None
+        self._loop: Optional[AbstractEventLoop] = None
+        self._handle: Optional[TimerHandle] = None
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _now(self) -> float:
+        return get_running_loop().time()
+
+    def _alive(self, key: str) -> bool:
+        if key not in self._data:
+            return False
+        if (deadline := self._deadlines.get(key)) is not None and deadline <= self._now():
+            self._remove(key)
+            self.expired += 1
+            return False
+        return True
+
+    def _remove(self, key: str) -> None:
+        self._data.pop(key, None)
+        self._persist(key)
+
+    def _persist(self, key: str) -> bool:
+        if self._deadlines.pop(key, None) is None:
+            return False
+        self._slots[self._slot_of.pop(key)].discard(key)
+        return True
+
+    def _set_deadline(self, key: str, seconds: float) -> None:
+        self._persist(key)
+        deadline = self._deadlines[key] = self._now() + seconds
+        slot = self._slot_of[key] = ceil(deadline / self._resolution) % len(self._slots)
+        self._slots[slot].add(key)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        loop = get_running_loop()
+        if self._handle is not None and self._loop is loop:
             return
+        if self._tick is None or self._loop is not loop:
+            self._tick = int(loop.time() / self._resolution)
+        self._loop = loop
+        self._handle = loop.call_later(self._resolution, self._run)
+
+    def _run(self) -> None:
+        self._handle = None
+        now = self._loop.time()
+        current = int(now / self._resolution)
+        # After a long pause (e.g. blocked loop) each slot is visited at most once
+        for tick in range(max(self._tick + 1, current - len(self._slots) + 1), current + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key in [key for key in slot if self._deadlines[key] <= now]:
+                self._remove(key)
+                self.expired += 1
+        self._tick = current
+        if self._deadlines:
+            self._schedule()
+
+    def _get_set(self, key: str, create: bool = False) -> Optional[Set[str]]:
+        if not self._alive(key):
+            if not create:
+                return None
+            self._data[key] = set()
+        if not isinstance(value := self._data[key], set):
+            raise ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def pipeline(self, transaction: bool = True) -> "Pipeline":
+        return Pipeline(self)
+
+    async def set(self, name: str, value: str, ex: Optional[float] = None, px: Optional[float] = None,
+                  nx: bool = False, xx: bool = False, keepttl: bool = False) -> Optional[bool]:
+        exists = self._alive(name)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._data[name] = str(value) if not isinstance(value, (str, bytes)) else value
+        if ex is not None or px is not None:
+            self._set_deadline(name, ex if ex is not None else px / 1000)
+        elif not keepttl:
+            self._persist(name)
+        return True
+
+    async def get(self, name: str) -> Optional[str]:
+        if not self._alive(name):
+            return None
+        if isinstance(value := self._data[name], set):
+            raise ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    async def mget(self, keys: list[str], *args: str) -> list[Optional[str]]:
+        result = []
+        for key in [*([keys] if isinstance(keys, str) else keys), *args]:
+            value = self._data[key] if self._alive(key) else None
+            result.append(value if not isinstance(value, set) else None)
+        return result
+
+    async def exists(self, *names: str) -> int:
+        return sum(1 for name in names if self._alive(name))
+
+    async def delete(self, *names: str) -> int:
+        deleted = 0
+        for name in names:
+            if self._alive(name):
+                self._remove(name)
+                deleted += 1
+        return deleted
+
+    async def expire(self, name: str, time: float) -> bool:
+        if not self._alive(name):
+            return False
+        if time <= 0:
+            self._remove(name)
+        else:
+            self._set_deadline(name, time)
+        return True
+
+    async def persist(self, name: str) -> bool:
+        return self._alive(name) and self._persist(name)
+
+    async def ttl(self, name: str) -> int:
+        if not self._alive(name):
+            return -2
+        if (deadline := self._deadlines.get(name)) is None:
+            return -1
+        return ceil(deadline - self._now())
+
+    async def sadd(self, name: str, *values: str) -> int:
+        members = self._get_set(name, create=True)
+        count = len(members)
+        members.update(values)
+        return len(members) - count
+
+    async def srem(self, name: str, *values: str) -> int:
+        if (members := self._get_set(name)) is None:
+            return 0
+        count = len(members)
+        members.difference_update(values)
+        if not members:
+            self._remove(name)
+        return count - len(members)
+
+    async def sismember(self, name: str, value: str) -> bool:
+        return (members := self._get_set(name)) is not None and value in members
+
+    async def smembers(self, name: str) -> Set[str]:
+        return set(self._get_set(name) or ())
+
+    async def scard(self, name: str) -> int:
+        return len(self._get_set(name) or ())
+
+    async def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop = None
+
+    aclose = close
+
+
+class Pipeline:
+    """
+    Buffers commands like redis.asyncio pipeline (commands return pipeline itself and may be awaited),
+    execute() runs them in order without yielding to event loop, so pipeline is always atomic.
+    """
+
+    def __init__(self, redis: FakeRedis):
+        self._redis = redis
+        self._commands: list[tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, item: str):
+        if item.startswith("_") or not callable(getattr(FakeRedis, item, None)):
+            raise AttributeError(item)
+
+        def _command(*args, **kwargs) -> "Pipeline":
+            self._commands.append((item, args, kwargs))
+            return self
+
+        return _command
+
+    def __await__(self):
+        if False:  # pragma: no cover
+            yield
+        return self
 
-        if val is not None and val.ex > 0:
-            self._exp[exp_time // self._interval].remove(key)
-
-        self._kv[key] = Value(value, exp_time)
-        if ex is not None:
-            self._exp[exp_time // self._interval].add(key)
-
-    async def expire(self, key: str, ex: int) -> None:
-        if key not in self._kv:
-            return
-
-        val = self._kv[key]
-        val.ex = int(time() + ex)
-        self._exp[val.ex // self._interval].add(key)
-
-    async def get(self, key: str) -> Optional[str]:
-        val = self._kv.pop(key, None)
-        if val is None or val.expired():
-            return
-
-        return val.value
-
-    async def delete(self, key: str):
-        if key in self._kv:
-            del self._kv[key]
-
-    async def sadd(self, name: str, *values: str):
-        self._sets[name].update(values)
-
-    async def srem(self, name: str, *values: str):
-        self._sets[name].difference_update(set(values))
-
-    async def sismember(self, name: str, value: str):
-        return value in self._sets[name]
-
-    async def execute(self):
-        pass
+    async def __aenter__(self) -> "Pipeline":
+        return self
 
-    async def close(self):
-        self._thread = None
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._commands.clear()
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        commands, self._commands = self._commands, []
+        results = []
+        for name, args, kwargs in commands:
+            try:
+                results.append(await getattr(self._redis, name)(*args, **kwargs))
+            except ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results